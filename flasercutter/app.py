@@ -13,6 +13,7 @@ except ImportError:
 
 
 import cv2
+import numpy as np
 import serial.tools.list_ports
 
 from PyQt5 import QtCore
@@ -23,9 +24,21 @@ import pyqtgraph as pg
 
 from . import image_item
 from . import grbl_sender
+from . import autofocus
+from . import toolpath
 from . import calibration
+from . import contour_tracer
+from . import mosaic
 from . import camera_capture
 from . import image_stack_collector
+from . import focus_stack_worker
+from . import perf
+
+
+class GrblSignals(QtCore.QObject):
+
+    status = QtCore.pyqtSignal(object)
+    response = QtCore.pyqtSignal(str, object)
 
 
 class AppMainWindow(QtWidgets.QMainWindow):
@@ -40,6 +53,8 @@ class AppMainWindow(QtWidgets.QMainWindow):
 
     GRBL_TIMER_PERIOD = 1.0/100.0
     GRBL_STATUS_PERIOD = 1.0/5.0
+    GRBL_ACQUIRE_STATUS_PERIOD = 1.0/20.0
+    GRBL_USE_THREAD = True
     GRBL_MODE_IDLE = 1
     GRBL_MODE_RUN = 2
     GRBL_MODE_UNKNOWN = 3
@@ -59,6 +74,9 @@ class AppMainWindow(QtWidgets.QMainWindow):
 
     CUT_DEFAULT_FEEDRATE = 3.0
     CUT_DEFAULT_LASER_POWER = 20.0
+    CUT_TOOLPATH_TOLERANCE = toolpath.DEFAULT_TOLERANCE
+    CUT_TOOLPATH_ARCS = False
+    CUT_DEPTH_TOLERANCE = image_stack_collector.ImageStackCollector.DEFAULT_DEPTH_TOLERANCE
 
     IMAGE_LINE_COLOR = (0,0,255)
     IMAGE_LINE_THICKNESS =2
@@ -78,6 +96,21 @@ class AppMainWindow(QtWidgets.QMainWindow):
     FOCUS_STACK_THICKNESS = 2 
     FOCUS_STACK_LINE_TYPE = cv2.LINE_AA
 
+    GCODE_PROGRESS_PERIOD = 0.5
+
+    MOSAIC_DIRECTORY = os.path.join(os.environ['HOME'], 'flaser_mosaic')
+    MOSAIC_DEFAULT_SIZE = '2.0, 2.0'
+    MOSAIC_DISPLAY_MAX_SIZE = 4096
+
+    AUTOFOCUS_ROI_MARGIN_PX = 20
+
+    PERF_TIMER_PERIOD = 1.0
+    PERF_TRACE_FILENAME = 'flaser_trace.json'
+
+    OVERLAY_MODE_RASTER = 'raster'
+    OVERLAY_MODE_SCENE = 'scene'
+    DEFAULT_OVERLAY_MODE = OVERLAY_MODE_SCENE
+
     JOG_HOTKEY_DICT = {
             QtCore.Qt.Key_H         : (-1,  0,  0 ),
             QtCore.Qt.Key_L         : ( 1,  0,  0 ),
@@ -97,6 +130,9 @@ class AppMainWindow(QtWidgets.QMainWindow):
         self.grbl_timer = None
         self.grbl_timer_counter = 0
         self.grbl_last_status = time.time()
+        self.grbl_signals = GrblSignals()
+        self.gcode_stream = None
+        self.gcode_last_progress = time.time()
         self.wpos = None
         self.mode = self.GRBL_MODE_IDLE
 
@@ -105,17 +141,48 @@ class AppMainWindow(QtWidgets.QMainWindow):
         self.camera_timer = None
         self.camera_running = False
         self.camera_timer_counter = 0
+        self.camera_last_seq = -1
+        self.stack_last_seq = -1
         self.current_image = None
+        self.display_buffers = None
+        self.display_buffer_index = 0
+        self.overlay = None
+        self.overlay_key = None
+        self.overlay_mode = self.DEFAULT_OVERLAY_MODE
 
         # Point list for cutting and calibrating 
         self.px_point_list = []
         self.z_point_list = []
+        self.point_list_version = 0
 
         # Calibration data
         self.calibration = calibration.Calibration() 
+        self.mm_point_converter = calibration.PointConverter(self.calibration, 'px_to_mm')
 
         # Image stack collector
         self.image_stack_collector = image_stack_collector.ImageStackCollector()
+        self.focus_stack_worker = None
+        self.autofocus = autofocus.Autofocus()
+        self.thread_pool = QtCore.QThreadPool.globalInstance()
+
+        # Automatic contour tracing
+        self.contour_tracer = contour_tracer.ContourTracer()
+        self.contour_proposals = []
+        self.contour_index = 0
+        self.trace_roi = None
+
+        # Multi-field mosaic
+        self.mosaic_collector = mosaic.MosaicCollector()
+        self.mosaic_workers = {}
+        self.mosaic_image = None
+        self.mosaic_scale = 1
+        self.mosaic_center = None
+        self.displaying_mosaic = False
+        self.image_scale = 1
+
+        # Performance panel
+        self.perf_timer = None
+        self.perf_label = None
 
         self.initialize()
         self.connectActions()
@@ -128,6 +195,16 @@ class AppMainWindow(QtWidgets.QMainWindow):
     def grbl_idle(self):
         return self.mode == self.GRBL_MODE_IDLE
 
+    @property
+    def grbl_status_period(self):
+        # Poll faster while acquiring so the end of each move is seen promptly
+        if self.image_stack_collector.running or self.autofocus.running:
+            return self.GRBL_ACQUIRE_STATUS_PERIOD
+        elif self.mosaic_collector.acquiring:
+            return self.GRBL_ACQUIRE_STATUS_PERIOD
+        else:
+            return self.GRBL_STATUS_PERIOD
+
     def initialize(self):
         self.cameraStartStopPushButton.setText('Start')
         self.cameraDeviceComboBox.addItems(camera_capture.CameraCapture.get_devices())
@@ -168,6 +245,18 @@ class AppMainWindow(QtWidgets.QMainWindow):
         self.cameraView.ui.menuBtn.hide()
         self.imageItem = image_item.ImageItem(axisOrder='row-major')
         self.cameraView.addItem(self.imageItem)
+        self.annotation_overlay = image_item.AnnotationOverlay(
+                self.cameraView,
+                point_color=bgr_to_rgb(self.IMAGE_POINT_COLOR),
+                point_size=self.IMAGE_POINT_SIZE,
+                line_color=bgr_to_rgb(self.IMAGE_LINE_COLOR),
+                line_width=self.IMAGE_LINE_THICKNESS,
+                depth_color=bgr_to_rgb(self.IMAGE_DEPTH_COLOR),
+                depth_offset=self.IMAGE_DEPTH_OFFSET_PX,
+                label_color=bgr_to_rgb(self.FOCUS_STACK_COLOR),
+                label_pos=self.FOCUS_STACK_TEXT_POS,
+                )
+        self.annotation_overlay.set_visible(self.overlay_mode == self.OVERLAY_MODE_SCENE)
 
         os.makedirs(self.CONFIG_DIRECTORY, exist_ok=True)
         cal_ok, cal_msg = self.calibration.load(self.calibration_file_fullpath)
@@ -188,6 +277,38 @@ class AppMainWindow(QtWidgets.QMainWindow):
                 self.cutGroupBox,
                 ]
 
+        self.perf_label = QtWidgets.QLabel('')
+        self.statusbar.addPermanentWidget(self.perf_label)
+        self.perf_timer = QtCore.QTimer()
+        self.perf_timer.start(int(convert_sec_to_msec(self.PERF_TIMER_PERIOD)))
+        file_menu = self.menubar.addMenu('File')
+        self.runGcodeFileAction = file_menu.addAction('Run G-code file...')
+        tools_menu = self.menubar.addMenu('Tools')
+        self.traceContoursAction = tools_menu.addAction('Trace contours')
+        self.traceContoursAction.setShortcut('Ctrl+T')
+        self.nextContourAction = tools_menu.addAction('Next traced contour')
+        self.nextContourAction.setShortcut('Ctrl+N')
+        self.traceRoiAction = tools_menu.addAction('Trace region of interest')
+        self.traceRoiAction.setCheckable(True)
+        tools_menu.addSeparator()
+        self.rasterOverlayAction = tools_menu.addAction('Draw annotations into image')
+        self.rasterOverlayAction.setCheckable(True)
+        self.rasterOverlayAction.setChecked(self.overlay_mode == self.OVERLAY_MODE_RASTER)
+        tools_menu.addSeparator()
+        self.loadCalPointsAction = tools_menu.addAction('Load calibration points...')
+        tools_menu.addSeparator()
+        self.recordStacksAction = tools_menu.addAction('Record focus stacks...')
+        self.recordStacksAction.setCheckable(True)
+        tools_menu.addSeparator()
+        self.acquireMosaicAction = tools_menu.addAction('Acquire mosaic...')
+        self.openMosaicAction = tools_menu.addAction('Open mosaic...')
+        self.showMosaicAction = tools_menu.addAction('Show mosaic')
+        self.showMosaicAction.setCheckable(True)
+        self.showMosaicAction.setEnabled(False)
+        tools_menu.addSeparator()
+        self.exportTraceAction = tools_menu.addAction('Export performance trace...')
+        self.clearPerfAction = tools_menu.addAction('Clear performance stats')
+
     def connectActions(self):
         self.stopPushButton.clicked.connect(self.onStopPushButtonClicked)
         self.gotoZeroPushButton.clicked.connect(self.onGotoZeroButtonClicked)
@@ -195,11 +316,26 @@ class AppMainWindow(QtWidgets.QMainWindow):
 
         self.cameraStartStopPushButton.clicked.connect(self.onCameraStartStopButtonClicked)
         self.camera_timer.timeout.connect(self.onCameraTimer)
+        self.perf_timer.timeout.connect(self.onPerfTimer)
+        self.exportTraceAction.triggered.connect(self.onExportTraceAction)
+        self.runGcodeFileAction.triggered.connect(self.onRunGcodeFileAction)
+        self.traceContoursAction.triggered.connect(self.onTraceContoursAction)
+        self.nextContourAction.triggered.connect(self.onNextContourAction)
+        self.traceRoiAction.toggled.connect(self.onTraceRoiToggled)
+        self.rasterOverlayAction.toggled.connect(self.onRasterOverlayToggled)
+        self.loadCalPointsAction.triggered.connect(self.onLoadCalPointsAction)
+        self.recordStacksAction.toggled.connect(self.onRecordStacksToggled)
+        self.acquireMosaicAction.triggered.connect(self.onAcquireMosaicAction)
+        self.openMosaicAction.triggered.connect(self.onOpenMosaicAction)
+        self.showMosaicAction.toggled.connect(self.onShowMosaicToggled)
+        self.clearPerfAction.triggered.connect(perf.monitor.clear)
         self.cameraExposureSpinBox.valueChanged.connect(self.onCameraExposureChanged)
 
         self.grblConnectPushButton.clicked.connect(self.onGrblConnectButtonClicked)
         self.grblRefreshPushButton.clicked.connect(self.onGrblRefreshButtonClicked)
         self.grbl_timer.timeout.connect(self.onGrblTimer)
+        self.grbl_signals.status.connect(self.onGrblStatus)
+        self.grbl_signals.response.connect(self.onGrblResponse)
 
         self.laserEnableCheckBox.stateChanged.connect(self.onLaserEnableChanged)
         self.laserPowerSlider.valueChanged.connect(self.onLaserPowerChanged)
@@ -244,6 +380,7 @@ class AppMainWindow(QtWidgets.QMainWindow):
 
         self.cutRunPushButton.clicked.connect(self.onCutRunButtonClicked)
         self.focusStackRunPushButton.clicked.connect(self.onFocusStackRunButtonClicked)
+        self.focusStackAutofocusPushButton.clicked.connect(self.onFocusStackAutofocusButtonClicked)
 
         self.imageItem.leftMousePressSignal.connect(self.onImageLeftMouseClick)
         self.imageItem.rightMousePressSignal.connect(self.onImageRightMouseClick)
@@ -252,9 +389,16 @@ class AppMainWindow(QtWidgets.QMainWindow):
     def onClearPointsClicked(self):
         self.px_point_list = []
         self.z_point_list = []
+        self.points_changed()
         self.update_image()
 
     def onStopPushButtonClicked(self):
+        if self.autofocus.running:
+            self.autofocus.stop()
+            self.cutInfoPlainTextEdit.appendPlainText('autofocus stopped')
+        if self.mosaic_collector.running:
+            self.stop_mosaic()
+            self.cutInfoPlainTextEdit.appendPlainText('mosaic stopped')
         if self.grbl:
             self.grbl.soft_stop()
 
@@ -262,8 +406,11 @@ class AppMainWindow(QtWidgets.QMainWindow):
         if not self.camera_running:
             device = self.cameraDeviceComboBox.currentText()
             self.camera = camera_capture.CameraCapture(device)
+            self.camera.start_thread()
             self.camera_running = True
             self.camera_timer_counter = 0
+            self.camera_last_seq = -1
+            self.stack_last_seq = -1
             self.camera_timer.start(int(convert_sec_to_msec(self.CAMERA_TIMER_PERIOD)))
             self.cameraStartStopPushButton.setText('Stop')
             self.cameraExposureSpinBox.setEnabled(True)
@@ -278,47 +425,153 @@ class AppMainWindow(QtWidgets.QMainWindow):
     def onCameraExposureChanged(self,value):
         rval = self.camera.set_exposure(value)
 
+    @perf.monitor.timed('camera_timer')
     def onCameraTimer(self):
-        ok, img_bgr = self.camera.read()
-        if ok:
+        frame = self.camera.read_latest(self.camera_last_seq)
+        if frame is not None:
+            if self.camera_last_seq >= 0 and frame.seq > self.camera_last_seq + 1:
+                perf.monitor.count('display_skipped', frame.seq - self.camera_last_seq - 1)
+            perf.monitor.count('display_frame')
+            self.camera_last_seq = frame.seq
+            img_bgr = frame.image
             self.current_image = img_bgr
-            self.update_image()
+            # A mosaic on display only needs redrawing when something changes
+            if not (self.show_mosaic and self.displaying_mosaic):
+                self.update_image()
             self.camera_timer_counter += 1
             self.setCameraFrameCountLabel(self.camera_timer_counter)
-            if self.image_stack_collector.running and self.grbl_idle:
-                if self.image_stack_collector.is_first:
-                    min_z = self.focusStackMinZDoubleSpinBox.value()
-                    max_z = self.focusStackMaxZDoubleSpinBox.value()
-                    num_z = self.focusStackQtySpinBox.value()
-                    self.image_stack_collector.set_range(min_z, max_z, num_z)
-                    self.cutInfoPlainTextEdit.appendPlainText('focus stack begin')
-                if self.image_stack_collector.step_complete:
-                    z_val = self.image_stack_collector.next_step()
+            if self.autofocus.running:
+                self.update_autofocus(frame)
+            collector = self.image_stack_collector
+            if self.mosaic_collector.settled_at(frame.timestamp) and not collector.running:
+                index = self.mosaic_collector.begin_tile()
+                num_tiles = self.mosaic_collector.num_tiles
+                self.cutInfoPlainTextEdit.appendPlainText(f'mosaic tile {index + 1}/{num_tiles}')
+                self.cancel_focus_stack_worker()
+                collector.start()
+            if collector.running and collector.is_first:
+                self.begin_focus_stack()
+            if collector.running and collector.sweep:
+                self.update_sweep()
+            elif collector.running and self.grbl_idle:
+                if collector.step_complete:
+                    z_val = collector.next_step()
+                    self.stack_last_seq = frame.seq
                     if z_val is None:
                         z_val = 0.0
-                    feedrate = self.jogFeedrateDoubleSpinBox.value()
-                    cmd_list = []
-                    cmd_list.append(f'G90')
-                    cmd_list.append(f'F{feedrate:0.1f}')
-                    cmd_list.append(f'G1 Z{z_val:0.3f}')
-                    if self.grbl:
-                        self.grbl.extend_cmd(cmd_list)
-                        info_msg = f'  moving to z= {z_val:0.3f}'
-                    else:
-                        info_msg = 'unable to move, grbl not connected'
-                    self.cutInfoPlainTextEdit.appendPlainText(info_msg)
-                    if not self.image_stack_collector.running:
-                        self.cutInfoPlainTextEdit.appendPlainText('focus stack done')
-                        self.image_stack_collector.calc_focus_and_depth_images()
-                        #self.image_stack_collector.save()
-                elif self.image_stack_collector.settled: 
-                    self.image_stack_collector.add_image(img_bgr)
+                    self.move_to_z(z_val)
+                    if not collector.running:
+                        self.focus_stack_done()
+                elif collector.settled: 
+                    # Take every frame captured since the last one used by the stack
+                    num_needed = collector.images_needed
+                    for stack_frame in self.camera.read_next(self.stack_last_seq, num_needed):
+                        self.stack_last_seq = stack_frame.seq
+                        if collector.frame_settled(stack_frame.image, stack_frame.timestamp):
+                            collector.add_image(stack_frame.image, stack_frame.timestamp)
 
         if self.image_stack_collector.ready:
             self.focusStackShowCheckBox.setEnabled(True)
         else:
             self.focusStackShowCheckBox.setEnabled(False)
 
+    def begin_focus_stack(self):
+        collector = self.image_stack_collector
+        min_z = self.focusStackMinZDoubleSpinBox.value()
+        max_z = self.focusStackMaxZDoubleSpinBox.value()
+        num_z = self.focusStackQtySpinBox.value()
+        # Without grbl there are no status reports to synchronize with or sweep from
+        collector.sweep = self.focusStackSweepCheckBox.isChecked() and self.grbl is not None
+        collector.adaptive = self.focusStackAdaptiveCheckBox.isChecked() and not collector.sweep
+        collector.sync_motion = self.grbl is not None
+        collector.set_range(min_z, max_z, num_z)
+        self.cutInfoPlainTextEdit.appendPlainText('focus stack begin')
+
+    def focus_stack_done(self):
+        num_steps = len(self.image_stack_collector.step_to_image_median)
+        self.cutInfoPlainTextEdit.appendPlainText(f'focus stack done, {num_steps} steps')
+        if self.image_stack_collector.record_dir is not None:
+            record_path = self.image_stack_collector.record_path
+            self.cutInfoPlainTextEdit.appendPlainText(f'  recorded to {record_path}')
+        if self.mosaic_collector.stacking:
+            # The tile is computed while the stage moves on to the next one
+            self.start_mosaic_tile_worker(self.mosaic_collector.index)
+            target = self.mosaic_collector.end_tile()
+            if target is not None:
+                self.move_to_xy(*target)
+            return
+        self.start_focus_stack_worker()
+        #self.image_stack_collector.save()
+
+    def update_sweep(self):
+        collector = self.image_stack_collector
+        try:
+            move = collector.next_sweep_move()
+        except ValueError as err:
+            collector.stop()
+            self.cutInfoPlainTextEdit.appendPlainText(f'unable to sweep, {err}')
+            return
+        if move is not None:
+            z_val, feedrate = move
+            self.move_to_z(z_val, feedrate)
+            self.stack_last_seq = self.camera_last_seq
+        if collector.sweeping:
+            # Every frame is used, each is binned by the z interpolated at its timestamp
+            num_frames = camera_capture.CameraCapture.DEFAULT_RING_SIZE
+            for sweep_frame in self.camera.read_next(self.stack_last_seq, num_frames):
+                self.stack_last_seq = sweep_frame.seq
+                collector.add_sweep_frame(sweep_frame.image, sweep_frame.timestamp)
+
+    def update_autofocus(self, frame):
+        if self.autofocus.step_complete:
+            z_val = self.autofocus.next_step()
+            self.stack_last_seq = frame.seq
+            self.move_to_z(z_val)
+            if not self.autofocus.running:
+                num_moves = self.autofocus.num_moves
+                info_msg = f'autofocus done, best z= {z_val:0.3f} after {num_moves} moves'
+                self.cutInfoPlainTextEdit.appendPlainText(info_msg)
+        else:
+            # Only frames captured once grbl reports the move complete are measured
+            num_needed = self.autofocus.images_needed
+            for af_frame in self.camera.read_next(self.stack_last_seq, num_needed):
+                self.stack_last_seq = af_frame.seq
+                if self.autofocus.settled_at(af_frame.timestamp):
+                    self.autofocus.add_image(af_frame.image, af_frame.timestamp)
+
+    def move_to_z(self, z_val, feedrate=None):
+        if feedrate is None:
+            feedrate = self.jogFeedrateDoubleSpinBox.value()
+        cmd_list = []
+        cmd_list.append(f'G90')
+        cmd_list.append(f'F{feedrate:0.1f}')
+        cmd_list.append(f'G1 Z{z_val:0.3f}')
+        if self.grbl:
+            self.grbl.extend_cmd(cmd_list)
+            info_msg = f'  moving to z= {z_val:0.3f}'
+        else:
+            info_msg = 'unable to move, grbl not connected'
+        self.cutInfoPlainTextEdit.appendPlainText(info_msg)
+
+    def move_to_xy(self, x_val, y_val, feedrate=None):
+        if feedrate is None:
+            feedrate = self.jogFeedrateDoubleSpinBox.value()
+        cmd_list = []
+        cmd_list.append(f'G90')
+        cmd_list.append(f'F{feedrate:0.1f}')
+        cmd_list.append(f'G1 X{x_val:0.3f} Y{y_val:0.3f}')
+        if self.grbl:
+            self.grbl.extend_cmd(cmd_list)
+            info_msg = f'  moving to x= {x_val:0.3f}, y= {y_val:0.3f}'
+        else:
+            info_msg = 'unable to move, grbl not connected'
+        self.cutInfoPlainTextEdit.appendPlainText(info_msg)
+
+    @property
+    def show_mosaic(self):
+        return self.showMosaicAction.isChecked() and self.mosaic_image is not None
+
+    @perf.monitor.timed('update_image')
     def update_image(self): 
 
         # Check to see if we are currently send data to grbl.  
@@ -329,10 +582,121 @@ class AppMainWindow(QtWidgets.QMainWindow):
         # Get image for display.  Which image is used depends on whether or not focus stack 
         # image is selected and ready. 
         show_focus_stack = self.focusStackShowCheckBox.isChecked() and self.image_stack_collector.ready
+        show_focus_stack = show_focus_stack and not self.show_mosaic
+        if not sending and self.show_mosaic:
+            img_bgr = self.mosaic_image
+        elif not sending and show_focus_stack:
+            img_bgr = self.image_stack_collector.focus_image
+        else:
+            img_bgr = self.current_image
+        if img_bgr is None:
+            return
+        self.displaying_mosaic = img_bgr is self.mosaic_image
+
+        # The mosaic is shown as a downsampled overview scaled back up, so the view (and
+        # the annotations and clicks) stays in full resolution mosaic pixels
+        image_scale = self.mosaic_scale if self.displaying_mosaic else 1
+        if image_scale != self.image_scale:
+            self.imageItem.setTransform(QtGui.QTransform.fromScale(image_scale, image_scale))
+            self.image_scale = image_scale
+
+        # pyqtgraph wants rgb, but it copies the image into its own ARGB buffer when it
+        # renders and picks the channels out as it does so. Handing it a channel reversed
+        # view of the bgr image costs nothing, so there is no conversion pass here. The
+        # annotations are either pyqtgraph items over the image or a cached overlay 
+        # which is composited onto a copy in a reused display buffer.
+        if self.overlay_mode == self.OVERLAY_MODE_SCENE or self.displaying_mosaic:
+            self.update_scene_overlay(img_bgr.shape, sending, show_focus_stack)
+            overlay_bbox = None
+        else:
+            overlay_bgr, overlay_mask, overlay_bbox = self.get_overlay(
+                    img_bgr.shape, 
+                    sending, 
+                    show_focus_stack,
+                    )
+        if overlay_bbox is not None:
+            img_display = self.get_display_buffer(img_bgr.shape)
+            np.copyto(img_display, img_bgr)
+            np.copyto(
+                    img_display[overlay_bbox], 
+                    overlay_bgr[overlay_bbox], 
+                    where=overlay_mask[overlay_bbox]
+                    )
+        else:
+            img_display = img_bgr
+        self.imageItem.setImage(img_display[:,:,::-1],autoRange=False,autoLevels=False)
+        #cv2.imshow('image', img_bgr)
+
+    def get_display_buffer(self, shape):
+        # Alternate between two buffers so the one handed to pyqtgraph last isn't
+        # overwritten before it has been rendered.
+        if self.display_buffers is None or self.display_buffers[0].shape != shape:
+            self.display_buffers = [np.zeros(shape, dtype=np.uint8) for i in range(2)]
+        self.display_buffer_index = (self.display_buffer_index + 1) % len(self.display_buffers)
+        return self.display_buffers[self.display_buffer_index]
+
+    def points_changed(self):
+        self.point_list_version += 1
+
+    def get_overlay_key(self, shape, sending, show_focus_stack):
+        return (
+                self.overlay_mode,
+                shape,
+                sending,
+                show_focus_stack,
+                self.image_stack_collector.running,
+                self.show_mosaic,
+                self.pointsVisibleCheckBox.isChecked(),
+                self.point_list_version,
+                self.calibration.ok,
+                self.calibration.version,
+                )
+
+    def get_overlay(self, shape, sending, show_focus_stack):
+        key = self.get_overlay_key(shape, sending, show_focus_stack)
+        if key != self.overlay_key:
+            self.overlay = self.render_overlay(shape, sending, show_focus_stack)
+            self.overlay_key = key
+            # The scene items may have been shown for the mosaic
+            self.annotation_overlay.set_visible(False)
+        return self.overlay
+
+    def update_scene_overlay(self, shape, sending, show_focus_stack):
+        key = self.get_overlay_key(shape, sending, show_focus_stack)
+        if key == self.overlay_key:
+            return
+        self.overlay_key = key
+        overlay = self.annotation_overlay
+        overlay.set_visible(True)
+        if self.image_stack_collector.running:
+            overlay.set_label('Running Focus Stack')
+        elif not sending and self.show_mosaic:
+            overlay.set_label('Mosaic')
+        elif not sending and show_focus_stack:
+            overlay.set_label('Focus Stack')
+        else:
+            overlay.set_label('')
+        overlay.set_points(self.px_point_list, self.z_point_list)
+        overlay.set_points_visible(not sending and self.pointsVisibleCheckBox.isChecked())
+        if self.calibration.ok and not self.show_mosaic:
+            overlay.set_laser_pos(self.calibration.laser_pos_px)
+        else:
+            overlay.set_laser_pos(None)
+
+    def set_overlay_mode(self, mode):
+        self.overlay_mode = mode
+        self.overlay_key = None
+        self.annotation_overlay.set_visible(mode == self.OVERLAY_MODE_SCENE)
+        self.update_image()
+
+    def render_overlay(self, shape, sending, show_focus_stack):
+        """ Draws the annotations (labels, points, depths, path and laser position) into
+        an otherwise empty image. Returns the bgr overlay, a mask of the annotated pixels 
+        and the bounding box of the mask (or None if there is nothing to draw).
+        """
+        img_bgr = np.zeros(shape, dtype=np.uint8)
 
         if not sending and show_focus_stack:
-            # Use focus stack image
-            img_bgr = self.image_stack_collector.focus_image.copy()
             cv2.putText(
                     img_bgr, 
                     'Focus Stack', 
@@ -343,9 +707,6 @@ class AppMainWindow(QtWidgets.QMainWindow):
                     self.FOCUS_STACK_THICKNESS, 
                     self.FOCUS_STACK_LINE_TYPE
                     )
-        else:
-            # Use current image from camera
-            img_bgr = self.current_image.copy()
 
         if self.image_stack_collector.running:
             # Show message if running focus stak
@@ -379,7 +740,7 @@ class AppMainWindow(QtWidgets.QMainWindow):
             for p, q in zip(self.px_point_list[:-1], self.px_point_list[1:]):
                 cv2.line(img_bgr, p, q, self.IMAGE_LINE_COLOR,self.IMAGE_LINE_THICKNESS)
 
-        if self.calibration.ok:
+        if self.calibration.ok and not self.show_mosaic:
             # Add laser position indicator
             cx, cy = self.calibration.laser_pos_px
             cx = int(cx)
@@ -387,9 +748,15 @@ class AppMainWindow(QtWidgets.QMainWindow):
             sz = 10
             cv2.line(img_bgr, (cx-sz,cy), (cx+sz,cy), (255,255,255), 2)
             cv2.line(img_bgr, (cx,cy-sz), (cx,cy+sz), (255,255,255), 2)
-        img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-        self.imageItem.setImage(img_rgb,autoRange=False,autoLevels=False)
-        #cv2.imshow('image', img_bgr)
+
+        mask = img_bgr.any(axis=2)
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if rows.size:
+            bbox = (slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1))
+        else:
+            bbox = None
+        return img_bgr, mask[:,:,np.newaxis], bbox
 
     def setCameraFrameCountLabel(self,value):
         self.cameraFrameCountLabel.setText(f'Frame count: {self.camera_timer_counter}')
@@ -398,6 +765,12 @@ class AppMainWindow(QtWidgets.QMainWindow):
         if self.grbl is None and self.grblDeviceComboBox.count()>0:
             device = self.grblDeviceComboBox.currentText()
             self.grbl = grbl_sender.GrblSender(port=device)
+            if self.GRBL_USE_THREAD:
+                self.grbl.start_thread(
+                        status_callback=self.grbl_signals.status.emit,
+                        response_callback=self.grbl_signals.response.emit,
+                        status_period=self.GRBL_STATUS_PERIOD,
+                        )
             self.grblConnectPushButton.setText('Diconnect')
             self.grblRefreshPushButton.setEnabled(False)
         else:
@@ -410,33 +783,103 @@ class AppMainWindow(QtWidgets.QMainWindow):
     def onGrblRefreshButtonClicked(self):
         self.grblDeviceComboBox.addItems(get_usbserial_devices())
 
+    @perf.monitor.timed('grbl_timer')
     def onGrblTimer(self):
         self.grbl_timer_counter += 1
         now = time.time()
         if self.grbl:
-            query_status = False
-            if now - self.grbl_last_status > self.GRBL_STATUS_PERIOD:
-                self.grbl_last_status = now
-                query_status = True
-            rsp = self.grbl.update(query_status=query_status)
-            if 'status' in rsp:
-                #print(rsp['status'])
-                self.wpos = rsp['status']['WPos']
-                mode_str = rsp['status']['mode']
-                self.mode = self.GRBL_MODE_DICT.get(mode_str, self.GRBL_MODE_UNKNOWN)
-                self.modeLabel.setText(mode_str)
-                x = rm_negative_zero(rsp['status']['WPos']['x'])
-                y = rm_negative_zero(rsp['status']['WPos']['y'])
-                z = rm_negative_zero(rsp['status']['WPos']['z'])
-                x_str = f"{x:1.3f}".rjust(6,' ')
-                y_str = f"{y:1.3f}".rjust(6,' ')
-                z_str = f"{z:1.3f}".rjust(6,' ')
-                self.xLcdNumber.display(x_str)
-                self.yLcdNumber.display(y_str)
-                self.zLcdNumber.display(z_str)
+            self.grbl.status_period = self.grbl_status_period
+            if not self.grbl.threaded:
+                # Serial i/o is done from this timer when the grbl thread isn't running
+                query_status = False
+                if now - self.grbl_last_status > self.grbl_status_period:
+                    self.grbl_last_status = now
+                    query_status = True
+                rsp = self.grbl.update(query_status=query_status)
+                if 'status' in rsp:
+                    self.onGrblStatus(rsp['status'])
+                for line, cmd in rsp.get('responses', []):
+                    self.onGrblResponse(line, cmd)
+            if self.gcode_stream is not None:
+                self.update_gcode_progress(now)
             if not self.grbl.sending:
                 self.reenable_widgets()
 
+    def onRunGcodeFileAction(self):
+        if not self.grbl:
+            self.cutInfoPlainTextEdit.appendPlainText('unable to run, grbl not connected')
+            return
+        if self.grbl.sending:
+            self.cutInfoPlainTextEdit.appendPlainText('unable to run, grbl is busy')
+            return
+        filename, _ = QtWidgets.QFileDialog.getOpenFileName(
+                self, 
+                'Run G-code file', 
+                os.environ['HOME'], 
+                'G-code (*.gcode *.nc *.ngc *.tap);;All files (*)',
+                )
+        if not filename:
+            return
+        try:
+            self.gcode_stream = self.grbl.stream_gcode(filename)
+        except (OSError, RuntimeError, ValueError) as err:
+            self.cutInfoPlainTextEdit.appendPlainText(f'unable to run {filename}: {err}')
+            return
+        self.disable_widgets_on_run()
+        self.cutInfoPlainTextEdit.appendPlainText(f'streaming {filename}')
+
+    def update_gcode_progress(self, now):
+        stream = self.gcode_stream
+        if stream.done:
+            self.gcode_stream = None
+            if stream.error is not None:
+                info_msg = f'G-code stream stopped, laser off: {stream.error}'
+                self.cutInfoPlainTextEdit.appendPlainText(info_msg)
+            else:
+                self.cutInfoPlainTextEdit.appendPlainText(f'G-code sent, {stream.lines_sent} lines')
+        elif now - self.gcode_last_progress > self.GCODE_PROGRESS_PERIOD:
+            self.gcode_last_progress = now
+            msg = f'G-code {stream.lines_sent} lines, {stream.bytes_sent} bytes sent'
+            if stream.total_bytes:
+                msg = f'{msg} ({100*stream.bytes_read/stream.total_bytes:0.0f}% read)'
+            self.statusbar.showMessage(msg)
+
+    def onGrblStatus(self, status):
+        if not self.grbl:
+            return
+        self.wpos = status['WPos']
+        mode_str = status['mode']
+        self.mode = self.GRBL_MODE_DICT.get(mode_str, self.GRBL_MODE_UNKNOWN)
+        self.modeLabel.setText(mode_str)
+        x = rm_negative_zero(status['WPos']['x'])
+        y = rm_negative_zero(status['WPos']['y'])
+        z = rm_negative_zero(status['WPos']['z'])
+        x_str = f"{x:1.3f}".rjust(6,' ')
+        y_str = f"{y:1.3f}".rjust(6,' ')
+        z_str = f"{z:1.3f}".rjust(6,' ')
+        self.xLcdNumber.display(x_str)
+        self.yLcdNumber.display(y_str)
+        self.zLcdNumber.display(z_str)
+        timestamp = status.get('timestamp')
+        self.autofocus.update_motion(self.grbl_idle, status['WPos']['z'], timestamp)
+        collector = self.image_stack_collector
+        collector.update_motion(self.grbl_idle, status['WPos']['z'], timestamp)
+        self.mosaic_collector.update_motion(
+                self.grbl_idle, 
+                status['WPos']['x'], 
+                status['WPos']['y'], 
+                timestamp,
+                )
+        if collector.sweeping:
+            collector.add_status(status['WPos']['z'], timestamp or time.time())
+            if not collector.running:
+                self.focus_stack_done()
+
+    def onGrblResponse(self, line, cmd):
+        if 'error' in line:
+            cmd_str = cmd.strip() if cmd is not None else ''
+            self.cutInfoPlainTextEdit.appendPlainText(f'grbl {line}: {cmd_str}')
+
     def onJogPushButtonClicked(self, x_sign, y_sign, z_sign):
         xy_step_size = self.jogStepXYDoubleSpinBox.value()
         z_step_size = self.jogStepZDoubleSpinBox.value()
@@ -472,7 +915,7 @@ class AppMainWindow(QtWidgets.QMainWindow):
         if self.laserEnableCheckBox.checkState() == QtCore.Qt.CheckState.Checked:
             laser_power = self.get_laser_power()
             cmd = ['M3', f'S {laser_power}']
-            self.grbl.send_gcode(cmd)
+            self.grbl.extend_cmd(cmd)
 
     def onLaserEnableChanged(self, state):
         if state == QtCore.Qt.CheckState.Unchecked:
@@ -482,7 +925,7 @@ class AppMainWindow(QtWidgets.QMainWindow):
             laser_power = self.get_laser_power()
             cmd = ['M3', f'S {laser_power}']
             self.laserPowerSlider.setEnabled(False)
-        self.grbl.send_gcode(cmd)
+        self.grbl.extend_cmd(cmd)
 
     def get_laser_power(self): 
         percent = self.laserPowerSlider.value()
@@ -542,9 +985,63 @@ class AppMainWindow(QtWidgets.QMainWindow):
                     }
             self.calibration.update(cal_data)
             self.calInfoPlainTextEdit.appendPlainText('calibration points accepted')
+            self.show_calibration_residuals()
         else:
             self.calInfoPlainTextEdit.appendPlainText('too few calibration points')
 
+    def onLoadCalPointsAction(self):
+        filename, _ = QtWidgets.QFileDialog.getOpenFileName(
+                self, 
+                'Load calibration points', 
+                os.environ['HOME'], 
+                'Calibration points (*.json);;All files (*)',
+                )
+        if not filename:
+            return
+        try:
+            cal_data = calibration.load_correspondences(filename)
+        except (OSError, ValueError) as err:
+            self.calInfoPlainTextEdit.appendPlainText(f'unable to load {filename}: {err}')
+            return
+        if 'image_points' not in cal_data:
+            # Target positions only - match them to the points picked on the image
+            cal_data['image_points'] = list(self.px_point_list)
+        num_points = len(cal_data['target_points_mm'])
+        if len(cal_data['image_points']) != num_points:
+            info_msg = f'{len(cal_data["image_points"])} image points for {num_points} targets'
+            self.calInfoPlainTextEdit.appendPlainText(info_msg)
+            return
+        if num_points < self.CALIBRATION_MINIMUM_POINTS:
+            self.calInfoPlainTextEdit.appendPlainText('too few calibration points')
+            return
+        if cal_data.get('distortion', False) and 'image_size' not in cal_data:
+            if self.current_image is None:
+                self.calInfoPlainTextEdit.appendPlainText('distortion fit requires an image')
+                return
+            height, width = self.current_image.shape[:2]
+            cal_data['image_size'] = [width, height]
+        # Fit a scratch calibration first so a bad fit leaves the current one alone
+        try:
+            calibration.Calibration().update(cal_data)
+        except (ValueError, RuntimeError, cv2.error) as err:
+            self.calInfoPlainTextEdit.appendPlainText(f'calibration failed: {err}')
+            return
+        self.calibration.update(cal_data)
+        self.calInfoPlainTextEdit.appendPlainText(f'calibration points loaded, {num_points} points')
+        self.show_calibration_residuals()
+
+    def show_calibration_residuals(self):
+        vals = self.calibration.vals
+        residual_rms_um = 1000*vals['residual_rms_mm']
+        residual_max_um = 1000*vals['residual_max_mm']
+        self.calInfoPlainTextEdit.appendPlainText(f'  residual rms = {residual_rms_um:0.1f} um')
+        self.calInfoPlainTextEdit.appendPlainText(f'  residual max = {residual_max_um:0.1f} um')
+        if 'inliers' in vals:
+            num_inliers = int(vals['inliers'].sum())
+            self.calInfoPlainTextEdit.appendPlainText(f'  inliers = {num_inliers}/{vals["inliers"].size}')
+        if 'distortion_rms_px' in vals:
+            self.calInfoPlainTextEdit.appendPlainText(f'  distortion rms = {vals["distortion_rms_px"]:0.2f} px')
+
 
     def onCalSaveDataPointsButtonClicked(self):
         self.calibration.save(self.calibration_file_fullpath)
@@ -563,32 +1060,342 @@ class AppMainWindow(QtWidgets.QMainWindow):
 
         feedrate = self.cutLaserFeedrateDoubleSpinBox.value()
         power = percent_to_laser_power(self.cutLaserPowerDoubleSpinBox.value())
-        px_point_list_mm = self.calibration.convert_px_to_mm(self.px_point_list)
-        xyz_point_list = [(p[0],p[1],z) for p,z in zip(px_point_list_mm, self.z_point_list)]
+        if self.show_mosaic:
+            px_point_array, z_point_array = self.mosaic_collector.mosaic.sample_path_depth(
+                    self.px_point_list,
+                    tolerance=self.CUT_DEPTH_TOLERANCE,
+                    )
+            px_point_array_mm = self.mosaic_collector.mosaic.px_to_mm(px_point_array)
+            if np.isnan(z_point_array).any():
+                self.cutInfoPlainTextEdit.appendPlainText('unable to run, path leaves mosaic')
+                return
+        elif self.focusStackShowCheckBox.isChecked() and self.image_stack_collector.ready:
+            # Follow the depth between the vertices, not just at them
+            px_point_array, z_point_array = self.image_stack_collector.sample_path_depth(
+                    self.px_point_list,
+                    tolerance=self.CUT_DEPTH_TOLERANCE,
+                    )
+            px_point_array_mm = self.calibration.px_to_mm(px_point_array)
+        else:
+            px_point_array_mm = self.mm_point_converter.update(self.px_point_list)
+            z_point_array = np.array(self.z_point_list)
+        xyz_point_list = np.column_stack((px_point_array_mm, z_point_array))
         x0, y0, z0 = xyz_point_list[0]
+        moves = toolpath.optimize_toolpath(
+                xyz_point_list, 
+                tolerance=self.CUT_TOOLPATH_TOLERANCE, 
+                arcs=self.CUT_TOOLPATH_ARCS,
+                )
         cmd_list = []
         cmd_list.append(f'G90')
+        cmd_list.append(f'G17')
         cmd_list.append(f'F{feedrate:0.1f}')
         cmd_list.append(f'G1 X{x0:0.3f} Y{y0:0.3f} Z{z0:0.3f}')
         cmd_list.append(f'M3 S{power}')
-        for x,y,z in xyz_point_list[1:]:
-            cmd_list.append(f'G1 X{x:0.3f} Y{y:0.3f} Z{z:0.3f}')
+        cmd_list.extend(toolpath.toolpath_to_gcode(moves))
         cmd_list.append(f'M5 S0')
         cmd_list.append('G1 X0 Y0 Z0')
         if self.grbl:
             self.grbl.extend_cmd(cmd_list)
-            info_msg = f'running cut with {len(self.px_point_list)} points'
+            info_msg = f'running cut with {len(self.px_point_list)} points, {len(moves)} moves'
         else:
             info_msg = 'unable to run, grbl not connected'
         self.cutInfoPlainTextEdit.appendPlainText(info_msg)
 
     def onFocusStackRunButtonClicked(self):
-        if self.camera_running: # and self.grbl:
+        if self.camera_running and not self.autofocus.running: # and self.grbl:
+            self.cancel_focus_stack_worker()
             self.image_stack_collector.start()
 
+    def onFocusStackAutofocusButtonClicked(self):
+        if not self.camera_running or not self.grbl:
+            self.cutInfoPlainTextEdit.appendPlainText('autofocus needs camera and grbl')
+            return
+        if self.image_stack_collector.running or self.autofocus.running:
+            return
+        min_z = self.focusStackMinZDoubleSpinBox.value()
+        max_z = self.focusStackMaxZDoubleSpinBox.value()
+        self.autofocus.set_range(min_z, max_z)
+        self.autofocus.set_roi(self.get_autofocus_roi())
+        self.stack_last_seq = self.camera_last_seq
+        if self.autofocus.roi is not None:
+            self.cutInfoPlainTextEdit.appendPlainText(f'autofocus begin, roi = {self.autofocus.roi}')
+        else:
+            self.cutInfoPlainTextEdit.appendPlainText('autofocus begin')
+        self.move_to_z(self.autofocus.start())
+
+    def get_autofocus_roi(self):
+        # The trace region of interest if shown, otherwise the cut path's bounding box 
+        roi = self.get_trace_roi()
+        if roi is None and len(self.px_point_list) > 0 and not self.show_mosaic:
+            x0, y0 = np.min(self.px_point_list, axis=0) - self.AUTOFOCUS_ROI_MARGIN_PX
+            x1, y1 = np.max(self.px_point_list, axis=0) + self.AUTOFOCUS_ROI_MARGIN_PX
+            roi = (int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+        return roi
+
+    def get_trace_roi(self):
+        if self.trace_roi is None:
+            return None
+        x, y = self.trace_roi.pos()
+        w, h = self.trace_roi.size()
+        return tuple(int(round(val)) for val in (x, y, w, h))
+
+    def start_focus_stack_worker(self):
+        self.cancel_focus_stack_worker()
+        task = self.image_stack_collector.focus_and_depth_task()
+        worker = focus_stack_worker.FocusStackWorker(task)
+        worker.signals.progress.connect(self.onFocusStackWorkerProgress)
+        worker.signals.finished.connect(
+                functools.partial(self.onFocusStackWorkerFinished, worker)
+                )
+        worker.signals.failed.connect(
+                functools.partial(self.onFocusStackWorkerFailed, worker)
+                )
+        worker.signals.cancelled.connect(self.onFocusStackWorkerCancelled)
+        self.focus_stack_worker = worker
+        self.thread_pool.start(worker)
+
+    def cancel_focus_stack_worker(self):
+        if self.focus_stack_worker is not None:
+            self.focus_stack_worker.cancel()
+            self.focus_stack_worker = None
+
+    def onFocusStackWorkerProgress(self, num_done, num_total):
+        self.statusbar.showMessage(f'computing focus stack {num_done}/{num_total}')
+
+    def onFocusStackWorkerFinished(self, worker, focus_image, depth_image):
+        if worker is not self.focus_stack_worker or worker.cancelled:
+            return
+        self.focus_stack_worker = None
+        self.image_stack_collector.set_focus_and_depth_images(focus_image, depth_image)
+        self.statusbar.showMessage('focus stack ready')
+        self.cutInfoPlainTextEdit.appendPlainText('focus stack ready')
+
+    def onFocusStackWorkerFailed(self, worker, msg):
+        if worker is not self.focus_stack_worker:
+            return
+        self.focus_stack_worker = None
+        self.statusbar.showMessage('focus stack failed')
+        self.cutInfoPlainTextEdit.appendPlainText(f'focus stack failed: {msg}')
+
+    def onFocusStackWorkerCancelled(self):
+        self.statusbar.showMessage('focus stack cancelled')
+
+    def onPerfTimer(self):
+        self.perf_label.setText(format_perf_summary(perf.monitor.summary()))
+
+    def onExportTraceAction(self):
+        default_path = os.path.join(os.environ['HOME'], self.PERF_TRACE_FILENAME)
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+                self, 
+                'Export performance trace', 
+                default_path, 
+                'Chrome trace (*.json)',
+                )
+        if not filename:
+            return
+        try:
+            perf.monitor.export_chrome_trace(filename)
+        except OSError as err:
+            self.statusbar.showMessage(f'trace export failed: {err}')
+        else:
+            self.statusbar.showMessage(f'trace written to {filename}')
+
+    def onTraceContoursAction(self):
+        if not self.image_stack_collector.ready:
+            self.cutInfoPlainTextEdit.appendPlainText('unable to trace, no focus stack')
+            return
+        self.contour_proposals = self.contour_tracer.trace(
+                self.image_stack_collector.focus_image, 
+                self.image_stack_collector.depth_image,
+                roi=self.get_trace_roi(),
+                )
+        if not self.contour_proposals:
+            self.cutInfoPlainTextEdit.appendPlainText('no contours found')
+            return
+        self.set_traced_contour(0)
+
+    def onNextContourAction(self):
+        if self.contour_proposals:
+            self.set_traced_contour((self.contour_index + 1) % len(self.contour_proposals))
+
+    def set_traced_contour(self, index):
+        """ Replaces the cut points with traced contour index. """
+        self.contour_index = index
+        contour = self.contour_proposals[index]
+        self.px_point_list = [(int(x), int(y)) for x, y in contour['px']]
+        self.z_point_list = [float(z) for z in contour['z']]
+        self.points_changed()
+        if self.calibration.ok:
+            self.mm_point_converter.update(self.px_point_list)
+        num_contours = len(self.contour_proposals)
+        info_msg = f'contour {index + 1}/{num_contours}, {len(self.px_point_list)} points'
+        self.cutInfoPlainTextEdit.appendPlainText(info_msg)
+        if not self.camera_running:
+            self.update_image()
+
+    def onTraceRoiToggled(self, checked):
+        if checked and self.trace_roi is None:
+            if self.current_image is not None:
+                height, width = self.current_image.shape[:2]
+            else:
+                width = camera_capture.CameraCapture.DEFAULT_FRAME_WIDTH
+                height = camera_capture.CameraCapture.DEFAULT_FRAME_HEIGHT
+            self.trace_roi = pg.RectROI(
+                    [width//4, height//4], 
+                    [width//2, height//2], 
+                    pen=pg.mkPen(bgr_to_rgb(self.IMAGE_DEPTH_COLOR), width=2),
+                    )
+            self.cameraView.addItem(self.trace_roi)
+        elif not checked and self.trace_roi is not None:
+            self.cameraView.removeItem(self.trace_roi)
+            self.trace_roi = None
+
+    def onAcquireMosaicAction(self):
+        if not self.camera_running or not self.grbl or not self.calibration.ok:
+            self.cutInfoPlainTextEdit.appendPlainText('mosaic needs camera, grbl and calibration')
+            return
+        busy = self.image_stack_collector.running or self.autofocus.running 
+        if busy or self.mosaic_collector.running:
+            return
+        if self.current_image is None or self.wpos is None:
+            return
+        text, ok = QtWidgets.QInputDialog.getText(
+                self, 
+                'Acquire mosaic', 
+                'Region (width, height) in mm, centered on the current position:', 
+                text=self.MOSAIC_DEFAULT_SIZE,
+                )
+        if not ok:
+            return
+        try:
+            width, height = (float(val) for val in text.split(','))
+        except ValueError:
+            self.cutInfoPlainTextEdit.appendPlainText(f'unable to parse mosaic size {text}')
+            return
+        self.showMosaicAction.setChecked(False)
+        self.showMosaicAction.setEnabled(False)
+        self.mosaic_image = None
+        center = self.wpos['x'], self.wpos['y']
+        try:
+            target = self.mosaic_collector.start(
+                    self.MOSAIC_DIRECTORY,
+                    self.calibration,
+                    self.current_image.shape,
+                    center,
+                    (width, height),
+                    )
+        except (OSError, ValueError) as err:
+            self.cutInfoPlainTextEdit.appendPlainText(f'unable to start mosaic: {err}')
+            return
+        self.mosaic_center = center
+        num_tiles = self.mosaic_collector.num_tiles
+        self.cutInfoPlainTextEdit.appendPlainText(f'mosaic begin, {num_tiles} tiles')
+        self.move_to_xy(*target)
+
+    def stop_mosaic(self):
+        self.mosaic_collector.stop()
+        for worker in self.mosaic_workers.values():
+            worker.cancel()
+        self.mosaic_workers = {}
+        if self.image_stack_collector.running:
+            self.image_stack_collector.stop()
+
+    def start_mosaic_tile_worker(self, index):
+        task = self.image_stack_collector.focus_and_depth_task()
+        worker = focus_stack_worker.FocusStackWorker(task)
+        worker.signals.finished.connect(
+                functools.partial(self.onMosaicWorkerFinished, worker, index)
+                )
+        worker.signals.failed.connect(
+                functools.partial(self.onMosaicWorkerFailed, worker, index)
+                )
+        self.mosaic_workers[index] = worker
+        self.thread_pool.start(worker)
+
+    def onMosaicWorkerFinished(self, worker, index, focus_image, depth_image):
+        if self.mosaic_workers.get(index) is not worker or worker.cancelled:
+            return
+        del self.mosaic_workers[index]
+        collector = self.mosaic_collector
+        with perf.monitor.span('mosaic_add_tile'):
+            done = collector.add_result(index, focus_image, depth_image)
+        self.statusbar.showMessage(f'mosaic {collector.num_added}/{collector.num_tiles} tiles')
+        if done:
+            self.mosaic_image, self.mosaic_scale = collector.mosaic.overview(
+                    self.MOSAIC_DISPLAY_MAX_SIZE
+                    )
+            self.showMosaicAction.setEnabled(True)
+            height, width = collector.mosaic.shape
+            info_msg = f'mosaic done, {width}x{height} px in {collector.mosaic.path}'
+            self.cutInfoPlainTextEdit.appendPlainText(info_msg)
+            self.move_to_xy(*self.mosaic_center)
+
+    def onOpenMosaicAction(self):
+        if not self.calibration.ok:
+            self.cutInfoPlainTextEdit.appendPlainText('opening a mosaic needs calibration')
+            return
+        if self.mosaic_collector.running:
+            return
+        dirname = QtWidgets.QFileDialog.getExistingDirectory(
+                self, 
+                'Open mosaic', 
+                self.MOSAIC_DIRECTORY,
+                )
+        if not dirname:
+            return
+        self.showMosaicAction.setChecked(False)
+        self.showMosaicAction.setEnabled(False)
+        self.mosaic_image = None
+        try:
+            self.mosaic_collector.open(dirname, self.calibration)
+        except (OSError, KeyError, ValueError) as err:
+            self.cutInfoPlainTextEdit.appendPlainText(f'unable to open mosaic: {err}')
+            return
+        mosaic = self.mosaic_collector.mosaic
+        self.mosaic_image, self.mosaic_scale = mosaic.overview(self.MOSAIC_DISPLAY_MAX_SIZE)
+        self.showMosaicAction.setEnabled(True)
+        self.showMosaicAction.setChecked(True)
+        height, width = mosaic.shape
+        self.cutInfoPlainTextEdit.appendPlainText(f'mosaic opened, {width}x{height} px from {dirname}')
+
+    def onMosaicWorkerFailed(self, worker, index, msg):
+        if self.mosaic_workers.get(index) is not worker:
+            return
+        self.stop_mosaic()
+        self.cutInfoPlainTextEdit.appendPlainText(f'mosaic tile {index + 1} failed: {msg}')
+
+    def onRecordStacksToggled(self, checked):
+        collector = self.image_stack_collector
+        if not checked:
+            collector.record_dir = None
+            return
+        dirname = QtWidgets.QFileDialog.getExistingDirectory(
+                self, 
+                'Record focus stacks to', 
+                os.environ['HOME'],
+                )
+        if not dirname:
+            self.recordStacksAction.setChecked(False)
+            return
+        collector.record_dir = dirname
+        self.cutInfoPlainTextEdit.appendPlainText(f'recording focus stacks to {dirname}')
+
+    def onRasterOverlayToggled(self, checked):
+        if checked:
+            self.set_overlay_mode(self.OVERLAY_MODE_RASTER)
+        else:
+            self.set_overlay_mode(self.OVERLAY_MODE_SCENE)
+
+    def onShowMosaicToggled(self, checked):
+        # Mosaic and camera points are in different pixel coordinates
+        self.onClearPointsClicked()
+
     def onImageLeftMouseClick(self, x, y):
-        if self.focusStackShowCheckBox.isChecked() and self.image_stack_collector.ready:
-            z = self.image_stack_collector.depth_image[y,x]
+        if self.show_mosaic:
+            z = float(self.mosaic_collector.mosaic.sample_depth([(x,y)])[0])
+        elif self.focusStackShowCheckBox.isChecked() and self.image_stack_collector.ready:
+            z = float(self.image_stack_collector.sample_depth([(x,y)])[0])
         else:
             if not self.wpos is None:
                 z = self.wpos['z']
@@ -596,21 +1403,25 @@ class AppMainWindow(QtWidgets.QMainWindow):
                 z = 0.0
         self.px_point_list.append((x,y))
         self.z_point_list.append(z)
-        self.calibration.convert_px_to_mm(self.px_point_list)
-        if not self.camera_running:
+        self.points_changed()
+        if self.calibration.ok:
+            self.mm_point_converter.update(self.px_point_list)
+        if not self.camera_running or self.show_mosaic:
             self.update_image()
 
     def onImageRightMouseClick(self, x, y):
         self.px_point_list.pop()
         self.z_point_list.pop()
-        if not self.camera_running:
+        self.points_changed()
+        if not self.camera_running or self.show_mosaic:
             self.update_image()
 
     def onImageMiddleMouseClick(self, x, y):
         if len(self.px_point_list) > 2:
             self.px_point_list.append(self.px_point_list[0])
             self.z_point_list.append(self.z_point_list[0])
-        if not self.camera_running:
+            self.points_changed()
+        if not self.camera_running or self.show_mosaic:
             self.update_image()
 
     def disable_widgets_on_run(self):
@@ -638,6 +1449,32 @@ def app_main():
     mainWindow.showMaximized()
     app.exec_()
 
+def bgr_to_rgb(color):
+    return tuple(reversed(color))
+
+def format_perf_summary(summary):
+    """ Short one line summary of the perf monitor stats for the status bar. """
+    items = []
+    for name, label in (('camera_capture', 'cam'), ('display_frame', 'disp')):
+        stats = summary.get(name)
+        if stats is not None:
+            items.append(f"{label} {stats['rate']:0.0f} fps")
+    stats = summary.get('display_skipped')
+    if stats is not None:
+        items.append(f"skip {stats['rate']:0.0f}/s")
+    for name, label in (('update_image', 'draw'), ('grbl_update', 'grbl')):
+        stats = summary.get(name)
+        if stats is not None:
+            items.append(f"{label} {1000*stats['p50']:0.1f}/{1000*stats['p99']:0.1f} ms")
+    stats = summary.get('grbl_rx_fill')
+    if stats is not None:
+        items.append(f"rx {stats['last']:0.0f}")
+    stats = summary.get('grbl_backlog')
+    if stats is not None:
+        items.append(f"queue {stats['last']:0.0f}")
+    return '  '.join(items)
+
+
 def rm_negative_zero(val):
     return abs(val) if val==0 else val
 
@@ -0,0 +1,218 @@
+"""
+Closed-loop contrast autofocus.
+
+Focus is found by searching over z for the position which maximizes the laplacian sharpness
+(the same measure the FocusStacker uses to pick pixels) within a region of interest. The
+searches are written as generators which yield the next z to measure and are sent back the
+sharpness measured there, so they know nothing about the motion or the camera. Autofocus
+drives a search from the camera timer in the same way as ImageStackCollector: move to the
+target, wait for grbl to report idle at that position, measure a few frames and move on.
+
+"""
+import math
+import time
+import numpy as np
+
+from .focus_stacker import FocusStacker
+
+
+def golden_section_search(min_val, max_val, coarse_num, tolerance):
+    """ Coarse scan of coarse_num points to bracket the peak followed by a golden-section
+    search within the bracket until it is smaller than tolerance. Returns the best z.
+    """
+    inv_phi = (math.sqrt(5.0) - 1.0)/2.0
+    z_coarse = np.linspace(min_val, max_val, max(coarse_num, 2))
+    score_coarse = []
+    for z in z_coarse:
+        score = yield z
+        score_coarse.append(score)
+    index = int(np.argmax(score_coarse))
+    best_z, best_score = z_coarse[index], score_coarse[index]
+    lo = z_coarse[max(index - 1, 0)]
+    hi = z_coarse[min(index + 1, z_coarse.size - 1)]
+
+    c = hi - inv_phi*(hi - lo)
+    d = lo + inv_phi*(hi - lo)
+    score_c = yield c
+    score_d = yield d
+    while True:
+        for z, score in ((c, score_c), (d, score_d)):
+            if score > best_score:
+                best_z, best_score = z, score
+        if hi - lo <= tolerance:
+            break
+        if score_c > score_d:
+            hi, d, score_d = d, c, score_c
+            c = hi - inv_phi*(hi - lo)
+            score_c = yield c
+        else:
+            lo, c, score_c = c, d, score_d
+            d = lo + inv_phi*(hi - lo)
+            score_d = yield d
+    return best_z
+
+
+def coarse_to_fine_search(min_val, max_val, num, tolerance):
+    """ Repeated scans of num points, each one over +/- one step of the best point of the
+    previous scan, until the step is smaller than tolerance. Returns the best z.
+    """
+    lo, hi = min_val, max_val
+    best_z, best_score = None, None
+    while True:
+        z_scan = np.linspace(lo, hi, max(num, 3))
+        for z in z_scan:
+            score = yield z
+            if best_score is None or score > best_score:
+                best_z, best_score = z, score
+        step = z_scan[1] - z_scan[0]
+        if step <= tolerance:
+            break
+        lo = max(best_z - step, min_val)
+        hi = min(best_z + step, max_val)
+    return best_z
+
+
+class Autofocus:
+
+    METHOD_GOLDEN = 'golden'
+    METHOD_COARSE_TO_FINE = 'coarse_to_fine'
+    SEARCH_DICT = {
+            METHOD_GOLDEN         : golden_section_search,
+            METHOD_COARSE_TO_FINE : coarse_to_fine_search,
+            }
+
+    DEFAULT_METHOD = METHOD_GOLDEN
+    DEFAULT_COARSE_NUM = 7
+    DEFAULT_TOLERANCE = 0.002
+    DEFAULT_IMAGES_PER_STEP = 2
+    DEFAULT_SETTLING_TIME = 0.1
+    DEFAULT_POSITION_TOLERANCE = 0.0005
+    DEFAULT_Z_DECIMALS = 3
+    DEFAULT_FOCUS_STACKER_PARAM = {
+            'laplacian_kernel_size'     : 5,
+            'gaussian_blur_kernel_size' : 5,
+            }
+
+    def __init__(self, min_val=-0.05, max_val=0.05, method=DEFAULT_METHOD):
+        self.method = method
+        self.coarse_num = self.DEFAULT_COARSE_NUM
+        self.tolerance = self.DEFAULT_TOLERANCE
+        self.images_per_step = self.DEFAULT_IMAGES_PER_STEP
+        self.settling_time = self.DEFAULT_SETTLING_TIME
+        self.position_tolerance = self.DEFAULT_POSITION_TOLERANCE
+        self.z_decimals = self.DEFAULT_Z_DECIMALS
+        self.focus_stacker = FocusStacker(**self.DEFAULT_FOCUS_STACKER_PARAM)
+        self.roi = None
+        self.set_range(min_val, max_val)
+        self.search = None
+        self.target = None
+        self.t_idle = None
+        self.scores = []
+        self.measured = {}
+        self.best_z = None
+        self.num_moves = 0
+
+    def set_range(self, min_val, max_val):
+        self.min_val = min(min_val, max_val)
+        self.max_val = max(min_val, max_val)
+
+    def set_roi(self, roi):
+        """ Sets the region of interest as (x, y, width, height) in pixels or None for the
+        whole image.
+        """
+        self.roi = roi
+
+    @property
+    def running(self):
+        return self.search is not None
+
+    @property
+    def moving(self):
+        return self.running and self.t_idle is None
+
+    @property
+    def step_complete(self):
+        return len(self.scores) >= self.images_per_step
+
+    @property
+    def images_needed(self):
+        if self.running and not self.moving:
+            return max(self.images_per_step - len(self.scores), 0)
+        else:
+            return 0
+
+    @property
+    def history(self):
+        """ List of (z, sharpness) for every position measured, in z order. """
+        return sorted(self.measured.items())
+
+    def start(self):
+        """ Starts the search and returns the first z to move to. """
+        search_func = self.SEARCH_DICT[self.method]
+        self.search = search_func(self.min_val, self.max_val, self.coarse_num, self.tolerance)
+        self.measured = {}
+        self.best_z = None
+        self.num_moves = 0
+        return self.advance(next(self.search))
+
+    def stop(self):
+        if self.search is not None:
+            self.search.close()
+        self.search = None
+        self.target = None
+        self.t_idle = None
+        self.scores = []
+
+    def update_motion(self, idle, z, now=None):
+        """ Called with each grbl status report. The move to the target is complete once
+        grbl reports idle with z at the target - checking the position as well means a
+        stale idle report from before the move was started isn't mistaken for its end.
+        """
+        if not self.moving or not idle or z is None:
+            return
+        if abs(z - self.target) <= self.position_tolerance:
+            self.t_idle = time.time() if now is None else now
+
+    def settled_at(self, timestamp):
+        if self.moving or not self.running:
+            return False
+        return (timestamp - self.t_idle) > self.settling_time
+
+    def measure(self, image):
+        """ Mean laplacian sharpness of the image within the region of interest. """
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            image_roi = image[max(y,0):y+h, max(x,0):x+w]
+            if image_roi.size:
+                image = image_roi
+        return float(self.focus_stacker.compute_sharpness(image).mean())
+
+    def add_image(self, image, timestamp=None):
+        self.scores.append(self.measure(image))
+
+    def next_step(self):
+        """ Feeds the sharpness at the current target to the search and returns the next
+        z to move to. When the search is finished running becomes False and the best z is
+        returned, so the caller always moves to the returned z.
+        """
+        score = float(np.mean(self.scores))
+        self.measured[self.target] = score
+        while True:
+            try:
+                z = self.search.send(score)
+            except StopIteration as stop:
+                self.best_z = round(float(stop.value), self.z_decimals)
+                self.stop()
+                return self.best_z
+            # Positions which round to one already measured needn't be revisited
+            key = round(float(z), self.z_decimals)
+            if key not in self.measured:
+                return self.advance(z)
+            score = self.measured[key]
+
+    def advance(self, z):
+        self.target = round(float(z), self.z_decimals)
+        self.t_idle = None
+        self.scores = []
+        self.num_moves += 1
+        return self.target
@@ -0,0 +1,326 @@
+"""
+Benchmarks for the image processing hot paths over synthetic focus stacks.
+
+The synthetic specimen is a random texture on a tilted plane. Each z step sees it blurred
+according to the distance from focus, and every frame adds sensor noise. Frames are generated
+on the fly so large cases don't need the whole stack in memory. For each case and stage the
+wall time (best of --repeat runs), peak RSS and the tracemalloc peak/net allocations are
+reported. Results can be saved as JSON and compared against a stored baseline, in which case
+the exit code is non-zero if any stage got slower than the tolerance allows.
+
+Example:
+
+    flaser-benchmark --save baseline.json
+    flaser-benchmark --baseline baseline.json --tolerance 0.25
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import resource
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from .focus_stacker import FocusStacker
+from .frame_reducer import create_reducer
+from .tile_pipeline import TilePipeline
+from .tile_pipeline import clean_depth_image
+from .image_stack_collector import ImageStackCollector
+
+
+RESOLUTIONS = {
+        '720p'  : (1280, 720),
+        '1080p' : (1920, 1080),
+        }
+
+QUICK_CASES = {
+        'resolution'      : ['720p'],
+        'num_steps'       : [10],
+        'frames_per_step' : [20],
+        }
+
+FULL_CASES = {
+        'resolution'      : ['720p', '1080p'],
+        'num_steps'       : [5, 10, 20, 50],
+        'frames_per_step' : [1, 5, 20, 40],
+        }
+
+DEFAULT_TOLERANCE = 0.2
+DEFAULT_REPEAT = 3
+
+
+class SyntheticStack:
+
+    MAX_BLUR_SIGMA = 8.0
+    NOISE_SIGMA = 3.0
+
+    def __init__(self, width, height, num_steps, seed=0):
+        self.width = width
+        self.height = height
+        rng = np.random.default_rng(seed)
+        texture = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        self.texture = cv2.GaussianBlur(texture, (0,0), 1.5)
+        self.depths = np.linspace(-0.05, 0.05, num_steps)
+        x = np.linspace(-1.0, 1.0, width)
+        y = np.linspace(-1.0, 1.0, height)
+        self.true_depth = 0.05*(0.6*x[np.newaxis,:] + 0.3*y[:,np.newaxis])
+        self.rng = rng
+
+    def step_image(self, step):
+        # Blend between sharp and blurred texture based on distance from focus
+        defocus = np.abs(self.true_depth - self.depths[step])/0.1
+        blurred = cv2.GaussianBlur(self.texture, (0,0), self.MAX_BLUR_SIGMA*defocus.max() + 0.1)
+        weight = np.clip(defocus, 0.0, 1.0)[:,:,np.newaxis]
+        image = (1.0 - weight)*self.texture + weight*blurred
+        return image.astype(np.uint8)
+
+    def frames(self, step, num):
+        image = self.step_image(step)
+        for i in range(num):
+            noise = self.rng.normal(0.0, self.NOISE_SIGMA, image.shape)
+            yield np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+# Memory measurement
+# -------------------------------------------------------------------------------------------------
+
+def reset_peak_rss():
+    # Linux only: writing 5 to clear_refs resets the peak RSS (VmHWM)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    """ Returns the peak resident set size in bytes. """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return 1024*int(line.split()[1])
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else 1024*maxrss
+
+
+def measure(func, repeat):
+    """ Runs func (a callable taking no arguments) and returns its timing and memory use. """
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    rss_reset = reset_peak_rss()
+    rss_before = get_peak_rss()
+    tracemalloc.start()
+    func()
+    alloc_net, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+            'time'       : min(times),
+            'time_mean'  : sum(times)/len(times),
+            'peak_rss'   : get_peak_rss() if rss_reset else None,
+            'rss_growth' : get_peak_rss() - rss_before,
+            'alloc_peak' : alloc_peak,
+            'alloc_net'  : alloc_net,
+            }
+
+
+# Stages
+# -------------------------------------------------------------------------------------------------
+
+def get_stages(case, with_gui=False):
+    """ Returns a dict of stage name to a no argument callable for a benchmark case. """
+    width, height = RESOLUTIONS[case['resolution']]
+    num_steps = case['num_steps']
+    frames_per_step = case['frames_per_step']
+    param = ImageStackCollector.DEFAULT_FOCUS_STACKER_PARAM
+    stack = SyntheticStack(width, height, num_steps)
+    step_images = [stack.step_image(i) for i in range(num_steps)]
+    step_frames = list(stack.frames(0, frames_per_step))
+    depths = list(stack.depths)
+    fs = FocusStacker(**param)
+    raw_depth = fs.focus_stack(step_images, depths)[1].copy()
+
+    def step_median():
+        # ImageStackCollector.next_step before streaming reducers
+        np.median(np.array(step_frames), axis=0).astype(np.uint8)
+
+    def step_reducer():
+        reducer = create_reducer(ImageStackCollector.DEFAULT_REDUCER)
+        for image in step_frames:
+            reducer.add(image)
+        reducer.result()
+
+    def compute_laplacian():
+        fs.compute_laplacian(step_images)
+
+    laplacian = fs.compute_laplacian(step_images)
+
+    def find_focus_regions():
+        fs.find_focus_regions(step_images, depths, laplacian)
+
+    def focus_push():
+        stacker = FocusStacker(**param)
+        for image, depth in zip(step_images, depths):
+            stacker.push(image, depth)
+        stacker.result()
+
+    def clean_depth():
+        clean_depth_image(
+                raw_depth,
+                ImageStackCollector.DEFAULT_MEDIAN_FILTER_SIZE,
+                ImageStackCollector.DEFAULT_SGOLAY_WINDOW_SIZE,
+                ImageStackCollector.DEFAULT_SGOLAY_POLY_ORDER,
+                )
+
+    def clean_depth_tiled():
+        pipeline = TilePipeline(
+                param,
+                ImageStackCollector.DEFAULT_MEDIAN_FILTER_SIZE,
+                ImageStackCollector.DEFAULT_SGOLAY_WINDOW_SIZE,
+                ImageStackCollector.DEFAULT_SGOLAY_POLY_ORDER,
+                )
+        pipeline.clean_depth(raw_depth)
+
+    stages = {
+            'step_median'        : step_median,
+            'step_reducer'       : step_reducer,
+            'compute_laplacian'  : compute_laplacian,
+            'find_focus_regions' : find_focus_regions,
+            'focus_push'         : focus_push,
+            'clean_depth'        : clean_depth,
+            'clean_depth_tiled'  : clean_depth_tiled,
+            }
+    if with_gui:
+        stages['update_image'] = get_update_image_stage(step_images[0])
+    return stages
+
+
+def get_update_image_stage(image, num_points=300):
+    """ AppMainWindow.update_image on an offscreen window with num_points cut points. """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets
+    from . import app
+    qt_app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    window = app.AppMainWindow()
+    height, width = image.shape[:2]
+    rng = np.random.default_rng(0)
+    for x, y in zip(rng.integers(0, width, num_points), rng.integers(0, height, num_points)):
+        window.px_point_list.append((int(x), int(y)))
+        window.z_point_list.append(0.0)
+    window.points_changed()
+    window.current_image = image
+
+    def update_image():
+        window.update_image()
+        qt_app.processEvents()
+
+    update_image.window = window
+    return update_image
+
+
+# Running and reporting
+# -------------------------------------------------------------------------------------------------
+
+def get_case_name(case):
+    return f"{case['resolution']}_z{case['num_steps']}_f{case['frames_per_step']}"
+
+
+def run_benchmarks(cases, repeat=DEFAULT_REPEAT, stage_names=None, with_gui=False):
+    results = {}
+    for case in cases:
+        case_name = get_case_name(case)
+        print(case_name)
+        stages = get_stages(case, with_gui=with_gui)
+        for stage_name, func in stages.items():
+            if stage_names and stage_name not in stage_names:
+                continue
+            result = measure(func, repeat)
+            results[f'{case_name}/{stage_name}'] = result
+            peak_mb = result['alloc_peak']/2**20
+            print(f"  {stage_name:20s} {1000*result['time']:10.1f} ms  {peak_mb:10.1f} MB alloc peak")
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """ Returns a list of (name, time, baseline_time) for results slower than the
+    baseline by more than tolerance (fractional).
+    """
+    regressions = []
+    for name, result in results.items():
+        try:
+            baseline_time = baseline[name]['time']
+        except KeyError:
+            continue
+        if result['time'] > (1.0 + tolerance)*baseline_time:
+            regressions.append((name, result['time'], baseline_time))
+    return regressions
+
+
+def benchmark_main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark image processing hot paths')
+    parser.add_argument('--full', action='store_true',
+            help='run the full grid of resolutions, steps and frames per step')
+    parser.add_argument('--resolution', nargs='+', choices=list(RESOLUTIONS), default=None)
+    parser.add_argument('--num-steps', type=int, nargs='+', default=None)
+    parser.add_argument('--frames-per-step', type=int, nargs='+', default=None)
+    parser.add_argument('--stage', nargs='+', default=None, help='only run these stages')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--gui', action='store_true', help='include update_image (needs PyQt5)')
+    parser.add_argument('--save', default=None, help='write results to this json file')
+    parser.add_argument('--baseline', default=None, help='compare against this json file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    grid = dict(FULL_CASES if args.full else QUICK_CASES)
+    for key in grid:
+        if getattr(args, key) is not None:
+            grid[key] = getattr(args, key)
+    cases = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+    results = run_benchmarks(cases, repeat=args.repeat, stage_names=args.stage, with_gui=args.gui)
+
+    if args.save is not None:
+        data = {
+                'machine' : {
+                    'platform'  : platform.platform(),
+                    'processor' : platform.processor(),
+                    'cpu_count' : os.cpu_count(),
+                    'python'    : platform.python_version(),
+                    'numpy'     : np.__version__,
+                    'opencv'    : cv2.__version__,
+                    },
+                'results' : results,
+                }
+        with open(args.save, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    rval = 0
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for name, t, t_base in regressions:
+            print(f'REGRESSION {name}: {1000*t:0.1f} ms vs {1000*t_base:0.1f} ms baseline')
+        if regressions:
+            rval = 1
+        else:
+            print(f'no regressions (tolerance {100*args.tolerance:0.0f}%)')
+    return rval
+
+
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    sys.exit(benchmark_main())
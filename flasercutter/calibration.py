@@ -1,13 +1,17 @@
 import os
+import json
 import pickle
 import cv2
 import numpy as np
 
 class Calibration:
 
+    DEFAULT_RANSAC_THRESHOLD_MM = 0.005
+
     def __init__(self):
         self.data = {}
         self.vals = {}
+        self.version = 0
 
     @property
     def ok(self):
@@ -21,6 +25,8 @@ class Calibration:
     def laser_pos_px(self):
         if self.vals:
             rval = self.vals['cx_laser_px'], self.vals['cy_laser_px']
+            if self.has_distortion:
+                rval = tuple(self.distort_points([rval])[0])
         else:
             rval = None
         return rval
@@ -30,14 +36,23 @@ class Calibration:
         self.calc_vals_from_data()
 
     def calc_vals_from_data(self):
+        self.vals = {}
+        if 'target_points_mm' in self.data:
+            self.calc_vals_from_correspondences()
+        else:
+            self.calc_vals_from_rectangle()
+        self.version += 1
+
+        #print(f'data: {self.data}')
+        #print(f'vals: {self.vals}')
+
+    def calc_vals_from_rectangle(self):
         x_list = [x for x,y in self.data['image_points']]
         y_list = [y for x,y in self.data['image_points']]
         dx_px = max(x_list) - min(x_list)
         dy_px = max(y_list) - min(y_list)
         cx_px = 0.5*(max(x_list) + min(x_list))
         cy_px = 0.5*(max(y_list) + min(y_list))
-        self.vals['cx_laser_px'] = cx_px
-        self.vals['cy_laser_px'] = cy_px
 
         # Get point correspondences 
         w = self.data['target_width_mm']
@@ -60,31 +75,128 @@ class Calibration:
         array_px = np.array(point_list_px)
         array_mm = np.array(point_list_mm)
         homography, mask = cv2.findHomography(array_px, array_mm, 0)
+        self.set_homography(homography, cx_px, cy_px)
+        self.calc_residuals(array_px + np.array([cx_px, cy_px]), array_mm)
+
+    def calc_vals_from_correspondences(self):
+        """ Calibration from any number (>= 4) of image point (px) to stage point (mm) 
+        correspondences, e.g. from a laser burned grid. The stage points are relative to 
+        the laser position. Optional data entries:
+
+            method      'lsq' (default) for a least squares fit over all points or 
+                        'ransac' to reject outliers. 
+            distortion  if True a radial/tangential lens distortion model is fit first
+                        and the homography is fit to the undistorted image points.
+            image_size  (width, height) of the camera image, required for distortion.
+        """
+        array_px = np.asarray(self.data['image_points'], dtype=np.float64).reshape(-1,2)
+        array_mm = np.asarray(self.data['target_points_mm'], dtype=np.float64).reshape(-1,2)
+        if array_px.shape != array_mm.shape:
+            raise ValueError('image_points and target_points_mm must be the same length')
+
+        if self.data.get('distortion', False):
+            self.calc_distortion(array_px, array_mm)
+            array_fit_px = self.undistort_points(array_px)
+        else:
+            array_fit_px = array_px
+
+        method = self.data.get('method', 'lsq')
+        if method == 'ransac':
+            threshold = self.data.get('ransac_threshold_mm', self.DEFAULT_RANSAC_THRESHOLD_MM)
+            homography, mask = cv2.findHomography(array_fit_px, array_mm, cv2.RANSAC, threshold)
+            self.vals['inliers'] = mask.ravel().astype(bool)
+        elif method == 'lsq':
+            homography, mask = cv2.findHomography(array_fit_px, array_mm, 0)
+        else:
+            raise ValueError(f'unknown calibration method {method}')
+        if homography is None:
+            raise RuntimeError('unable to find homography')
+
+        # Laser position is the image of the stage origin
+        cx_px, cy_px = apply_homography(np.linalg.inv(homography), [(0.0, 0.0)])[0]
+        offset_inv = np.array([[1.0, 0.0, cx_px], [0.0, 1.0, cy_px], [0.0, 0.0, 1.0]])
+        self.set_homography(homography @ offset_inv, cx_px, cy_px)
+        self.calc_residuals(array_px, array_mm)
+
+    def calc_distortion(self, array_px, array_mm):
+        # Single view planar camera calibration - only the intrinsics and distortion are kept
+        image_size = tuple(self.data['image_size'])
+        object_points = np.zeros((array_mm.shape[0], 3), dtype=np.float32)
+        object_points[:,:2] = array_mm
+        image_points = array_px.astype(np.float32)
+        rms, camera_matrix, dist_coeffs, rvecs, tvecs = cv2.calibrateCamera(
+                [object_points], 
+                [image_points], 
+                image_size, 
+                None, 
+                None,
+                flags=cv2.CALIB_FIX_ASPECT_RATIO,
+                )
+        self.vals['camera_matrix'] = camera_matrix
+        self.vals['dist_coeffs'] = dist_coeffs
+        self.vals['distortion_rms_px'] = rms
+
+    def set_homography(self, homography, cx_px, cy_px):
+        self.vals['cx_laser_px'] = cx_px
+        self.vals['cy_laser_px'] = cy_px
         self.vals['homography'] = homography
         self.vals['homography_inv'] = np.linalg.inv(homography)
 
-        #print(f'data: {self.data}')
-        #print(f'vals: {self.vals}')
+        # Combined offset + homography matrices for each direction
+        offset = np.array([[1.0, 0.0, -cx_px], [0.0, 1.0, -cy_px], [0.0, 0.0, 1.0]])
+        offset_inv = np.array([[1.0, 0.0, cx_px], [0.0, 1.0, cy_px], [0.0, 0.0, 1.0]])
+        self.vals['px_to_mm'] = homography @ offset
+        self.vals['mm_to_px'] = offset_inv @ self.vals['homography_inv']
+
+    def calc_residuals(self, array_px, array_mm):
+        residuals = np.linalg.norm(self.px_to_mm(array_px) - array_mm, axis=1)
+        self.vals['residuals_mm'] = residuals
+        self.vals['residual_rms_mm'] = float(np.sqrt(np.mean(residuals**2)))
+        self.vals['residual_max_mm'] = float(residuals.max())
+
+    @property
+    def has_distortion(self):
+        return 'camera_matrix' in self.vals
+
+    def undistort_points(self, array_px):
+        """ Removes lens distortion from an (N,2) array of image points. """
+        array_px = np.asarray(array_px, dtype=np.float64).reshape(-1,1,2)
+        camera_matrix = self.vals['camera_matrix']
+        dist_coeffs = self.vals['dist_coeffs']
+        array_px = cv2.undistortPoints(array_px, camera_matrix, dist_coeffs, P=camera_matrix)
+        return np.ascontiguousarray(array_px.reshape(-1,2))
+
+    def distort_points(self, array_px):
+        """ Applies lens distortion to an (N,2) array of undistorted image points. """
+        array_px = np.asarray(array_px, dtype=np.float64).reshape(-1,2)
+        camera_matrix = self.vals['camera_matrix']
+        dist_coeffs = self.vals['dist_coeffs']
+        normalized = apply_homography(np.linalg.inv(camera_matrix), array_px)
+        object_points = np.zeros((normalized.shape[0], 3))
+        object_points[:,:2] = normalized
+        object_points[:,2] = 1.0
+        zero = np.zeros((3,1))
+        array_px, jacobian = cv2.projectPoints(object_points, zero, zero, camera_matrix, dist_coeffs)
+        return np.ascontiguousarray(array_px.reshape(-1,2))
+
+    def px_to_mm(self, array_px):
+        """ Transforms an (N,2) array of image points (px) to stage points (mm). """
+        if self.has_distortion:
+            array_px = self.undistort_points(array_px)
+        return apply_homography(self.vals['px_to_mm'], array_px)
+
+    def mm_to_px(self, array_mm):
+        """ Transforms an (N,2) array of stage points (mm) to image points (px). """
+        array_px = apply_homography(self.vals['mm_to_px'], array_mm)
+        if self.has_distortion:
+            array_px = self.distort_points(array_px)
+        return array_px
 
     def convert_px_to_mm(self, points_px):
-        cx = self.vals['cx_laser_px']
-        cy = self.vals['cy_laser_px']
-        homography = self.vals['homography']
-        array_px = np.array(points_px,dtype=np.float) - np.array([cx,cy])
-        array_mm = cv2.perspectiveTransform(array_px.reshape(-1,1,2),homography)
-        array_mm = array_mm.reshape(-1,2)
-        points_mm = array_mm.tolist() 
-        return points_mm
+        return self.px_to_mm(points_px).tolist()
 
     def convert_mm_to_px(self, points_mm):
-        cx = self.vals['cx_laser_px']
-        cy = self.vals['cy_laser_px']
-        homography_inv = self.vals['homography_inv']
-        array_mm = np.array(points_mm,dtype=np.float)
-        array_px = cv2.perspectiveTransform(array_mm.reshape(-1,1,2),homography)
-        array_px = array_px.reshape(-1,2) + np.array([cx,cy])
-        points_px = array_px.tolist()
-        return points_px
+        return self.mm_to_px(points_mm).tolist()
 
     def load(self, filename):
         try:
@@ -110,5 +222,69 @@ class Calibration:
         return rval, msg
 
 
+class PointConverter:
+
+    """ Keeps the transformed version of a point list so that only points which are 
+    new or have changed are converted. The points converted last are kept and compared
+    against, so everything from the first changed point on is reconverted. Everything 
+    is reconverted if the calibration changes. 
+
+    direction is either 'px_to_mm' or 'mm_to_px'.
+    """
+
+    def __init__(self, calibration, direction='px_to_mm'):
+        self.calibration = calibration
+        self.direction = direction
+        self.clear()
+
+    def clear(self):
+        self.points = np.zeros((0,2))
+        self.array = np.zeros((0,2))
+        self.version = None
+
+    def update(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1,2)
+        if self.version != self.calibration.version:
+            self.clear()
+            self.version = self.calibration.version
+        num_same = min(points.shape[0], self.points.shape[0])
+        mismatch = np.flatnonzero((points[:num_same] != self.points[:num_same]).any(axis=1))
+        if mismatch.size:
+            num_same = int(mismatch[0])
+        self.array = self.array[:num_same]
+        if points.shape[0] > num_same:
+            transform = getattr(self.calibration, self.direction)
+            new_array = transform(points[num_same:])
+            self.array = np.concatenate((self.array, new_array))
+        self.points = points.copy()
+        return self.array
+
+
+def load_correspondences(filename):
+    """ Loads correspondence calibration data from a json file with a list of 
+    target_points_mm and, optionally, the matching image_points and the method, 
+    distortion, image_size and ransac_threshold_mm entries used by
+    Calibration.calc_vals_from_correspondences. When image_points is missing the 
+    caller supplies them, e.g. from points picked on the camera image in the same order. 
+    """
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or 'target_points_mm' not in data:
+        raise ValueError('correspondence file has no target_points_mm')
+    array_mm = np.asarray(data['target_points_mm'], dtype=np.float64)
+    if array_mm.ndim != 2 or array_mm.shape[1] != 2:
+        raise ValueError('target_points_mm must be a list of (x,y) points')
+    if 'image_points' in data:
+        array_px = np.asarray(data['image_points'], dtype=np.float64)
+        if array_px.shape != array_mm.shape:
+            raise ValueError('image_points and target_points_mm must be the same length')
+    return data
 
 
+def apply_homography(matrix, points):
+    """ Applies a 3x3 homography to an (N,2) array (or list) of points and returns a
+    contiguous (N,2) float64 array. 
+    """
+    array = np.asarray(points, dtype=np.float64).reshape(-1,2)
+    array_h = array @ matrix[:,:2].T + matrix[:,2]
+    return np.ascontiguousarray(array_h[:,:2]/array_h[:,2:])
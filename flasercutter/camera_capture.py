@@ -1,5 +1,80 @@
 import cv2
+import time
 import pathlib
+import threading
+import collections
+import numpy as np
+
+from . import perf
+
+
+Frame = collections.namedtuple('Frame', ['seq', 'timestamp', 'image'])
+
+
+class FrameRingBuffer:
+
+    """ Fixed size ring of preallocated frame buffers. A single writer (the capture
+    thread) fills the slots in order and publishes each one by advancing the write
+    count. Readers never block the writer - they copy a slot out and then check that
+    the writer has not lapped them while they were copying.
+    """
+
+    def __init__(self, size, shape, dtype=np.uint8):
+        self.size = size
+        self.frames = np.zeros((size,) + tuple(shape), dtype=dtype)
+        self.timestamps = np.zeros((size,))
+        self.count = 0
+
+    @property
+    def shape(self):
+        return self.frames.shape[1:]
+
+    @property
+    def last_seq(self):
+        return self.count - 1
+
+    def write_slot(self):
+        return self.frames[self.count % self.size]
+
+    def publish(self, timestamp):
+        self.timestamps[self.count % self.size] = timestamp
+        self.count += 1
+
+    def get(self, seq):
+        """ Returns a copy of frame seq or None if it has been overwritten. """
+        if seq < 0 or seq >= self.count or self.count - seq > self.size - 1:
+            return None
+        index = seq % self.size
+        image = self.frames[index].copy()
+        timestamp = self.timestamps[index]
+        if self.count - seq > self.size - 1:
+            # Writer lapped us while copying
+            return None
+        return Frame(seq, timestamp, image)
+
+    def latest(self, after_seq=-1):
+        """ Returns the newest frame if it is newer than after_seq, else None. """
+        while True:
+            seq = self.last_seq
+            if seq <= after_seq:
+                return None
+            frame = self.get(seq)
+            if frame is not None:
+                return frame
+
+    def next_frames(self, after_seq=-1, num=1):
+        """ Returns up to num frames following after_seq, oldest first. Frames that
+        have already been overwritten are skipped.
+        """
+        frame_list = []
+        seq = max(after_seq + 1, self.count - (self.size - 1))
+        while len(frame_list) < num and seq <= self.last_seq:
+            frame = self.get(seq)
+            if frame is not None:
+                frame_list.append(frame)
+            seq += 1
+        return frame_list
+
 
 class CameraCapture(cv2.VideoCapture):
 
@@ -12,10 +87,17 @@ class CameraCapture(cv2.VideoCapture):
 
     DEFAULT_FRAME_WIDTH = 1280
     DEFAULT_FRAME_HEIGHT = 720
-    DEFAULT_EXPOSURE = 300 
-    DEFAULT_AUTO_EXPOSURE = AUTO_EXPOSURE_OFF 
-    
+    DEFAULT_EXPOSURE = 300
+    DEFAULT_AUTO_EXPOSURE = AUTO_EXPOSURE_OFF
+
+    DEFAULT_RING_SIZE = 8
+    GRAB_RETRY_SLEEP = 0.005
+
     def __init__(self, dev):
+        self.device_lock = threading.Lock()
+        self.ring = None
+        self.thread = None
+        self.thread_stop_event = threading.Event()
         super().__init__(dev)
         if not self.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc(*'MJPG')):
             raise RuntimeError('unable to set fourcc to mjpg')
@@ -28,6 +110,15 @@ class CameraCapture(cv2.VideoCapture):
         if not self.set_exposure(self.DEFAULT_EXPOSURE):
             raise RuntimeError('unable to set auto exposure')
 
+    @property
+    def threaded(self):
+        return self.thread is not None
+
+    def set(self, prop, value):
+        with self.device_lock:
+            rval = super().set(prop, value)
+        return rval
+
     def set_auto_exposure(self,value):
         if not bool(value):
             raise ValueError('exposure value must be bool')
@@ -42,6 +133,59 @@ class CameraCapture(cv2.VideoCapture):
         rval = self.set(cv2.CAP_PROP_EXPOSURE, value_clamped)
         return rval
 
+    def start_thread(self, ring_size=DEFAULT_RING_SIZE):
+        if self.threaded:
+            return
+        width = int(self.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.ring = FrameRingBuffer(ring_size, (height, width, 3))
+        self.thread_stop_event.clear()
+        self.thread = threading.Thread(target=self.capture_loop, daemon=True)
+        self.thread.start()
+
+    def stop_thread(self):
+        if not self.threaded:
+            return
+        self.thread_stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def capture_loop(self):
+        while not self.thread_stop_event.is_set():
+            with self.device_lock:
+                ok = self.grab()
+                timestamp = time.time()
+                if ok:
+                    buf = self.ring.write_slot()
+                    ok, image = self.retrieve(buf)
+            if not ok:
+                time.sleep(self.GRAB_RETRY_SLEEP)
+                continue
+            if image.shape != self.ring.shape:
+                # Frame size changed under us - reallocate ring and drop this frame
+                self.ring = FrameRingBuffer(self.ring.size, image.shape, image.dtype)
+                continue
+            if image is not buf:
+                buf[...] = image
+            self.ring.publish(timestamp)
+            perf.monitor.count('camera_capture')
+
+    def read_latest(self, after_seq=-1):
+        """ Returns the newest captured Frame newer than after_seq or None. """
+        if not self.threaded:
+            raise RuntimeError('capture thread not running')
+        return self.ring.latest(after_seq)
+
+    def read_next(self, after_seq=-1, num=1):
+        """ Returns up to num captured Frames following after_seq, oldest first. """
+        if not self.threaded:
+            raise RuntimeError('capture thread not running')
+        return self.ring.next_frames(after_seq, num)
+
+    def release(self):
+        self.stop_thread()
+        super().release()
+
     @staticmethod
     def get_devices():
         path = pathlib.Path('/dev')
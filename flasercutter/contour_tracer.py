@@ -0,0 +1,122 @@
+"""
+Proposes closed cut contours from the focus stacked image.
+
+The focus image is thresholded (Otsu, or adaptive for uneven lighting) or edge detected
+(Canny) inside an optional region of interest, cleaned up morphologically and its outer
+contours found with cv2.findContours. Each contour is simplified with approxPolyDP and z
+for every vertex is sampled from the depth image. Everything is whole-image OpenCV/numpy
+so a full resolution frame takes a few tens of milliseconds.
+
+"""
+import cv2
+import numpy as np
+
+
+class ContourTracer:
+
+    METHOD_OTSU = 'otsu'
+    METHOD_ADAPTIVE = 'adaptive'
+    METHOD_CANNY = 'canny'
+    METHOD_LIST = [METHOD_OTSU, METHOD_ADAPTIVE, METHOD_CANNY]
+
+    DEFAULT_METHOD = METHOD_OTSU
+    DEFAULT_BLUR_KERNEL_SIZE = 5
+    DEFAULT_INVERT = False
+    DEFAULT_ADAPTIVE_BLOCK_SIZE = 51
+    DEFAULT_ADAPTIVE_C = 5
+    DEFAULT_CANNY_THRESHOLDS = (50, 150)
+    DEFAULT_MORPH_KERNEL_SIZE = 5
+    DEFAULT_MIN_AREA = 500.0
+    DEFAULT_EPSILON = 1.5
+    DEFAULT_MAX_CONTOURS = 10
+    DEFAULT_EXCLUDE_BORDER = True
+
+    def __init__(self, method=DEFAULT_METHOD):
+        if method not in self.METHOD_LIST:
+            raise ValueError(f'unknown method {method}')
+        self.method = method
+        self.blur_kernel_size = self.DEFAULT_BLUR_KERNEL_SIZE
+        self.invert = self.DEFAULT_INVERT
+        self.adaptive_block_size = self.DEFAULT_ADAPTIVE_BLOCK_SIZE
+        self.adaptive_c = self.DEFAULT_ADAPTIVE_C
+        self.canny_thresholds = self.DEFAULT_CANNY_THRESHOLDS
+        self.morph_kernel_size = self.DEFAULT_MORPH_KERNEL_SIZE
+        self.min_area = self.DEFAULT_MIN_AREA
+        self.epsilon = self.DEFAULT_EPSILON
+        self.max_contours = self.DEFAULT_MAX_CONTOURS
+        self.exclude_border = self.DEFAULT_EXCLUDE_BORDER
+
+    def segment(self, image):
+        """ Returns the binary (0/255) foreground mask of an image. """
+        if image.ndim == 3:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = image
+        if gray.dtype != np.uint8:
+            gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+        if self.blur_kernel_size > 1:
+            size = self.blur_kernel_size
+            gray = cv2.GaussianBlur(gray, (size, size), 0)
+        threshold_type = cv2.THRESH_BINARY_INV if self.invert else cv2.THRESH_BINARY
+        if self.method == self.METHOD_OTSU:
+            _, mask = cv2.threshold(gray, 0, 255, threshold_type | cv2.THRESH_OTSU)
+        elif self.method == self.METHOD_ADAPTIVE:
+            mask = cv2.adaptiveThreshold(
+                    gray,
+                    255,
+                    cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                    threshold_type,
+                    self.adaptive_block_size,
+                    self.adaptive_c,
+                    )
+        else:
+            mask = cv2.Canny(gray, *self.canny_thresholds)
+        if self.morph_kernel_size > 1:
+            size = self.morph_kernel_size
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+            if self.method != self.METHOD_CANNY:
+                mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+        return mask
+
+    def trace(self, focus_image, depth_image=None, roi=None):
+        """ Returns a list of proposed contours, largest first. Each is a dict with the
+        closed vertex list 'px' ((n,2) int array, last vertex equal to the first), 'z'
+        ((n,) array sampled from depth_image, or None) and 'area' in pixels. roi is an
+        optional (x, y, width, height) in pixels restricting the search. With 
+        exclude_border set contours touching the edge of the search area are dropped.
+        """
+        height, width = focus_image.shape[:2]
+        x0, y0, x1, y1 = 0, 0, width, height
+        if roi is not None:
+            x, y, w, h = (int(round(val)) for val in roi)
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + w, width), min(y + h, height)
+            if x1 <= x0 or y1 <= y0:
+                return []
+        mask = self.segment(focus_image[y0:y1, x0:x1])
+        contours, _ = cv2.findContours(
+                mask,
+                cv2.RETR_EXTERNAL,
+                cv2.CHAIN_APPROX_SIMPLE,
+                offset=(x0, y0),
+                )
+        areas = np.array([cv2.contourArea(c) for c in contours])
+        if self.exclude_border and contours:
+            # Contours cut off by the edge of the search area aren't the object's outline
+            rects = np.array([cv2.boundingRect(c) for c in contours])
+            on_border = (rects[:,0] <= x0) | (rects[:,1] <= y0)
+            on_border |= (rects[:,0] + rects[:,2] >= x1) | (rects[:,1] + rects[:,3] >= y1)
+            areas[on_border] = 0.0
+        order = [i for i in np.argsort(-areas) if areas[i] >= self.min_area]
+        proposals = []
+        for i in order[:self.max_contours]:
+            px = cv2.approxPolyDP(contours[i], self.epsilon, True).reshape(-1, 2)
+            if len(px) < 3:
+                continue
+            px = np.vstack([px, px[:1]])
+            z = None
+            if depth_image is not None:
+                z = depth_image[px[:,1], px[:,0]]
+            proposals.append({'px': px, 'z': z, 'area': float(areas[i])})
+        return proposals
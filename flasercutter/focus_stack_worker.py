@@ -0,0 +1,50 @@
+import threading
+import traceback
+import concurrent.futures
+from PyQt5 import QtCore
+
+
+class FocusStackWorkerSignals(QtCore.QObject):
+
+    progress = QtCore.pyqtSignal(int, int)
+    finished = QtCore.pyqtSignal(object, object)
+    failed = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
+
+
+class FocusStackWorker(QtCore.QRunnable):
+
+    """ Runs a focus and depth image task from ImageStackCollector.focus_and_depth_task
+    on a QThreadPool thread. Results are delivered through the signals, which are
+    queued to the GUI thread, so the images can be swapped in there in one step.
+    """
+
+    def __init__(self, task):
+        super().__init__()
+        self.task = task
+        self.signals = FocusStackWorkerSignals()
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        try:
+            focus_image, depth_image = self.task(
+                    progress_callback=self.signals.progress.emit,
+                    cancel_event=self.cancel_event,
+                    )
+        except concurrent.futures.CancelledError:
+            self.signals.cancelled.emit()
+        except Exception as err:
+            traceback.print_exc()
+            self.signals.failed.emit(str(err))
+        else:
+            if self.cancelled:
+                self.signals.cancelled.emit()
+            else:
+                self.signals.finished.emit(focus_image, depth_image)
@@ -21,7 +21,7 @@ https://github.com/momonala/focus-stack
 """
 
 import logging
-from typing import List
+from typing import List, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -42,12 +42,85 @@ class FocusStacker(object):
         """
         self._laplacian_kernel_size = laplacian_kernel_size
         self._gaussian_blur_kernel_size = gaussian_blur_kernel_size
-
-    def focus_stack(self, images: List[np.ndarray], depths: List[float]) -> np.ndarray:
+        self.reset()
+
+    def reset(self) -> None:
+        """Clear the state of the incremental focus stack."""
+        self._count = 0
+        self._best_sharpness = None
+        self._index_image = None
+        self._focus_image = None
+        self._depths = []
+
+    @property
+    def count(self) -> int:
+        """Number of images pushed into the incremental focus stack."""
+        return self._count
+
+    @property
+    def index_image(self) -> Optional[np.ndarray]:
+        """Index of the sharpest image for each pixel of the incremental focus stack."""
+        return self._index_image
+
+    def focus_stack(self, images: List[np.ndarray], depths: List[float]) -> Tuple[np.ndarray, np.ndarray]:
         """Pipeline to focus stack a list of images."""
-        laplacian = self.compute_laplacian(images)
-        focus_stacked = self.find_focus_regions(images, depths, laplacian)
-        return focus_stacked
+        self.reset()
+        for image, depth in zip(images, depths):
+            self.push(image, depth)
+        return self.result()
+
+    def push(self, image: np.ndarray, depth: float) -> None:
+        """Fold one image of the stack into the running focus and depth images. 
+
+        Only the running best sharpness, the index of the sharpest image, the focus
+        image and the depth image are kept, so memory is O(H x W) regardless of the
+        number of images in the stack. Ties go to the later image, which matches
+        find_focus_regions.
+
+        Args:
+            image:  image data 
+            depth:  depth at which the image was acquired
+        """
+        sharpness = self.compute_sharpness(image)
+        if self._count == 0:
+            self._best_sharpness = sharpness
+            self._index_image = np.zeros(sharpness.shape, dtype=np.int32)
+            self._focus_image = image.copy()
+        else:
+            # cv2 masked copies are much faster than numpy's for scattered masks
+            mask = cv2.compare(sharpness, self._best_sharpness, cv2.CMP_GE)
+            np.maximum(self._best_sharpness, sharpness, out=self._best_sharpness)
+            index = np.full(sharpness.shape, self._count, dtype=np.int32)
+            cv2.copyTo(index, mask, self._index_image)
+            cv2.copyTo(image, mask, self._focus_image)
+        self._depths.append(depth)
+        self._count += 1
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the focus and depth images of the incremental focus stack."""
+        if self._count == 0:
+            raise RuntimeError('no images have been pushed')
+        depth_array = np.asarray(self._depths)
+        depth_image = depth_array[self._index_image]
+        return self._focus_image, depth_image
+
+    def compute_sharpness(self, image: np.ndarray) -> np.ndarray:
+        """Absolute value of the laplacian of the blurred image. This is the proxy for 
+        focus used to select pixels. 
+
+        Args:
+            image: image data
+        """
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        blurred = cv2.GaussianBlur(
+            gray,
+            (self._gaussian_blur_kernel_size, self._gaussian_blur_kernel_size),
+            0,
+        )
+        laplacian_gradient = cv2.Laplacian(
+            blurred, cv2.CV_64F, ksize=self._laplacian_kernel_size
+        )
+        return np.absolute(laplacian_gradient, out=laplacian_gradient)
 
 
     def compute_laplacian(self, images: List[np.ndarray],) -> np.ndarray:
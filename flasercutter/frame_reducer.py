@@ -0,0 +1,174 @@
+import numpy as np
+
+
+class FrameReducer:
+
+    """ Base class for streaming per-step frame reducers. Frames are folded in one at
+    a time with add() and the reduced uint8 image is available from result() at any
+    point. Memory use is a fixed number of frame sized buffers.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, image):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def to_uint8(array):
+        return np.clip(np.rint(array), 0, 255).astype(np.uint8)
+
+
+class MeanReducer(FrameReducer):
+
+    """ Running mean. """
+
+    def __init__(self):
+        super().__init__()
+        self.sum = None
+
+    def add(self, image):
+        if self.sum is None:
+            self.sum = np.zeros(image.shape, dtype=np.float64)
+        self.sum += image
+        self.count += 1
+
+    def result(self):
+        if not self.count:
+            return None
+        return self.to_uint8(self.sum/self.count)
+
+
+class WelfordReducer(FrameReducer):
+
+    """ Running mean and variance using Welford's algorithm. """
+
+    def __init__(self):
+        super().__init__()
+        self.mean = None
+        self.m2 = None
+        self.delta = None
+
+    def add(self, image):
+        if self.mean is None:
+            self.mean = np.zeros(image.shape, dtype=np.float64)
+            self.m2 = np.zeros(image.shape, dtype=np.float64)
+            self.delta = np.zeros(image.shape, dtype=np.float64)
+        self.count += 1
+        np.subtract(image, self.mean, out=self.delta)
+        self.mean += self.delta/self.count
+        # m2 += delta*(image - mean), reusing the delta buffer for the product
+        self.delta *= image - self.mean
+        self.m2 += self.delta
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return None
+        return self.m2/(self.count - 1)
+
+    @property
+    def std(self):
+        variance = self.variance
+        if variance is None:
+            return None
+        return np.sqrt(variance)
+
+    def result(self):
+        if not self.count:
+            return None
+        return self.to_uint8(self.mean)
+
+
+class SigmaClippedMeanReducer(WelfordReducer):
+
+    """ Streaming sigma clipped mean. Pixels further than num_sigma standard
+    deviations from the running mean are left out of the clipped mean. Every frame
+    is accepted until min_count frames (and at least two, for the standard deviation)
+    have been seen so that the running statistics have settled.
+    """
+
+    def __init__(self, num_sigma=2.0, min_count=5):
+        super().__init__()
+        self.num_sigma = num_sigma
+        self.min_count = min_count
+        self.clipped_sum = None
+        self.clipped_count = None
+
+    def add(self, image):
+        if self.clipped_sum is None:
+            self.clipped_sum = np.zeros(image.shape, dtype=np.float64)
+            self.clipped_count = np.zeros(image.shape, dtype=np.uint32)
+        std = self.std
+        if std is not None and self.count >= self.min_count:
+            keep = np.abs(image - self.mean) <= self.num_sigma*std
+            self.clipped_sum += np.where(keep, image, 0)
+            self.clipped_count += keep
+        else:
+            self.clipped_sum += image
+            self.clipped_count += 1
+        super().add(image)
+
+    def result(self):
+        if not self.count:
+            return None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            clipped_mean = self.clipped_sum/self.clipped_count
+        clipped_mean = np.where(self.clipped_count > 0, clipped_mean, self.mean)
+        return self.to_uint8(clipped_mean)
+
+
+class RemedianReducer(FrameReducer):
+
+    """ Approximate median in bounded memory using the remedian. Frames are held in a
+    buffer of size base; when it fills its median is pushed up to the next level and
+    the buffer is cleared. Memory is base*levels frames for up to base**levels frames.
+    """
+
+    def __init__(self, base=5):
+        super().__init__()
+        self.base = base
+        self.levels = []
+
+    def add(self, image):
+        self.count += 1
+        self.push(0, image)
+
+    def push(self, level, image):
+        if level == len(self.levels):
+            self.levels.append([])
+        buf = self.levels[level]
+        buf.append(image)
+        if len(buf) >= self.base:
+            image_median = np.median(np.array(buf), axis=0).astype(np.uint8)
+            self.levels[level] = []
+            self.push(level + 1, image_median)
+
+    def result(self):
+        if not self.count:
+            return None
+        carry = None
+        for buf in self.levels:
+            image_list = buf if carry is None else buf + [carry]
+            if image_list:
+                carry = np.median(np.array(image_list), axis=0).astype(np.uint8)
+        return carry
+
+
+REDUCER_DICT = {
+        'mean'         : MeanReducer,
+        'welford'      : WelfordReducer,
+        'sigma_clip'   : SigmaClippedMeanReducer,
+        'median'       : RemedianReducer,
+        }
+
+
+def create_reducer(name, **kwargs):
+    try:
+        reducer_class = REDUCER_DICT[name]
+    except KeyError:
+        raise ValueError(f'unknown reducer {name}')
+    return reducer_class(**kwargs)
@@ -1,32 +1,195 @@
+import os
+import re
+import time
+import threading
+import collections
 import grbl_comm
 
+from . import perf
+
+
+GCODE_COMMENT_RE = re.compile(r'\(.*?\)|;.*')
+
+
+def clean_gcode_line(line):
+    """ Strips comments and all whitespace (grbl ignores it) from a line of G-code. """
+    line = GCODE_COMMENT_RE.sub('', line)
+    line = ''.join(line.split())
+    if line == '%':
+        return ''
+    return line
+
+
+def find_long_line(lines, max_line_length):
+    """ Returns (line number, length) of the first line which is too long to fit in 
+    grbl's rx buffer once cleaned, or None if there isn't one. 
+    """
+    for num, line in enumerate(lines, 1):
+        cmd = clean_gcode_line(line)
+        if cmd and len(cmd) + 1 >= max_line_length:
+            return num, len(cmd) + 1
+    return None
+
+
+class GcodeStream:
+
+    """ Lazily reads G-code from a file or an iterable of lines. At most lookahead 
+    cleaned lines are held in memory so the size of the job doesn't matter. 
+
+    Files are checked for lines too long to fit in grbl's rx buffer before anything is 
+    sent (ValueError is raised). An iterable can only be checked as it is read, so 
+    reading stops with error set at the first such line and the lines not yet sent are
+    replaced by a safe stop (laser off). 
+    """
+
+    DEFAULT_LOOKAHEAD = 256
+    SAFE_STOP_CMD = 'M5\n'
+
+    def __init__(self, source, max_line_length, lookahead=DEFAULT_LOOKAHEAD):
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'r') as f:
+                long_line = find_long_line(f, max_line_length)
+            if long_line is not None:
+                num, length = long_line
+                raise ValueError(f'line {num} is too long ({length} characters)')
+            self.name = os.fspath(source)
+            self.file = open(source, 'r')
+            self.total_bytes = os.path.getsize(source)
+            self.lines = iter(self.file)
+        else:
+            self.name = None
+            self.file = None
+            self.total_bytes = None
+            self.lines = iter(source)
+        self.max_line_length = max_line_length
+        self.lookahead = lookahead
+        self.buffer = collections.deque()
+        self.exhausted = False
+        self.error = None
+        self.lines_read = 0
+        self.bytes_read = 0
+        self.lines_sent = 0
+        self.bytes_sent = 0
+
+    @property
+    def done(self):
+        return self.exhausted and not self.buffer
+
+    @property
+    def progress(self):
+        return {
+                'lines_read'  : self.lines_read,
+                'bytes_read'  : self.bytes_read,
+                'lines_sent'  : self.lines_sent,
+                'bytes_sent'  : self.bytes_sent,
+                'total_bytes' : self.total_bytes,
+                'done'        : self.done,
+                'error'       : self.error,
+                }
+
+    def fill(self):
+        while not self.exhausted and len(self.buffer) < self.lookahead:
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                self.close()
+                break
+            self.lines_read += 1
+            self.bytes_read += len(line)
+            cmd = clean_gcode_line(line)
+            if not cmd:
+                continue
+            cmd = f'{cmd}\n'
+            if len(cmd) >= self.max_line_length:
+                self.error = f'line {self.lines_read} is too long ({len(cmd)} characters)'
+                self.cancel()
+                self.buffer.append(self.SAFE_STOP_CMD)
+                break
+            self.buffer.append(cmd)
+
+    def pop(self):
+        cmd = self.buffer.popleft()
+        self.lines_sent += 1
+        self.bytes_sent += len(cmd)
+        return cmd
+
+    def cancel(self):
+        self.buffer.clear()
+        self.close()
+
+    def close(self):
+        self.exhausted = True
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 class GrblSender(grbl_comm.GrblComm):
 
-    def __init__(self, port='/dev/ttyACM0', baudrate=115200, timeout=None):
-        super().__init__(port=port, baudrate=baudrate, timeout=timeout)
-        self.cmd_to_send = []
-        self.cmd_in_buff = []
-        self.char_counts = []
+    DEFAULT_THREAD_PERIOD = 0.002
+    DEFAULT_STATUS_PERIOD = 0.2
+
+    def __init__(self, port='/dev/ttyACM0', baudrate=115200, timeout=None, serial_port=None):
+        """ serial_port is an open port-like object (write, readline, in_waiting and 
+        close), e.g. grbl_simulator.SimulatedSerial, which is used in place of opening 
+        the device at port. 
+        """
+        self.serial_port = serial_port
+        if serial_port is None:
+            super().__init__(port=port, baudrate=baudrate, timeout=timeout)
+        self.cmd_to_send = collections.deque()
+        self.cmd_in_buff = collections.deque()
+        self.buff_char_count = 0
         self.debug = False
+        self.io_lock = threading.RLock()
+        self.thread = None
+        self.thread_stop_event = threading.Event()
+        self.thread_wake_event = threading.Event()
+        self.status_callback = None
+        self.response_callback = None
+        self.status_period = self.DEFAULT_STATUS_PERIOD
+        self.stream = None
+
+    @property
+    def threaded(self):
+        return getattr(self, 'thread', None) is not None
 
     @property
     def sending(self):
-        return self.cmd_to_send or self.cmd_in_buff
-        
+        streaming = self.stream is not None and not self.stream.done
+        return bool(self.cmd_to_send or self.cmd_in_buff or streaming)
+
     def append_cmd(self,cmd):
         self.cmd_to_send.append(f'{cmd}\n')
+        self.thread_wake_event.set()
 
     def extend_cmd(self, cmd_list):
         for cmd in cmd_list:
             self.append_cmd(cmd)
 
+    def stream_gcode(self, source, lookahead=GcodeStream.DEFAULT_LOOKAHEAD):
+        """ Streams G-code from a file name or an iterable of lines, reading it lazily as 
+        grbl's rx buffer empties. Commands queued with append_cmd are sent ahead of the 
+        stream's lines. Returns the GcodeStream, whose progress gives the lines and bytes
+        sent so far. Raises ValueError if a file has a line too long to send.
+        """
+        with self.io_lock:
+            if self.stream is not None and not self.stream.done:
+                raise RuntimeError('already streaming')
+            self.stream = GcodeStream(source, self.RX_BUFFER_SIZE, lookahead)
+        self.thread_wake_event.set()
+        return self.stream
+
     def soft_stop(self):
-        self.feedhold()
-        self.reset()
-        self.kill_alarm_lock()
-        self.cmd_to_send = []
-        self.cmd_in_buff = []
-        self.char_counts = []
+        with self.io_lock:
+            self.feedhold()
+            self.reset()
+            self.kill_alarm_lock()
+            self.cmd_to_send.clear()
+            self.cmd_in_buff.clear()
+            self.buff_char_count = 0
+            if self.stream is not None:
+                self.stream.cancel()
 
     def set_zero(self):
         self.append_cmd(f'G10P1L20 X0 Y0 Z0')
@@ -37,42 +200,132 @@ class GrblSender(grbl_comm.GrblComm):
         self.append_cmd(f'G10P1L2 X0 Y0 Z0')
         self.append_cmd(f'G54')
 
-    def update(self, query_status=False): 
-        rval = {} 
-        if self.debug: 
+    def start_thread(self, status_callback=None, response_callback=None, 
+            status_period=DEFAULT_STATUS_PERIOD):
+        """ Hands the serial port to a background thread which keeps grbl's rx buffer 
+        full and polls for status. Status reports are passed to status_callback(status) 
+        and ok/error acknowledgements to response_callback(line, cmd), both called from 
+        the background thread. Commands are queued with append_cmd/extend_cmd as usual.
+        """
+        if self.threaded:
+            return
+        self.status_callback = status_callback
+        self.response_callback = response_callback
+        self.status_period = status_period
+        self.thread_stop_event.clear()
+        self.thread = threading.Thread(target=self.thread_loop, daemon=True)
+        self.thread.start()
+
+    def stop_thread(self):
+        if not self.threaded:
+            return
+        self.thread_stop_event.set()
+        self.thread_wake_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def thread_loop(self):
+        last_status = 0.0
+        while not self.thread_stop_event.is_set():
+            now = time.time()
+            query_status = (now - last_status) > self.status_period
+            if query_status:
+                last_status = now
+            rval = self.update(query_status=query_status)
+            if 'status' in rval and self.status_callback is not None:
+                self.status_callback(rval['status'])
+            if self.response_callback is not None:
+                for line, cmd in rval.get('responses', []):
+                    self.response_callback(line, cmd)
+            self.thread_wake_event.wait(self.DEFAULT_THREAD_PERIOD)
+            self.thread_wake_event.clear()
+
+    def close(self):
+        self.stop_thread()
+        if self.serial_port is not None:
+            self.serial_port.close()
+        else:
+            super().close()
+
+    # Port I/O goes to the injected port object if there is one
+    # ---------------------------------------------------------------------------------------------
+
+    def write(self, data):
+        if self.serial_port is not None:
+            return self.serial_port.write(data)
+        return super().write(data)
+
+    def readline(self, *args, **kwargs):
+        if self.serial_port is not None:
+            return self.serial_port.readline()
+        return super().readline(*args, **kwargs)
+
+    @property
+    def in_waiting(self):
+        if self.serial_port is not None:
+            return self.serial_port.in_waiting
+        return super().in_waiting
+
+    def update(self, query_status=False):
+        with self.io_lock, perf.monitor.span('grbl_update'):
+            rval = self._update(query_status)
+            perf.monitor.gauge('grbl_rx_fill', self.buff_char_count)
+            perf.monitor.gauge('grbl_backlog', len(self.cmd_to_send))
+        return rval
+
+    def _update(self, query_status):
+        rval = {}
+        if self.debug:
             if self.cmd_to_send:
-                print(f'cmd_to_send: {self.cmd_to_send}')
+                print(f'cmd_to_send: {list(self.cmd_to_send)}')
             if self.cmd_in_buff:
-                print(f'cmd_in_buf:  {self.cmd_in_buff}')
-                print(f'char_counts: {self.char_counts}')
-                print(f'sum(char_counts): {sum(self.char_counts)}')
+                print(f'cmd_in_buf:  {list(self.cmd_in_buff)}')
+                print(f'buff_char_count: {self.buff_char_count}')
                 print()
 
         if query_status:
             if not self.cmd_to_send or self.cmd_to_send[-1] != self.CMD_GET_STATUS:
                 self.write(f'{self.CMD_GET_STATUS}'.encode())
 
-        if self.cmd_to_send:
-            cmd = self.cmd_to_send[0]
-            if (sum(self.char_counts) + len(cmd)) < self.RX_BUFFER_SIZE:
-                self.write('{}'.format(cmd).encode())
-                self.char_counts.append(len(cmd))
-                self.cmd_in_buff.append(cmd)
-                del self.cmd_to_send[0]
+        # Fill grbl's rx buffer as full as possible (character counting)
+        stream = self.stream
+        if stream is not None:
+            stream.fill()
+        data = []
+        while True:
+            if self.cmd_to_send:
+                queue = self.cmd_to_send
+            elif stream is not None and stream.buffer:
+                queue = stream.buffer
+            else:
+                break
+            cmd = queue[0]
+            if (self.buff_char_count + len(cmd)) >= self.RX_BUFFER_SIZE:
+                break
+            if queue is self.cmd_to_send:
+                self.cmd_to_send.popleft()
+            else:
+                stream.pop()
+                if not stream.buffer:
+                    stream.fill()
+            data.append(cmd)
+            self.buff_char_count += len(cmd)
+            self.cmd_in_buff.append(cmd)
+        if data:
+            self.write(''.join(data).encode())
 
-        if self.in_waiting:
+        # Drain all pending responses
+        while self.in_waiting:
             line = self.readline().decode('UTF-8').strip()
             if 'ok' in line or 'error' in line:
-                del self.cmd_in_buff[0]
-                del self.char_counts[0]
-                
+                cmd = None
+                if self.cmd_in_buff:
+                    cmd = self.cmd_in_buff.popleft()
+                    self.buff_char_count -= len(cmd)
+                rval.setdefault('responses', []).append((line, cmd))
             elif 'MPos' in line or 'WPos' in line:
                 status = grbl_comm.extract_status_from_line(line)
+                status['timestamp'] = time.time()
                 rval['status'] = status
 
         return rval
-
-
-
-
-
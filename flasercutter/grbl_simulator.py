@@ -0,0 +1,482 @@
+"""
+Software stand-in for a GRBL controller for benchmarking and headless testing.
+
+GrblSimulator models the 128 byte serial rx buffer, the planner queue, ok/error responses,
+realtime commands ('?', '!', '~', ctrl-x) and status reports with MPos/WPos. Motion is
+timed from the programmed feedrates (acceleration is not modelled, and arcs are timed by
+their length but interpolated as straight lines). It can be driven in-process by handing
+a SimulatedSerial to GrblSender(serial_port=...) or served on a pseudo terminal with 
+GrblSimulatorPty, in which case GrblSender can be pointed at the pty's device path in 
+place of a real controller.
+
+"""
+import os
+import re
+import math
+import pty
+import tty
+import time
+import select
+import threading
+import collections
+
+
+class MotionBlock:
+
+    def __init__(self, start, end, duration, feedrate=0.0):
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.feedrate = feedrate
+        self.elapsed = 0.0
+
+    def position(self):
+        if self.duration <= 0:
+            return self.end
+        s = min(self.elapsed/self.duration, 1.0)
+        return tuple(p + s*(q - p) for p, q in zip(self.start, self.end))
+
+
+class GrblSimulator:
+
+    RX_BUFFER_SIZE = 128
+    PLANNER_BUFFER_SIZE = 16
+    MAX_RAPID_RATE = 500.0  # mm/min
+    DEFAULT_FEEDRATE = 0.0
+    GREETING = "Grbl 1.1h ['$' for help]"
+
+    CMD_GET_STATUS = '?'
+    CMD_FEEDHOLD = '!'
+    CMD_RESUME = '~'
+    CMD_RESET = '\x18'
+
+    STATE_IDLE = 'Idle'
+    STATE_RUN = 'Run'
+    STATE_HOLD = 'Hold'
+    STATE_ALARM = 'Alarm'
+
+    STATUS_FORMAT_V1 = 'v1.1'
+    STATUS_FORMAT_V0 = 'v0.9'
+
+    ERROR_EXPECTED_COMMAND = 1
+    ERROR_BAD_NUMBER = 2
+    ERROR_INVALID_STATEMENT = 3
+    ERROR_ALARM_LOCK = 9
+    ERROR_UNSUPPORTED_COMMAND = 20
+    ERROR_NO_FEEDRATE = 22
+
+    WORD_REGEX = re.compile(r'([A-Z])([-+]?[0-9]*\.?[0-9]*)')
+
+    def __init__(self, clock=time.monotonic, status_format=STATUS_FORMAT_V1):
+        self.clock = clock
+        self.status_format = status_format
+        self.output = collections.deque()
+        self.stats = collections.Counter()
+        self.reset()
+        self.send_line(self.GREETING)
+
+    def reset(self):
+        self.rx_buffer = bytearray()
+        self.planner = collections.deque()
+        self.mpos = (0.0, 0.0, 0.0)
+        self.wco = (0.0, 0.0, 0.0)
+        self.absolute = True
+        self.feedrate = self.DEFAULT_FEEDRATE
+        self.spindle_on = False
+        self.spindle_speed = 0.0
+        self.hold = False
+        self.alarm = False
+        self.last_update = self.clock()
+
+    @property
+    def wpos(self):
+        return tuple(p - o for p, o in zip(self.mpos, self.wco))
+
+    @property
+    def state(self):
+        if self.alarm:
+            return self.STATE_ALARM
+        if self.hold:
+            return self.STATE_HOLD
+        if self.planner:
+            return self.STATE_RUN
+        return self.STATE_IDLE
+
+    @property
+    def rx_free(self):
+        return self.RX_BUFFER_SIZE - len(self.rx_buffer)
+
+    @property
+    def planner_free(self):
+        return self.PLANNER_BUFFER_SIZE - len(self.planner)
+
+    # Serial side
+    # ---------------------------------------------------------------------------------------------
+
+    def write(self, data):
+        """ Bytes received from the host. Realtime commands are acted on immediately,
+        everything else goes into the rx buffer. Bytes arriving with the rx buffer full
+        are lost, just as they would be on the controller.
+        """
+        self.update()
+        for value in data:
+            char = chr(value)
+            if char == self.CMD_GET_STATUS:
+                self.send_line(self.status_line())
+                self.stats['status_reports'] += 1
+            elif char == self.CMD_FEEDHOLD:
+                self.hold = bool(self.planner) or self.hold
+            elif char == self.CMD_RESUME:
+                self.hold = False
+            elif char == self.CMD_RESET:
+                moving = bool(self.planner) and not self.hold
+                mpos, wco = self.mpos, self.wco
+                self.reset()
+                self.mpos, self.wco = mpos, wco
+                self.alarm = moving
+                self.send_line(self.GREETING)
+            elif len(self.rx_buffer) < self.RX_BUFFER_SIZE:
+                self.rx_buffer.append(value)
+                self.stats['max_rx_fill'] = max(self.stats['max_rx_fill'], len(self.rx_buffer))
+            else:
+                self.stats['rx_overflow_bytes'] += 1
+        self.update()
+
+    def read(self):
+        """ Returns all pending output bytes. """
+        self.update()
+        data = b''.join(self.output)
+        self.output.clear()
+        return data
+
+    def send_line(self, line):
+        self.output.append(f'{line}\r\n'.encode())
+
+    # Controller side
+    # ---------------------------------------------------------------------------------------------
+
+    def update(self, now=None):
+        """ Advances motion to the current time and parses buffered lines for as long
+        as the planner has room.
+        """
+        if now is None:
+            now = self.clock()
+        self.advance(now - self.last_update)
+        self.last_update = now
+        while self.planner_free > 0:
+            index = self.rx_buffer.find(b'\n')
+            if index < 0:
+                break
+            line = self.rx_buffer[:index].decode('ascii', errors='replace')
+            if self.needs_sync(line) and self.planner:
+                break
+            del self.rx_buffer[:index+1]
+            self.stats['lines'] += 1
+            error = self.execute_line(line)
+            if error:
+                self.stats['errors'] += 1
+                self.send_line(f'error:{error}')
+            else:
+                self.stats['oks'] += 1
+                self.send_line('ok')
+
+    def advance(self, dt):
+        if self.hold or self.alarm:
+            return
+        if not self.planner:
+            self.stats['idle_time'] += dt
+            return
+        while dt > 0 and self.planner:
+            block = self.planner[0]
+            remaining = block.duration - block.elapsed
+            if dt >= remaining:
+                dt -= remaining
+                self.mpos = block.end
+                self.planner.popleft()
+                if not self.planner and self.rx_buffer.find(b'\n') < 0:
+                    self.stats['planner_starved'] += 1
+            else:
+                block.elapsed += dt
+                self.mpos = block.position()
+                dt = 0.0
+
+    def status_line(self):
+        mpos = ','.join(f'{v:0.3f}' for v in self.mpos)
+        wpos = ','.join(f'{v:0.3f}' for v in self.wpos)
+        if self.status_format == self.STATUS_FORMAT_V0:
+            return f'<{self.state},MPos:{mpos},WPos:{wpos}>'
+        feed = self.planner[0].feedrate if self.planner else 0.0
+        return (
+                f'<{self.state}|MPos:{mpos}|WPos:{wpos}|Bf:{self.planner_free},{self.rx_free}'
+                f'|FS:{feed:0.0f},{self.spindle_speed:0.0f}>'
+                )
+
+    def planner_end(self):
+        if self.planner:
+            return self.planner[-1].end
+        return self.mpos
+
+    @staticmethod
+    def strip_line(line):
+        line = re.sub(r'\(.*?\)', '', line)
+        line = line.split(';')[0]
+        return ''.join(line.split()).upper()
+
+    def needs_sync(self, line):
+        # Commands that act on the current position wait for the planner to empty
+        line = self.strip_line(line)
+        return line.startswith('$') or 'G10' in line
+
+    def execute_line(self, line):
+        """ Parses and executes a single line. Returns an error code or None. """
+        line = self.strip_line(line)
+        if not line:
+            return None
+        if line.startswith('$'):
+            if line == '$X':
+                self.alarm = False
+            return None
+        if self.alarm:
+            return self.ERROR_ALARM_LOCK
+
+        words = []
+        pos = 0
+        for match in self.WORD_REGEX.finditer(line):
+            if match.start() != pos:
+                return self.ERROR_EXPECTED_COMMAND
+            letter, number = match.groups()
+            try:
+                words.append((letter, float(number)))
+            except ValueError:
+                return self.ERROR_BAD_NUMBER
+            pos = match.end()
+        if pos != len(line):
+            return self.ERROR_EXPECTED_COMMAND
+
+        motion = None
+        dwell = None
+        axes = {}
+        arc_offset = {}
+        g10 = None
+        for letter, value in words:
+            if letter == 'G':
+                if value in (0, 1, 2, 3):
+                    motion = int(value)
+                elif value == 90:
+                    self.absolute = True
+                elif value == 91:
+                    self.absolute = False
+                elif value == 4:
+                    dwell = 0.0
+                elif value == 10:
+                    g10 = {}
+                elif value in (17, 21, 54, 94):
+                    pass
+                else:
+                    return self.ERROR_UNSUPPORTED_COMMAND
+            elif letter == 'M':
+                if value in (3, 4):
+                    self.spindle_on = True
+                elif value == 5:
+                    self.spindle_on = False
+                elif value in (0, 1, 2, 30):
+                    pass
+                else:
+                    return self.ERROR_UNSUPPORTED_COMMAND
+            elif letter == 'F':
+                self.feedrate = value
+            elif letter == 'S':
+                self.spindle_speed = value
+            elif letter in 'XYZ':
+                axes['XYZ'.index(letter)] = value
+            elif letter in 'IJ':
+                arc_offset['IJ'.index(letter)] = value
+            elif letter in 'LP':
+                if g10 is not None:
+                    g10[letter] = value
+                elif letter == 'P' and dwell is not None:
+                    dwell = value
+                else:
+                    return self.ERROR_UNSUPPORTED_COMMAND
+            else:
+                return self.ERROR_UNSUPPORTED_COMMAND
+
+        if g10 is not None:
+            return self.execute_g10(g10, axes)
+
+        if dwell is not None:
+            start = self.planner_end()
+            self.planner.append(MotionBlock(start, start, dwell))
+            return None
+
+        if axes:
+            if motion is None:
+                return self.ERROR_INVALID_STATEMENT
+            start = self.planner_end()
+            end = list(start)
+            for i, value in axes.items():
+                if self.absolute:
+                    end[i] = value + self.wco[i]
+                else:
+                    end[i] = start[i] + value
+            end = tuple(end)
+            if motion == 0:
+                feedrate = self.MAX_RAPID_RATE
+            else:
+                if self.feedrate <= 0:
+                    return self.ERROR_NO_FEEDRATE
+                feedrate = self.feedrate
+            distance = sum((q - p)**2 for p, q in zip(start, end))**0.5
+            if motion in (2, 3):
+                if not arc_offset:
+                    return self.ERROR_INVALID_STATEMENT
+                distance = self.arc_length(start, end, arc_offset, clockwise=(motion == 2))
+            self.planner.append(MotionBlock(start, end, 60.0*distance/feedrate, feedrate))
+        return None
+
+    @staticmethod
+    def arc_length(start, end, arc_offset, clockwise):
+        center_x = start[0] + arc_offset.get(0, 0.0)
+        center_y = start[1] + arc_offset.get(1, 0.0)
+        radius = math.hypot(start[0] - center_x, start[1] - center_y)
+        angle_start = math.atan2(start[1] - center_y, start[0] - center_x)
+        angle_end = math.atan2(end[1] - center_y, end[0] - center_x)
+        sweep = angle_end - angle_start
+        if clockwise and sweep >= 0.0:
+            sweep -= 2.0*math.pi
+        elif not clockwise and sweep <= 0.0:
+            sweep += 2.0*math.pi
+        return math.hypot(radius*sweep, end[2] - start[2])
+
+    def execute_g10(self, g10, axes):
+        if g10.get('P', 1) not in (0, 1):
+            return self.ERROR_UNSUPPORTED_COMMAND
+        wco = list(self.wco)
+        if g10.get('L') == 20:
+            for i, value in axes.items():
+                wco[i] = self.mpos[i] - value
+        elif g10.get('L') == 2:
+            for i, value in axes.items():
+                wco[i] = value
+        else:
+            return self.ERROR_UNSUPPORTED_COMMAND
+        self.wco = tuple(wco)
+        return None
+
+
+class SimulatedSerial:
+
+    """ In-process stand-in for the serial.Serial methods used by GrblSender. """
+
+    def __init__(self, simulator=None):
+        self.simulator = simulator if simulator is not None else GrblSimulator()
+        self.in_buffer = bytearray()
+        self.is_open = True
+
+    def fill(self):
+        self.in_buffer.extend(self.simulator.read())
+
+    @property
+    def in_waiting(self):
+        self.fill()
+        return len(self.in_buffer)
+
+    def write(self, data):
+        self.simulator.write(data)
+        return len(data)
+
+    def read(self, size=1):
+        self.fill()
+        data = bytes(self.in_buffer[:size])
+        del self.in_buffer[:size]
+        return data
+
+    def readline(self):
+        self.fill()
+        index = self.in_buffer.find(b'\n')
+        if index < 0:
+            data = bytes(self.in_buffer)
+            self.in_buffer.clear()
+        else:
+            data = bytes(self.in_buffer[:index+1])
+            del self.in_buffer[:index+1]
+        return data
+
+    def reset_input_buffer(self):
+        self.fill()
+        self.in_buffer.clear()
+
+    def close(self):
+        self.is_open = False
+
+
+class GrblSimulatorPty:
+
+    """ Serves a GrblSimulator on a pseudo terminal from a background thread. Open
+    the device at self.port (e.g. with GrblSender(port=sim.port)) to talk to it.
+    """
+
+    POLL_PERIOD = 0.001
+
+    def __init__(self, simulator=None):
+        self.simulator = simulator if simulator is not None else GrblSimulator()
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            readable, _, _ = select.select([self.master_fd], [], [], self.POLL_PERIOD)
+            if readable:
+                try:
+                    data = os.read(self.master_fd, 1024)
+                except OSError:
+                    data = b''
+                if data:
+                    self.simulator.write(data)
+            output = self.simulator.read()
+            if output:
+                os.write(self.master_fd, output)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+# -------------------------------------------------------------------------------------------------
+
+def simulator_main():
+    sim = GrblSimulatorPty()
+    sim.start()
+    print(f'grbl simulator running on {sim.port}', flush=True)
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+        print(dict(sim.simulator.stats))
+
+
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    simulator_main()
@@ -1,3 +1,4 @@
+import numpy as np
 from PyQt5 import QtCore
 import pyqtgraph as pg
 
@@ -11,11 +12,100 @@ class ImageItem(pg.ImageItem):
         super().__init__(*args, **kwargs)
 
     def mousePressEvent(self, ev):
-        x = int(ev.pos().x())
-        y = int(ev.pos().y())
+        # Positions are reported in view coordinates, which differ from the image's own
+        # pixels when it is displayed scaled
+        pos = self.mapToParent(ev.pos())
+        x = int(pos.x())
+        y = int(pos.y())
         if ev.button() == QtCore.Qt.MouseButton.LeftButton:
             self.leftMousePressSignal.emit(x,y)
         if ev.button() == QtCore.Qt.MouseButton.RightButton:
             self.rightMousePressSignal.emit(x,y)
         if ev.button() == QtCore.Qt.MouseButton.MiddleButton:
             self.middleMousePressSignal.emit(x,y)
+
+
+class AnnotationOverlay:
+
+    """ Cut path, points, depth labels, laser crosshair and status label drawn as 
+    pyqtgraph items layered over the image rather than rasterized into it. Items are 
+    only touched when the annotations change so the per-frame cost doesn't depend on 
+    the number of points. Colors are rgb. 
+    """
+
+    Z_VALUE = 10
+    PIXEL_CENTER_OFFSET = 0.5
+
+    def __init__(self, view, point_color, point_size, line_color, line_width, depth_color, 
+            depth_offset, label_color, label_pos, laser_color=(255,255,255), laser_size=10):
+        self.view = view
+        self.depth_color = depth_color
+        self.depth_offset = depth_offset
+        self.laser_size = laser_size
+        self.path_item = pg.PlotDataItem(pen=pg.mkPen(line_color, width=line_width))
+        self.point_item = pg.ScatterPlotItem(
+                size=2*point_size, 
+                pen=None, 
+                brush=pg.mkBrush(point_color),
+                )
+        self.laser_item = pg.PlotDataItem(pen=pg.mkPen(laser_color, width=2), connect='pairs')
+        self.label_item = pg.TextItem(color=label_color, anchor=(0,1))
+        self.label_item.setPos(*label_pos)
+        self.depth_items = []
+        self.depth_values = []
+        for item in (self.path_item, self.point_item, self.laser_item, self.label_item):
+            item.setZValue(self.Z_VALUE)
+            self.view.addItem(item)
+
+    def set_points(self, px_point_list, z_point_list):
+        offset = self.PIXEL_CENTER_OFFSET
+        if px_point_list:
+            xy = np.asarray(px_point_list, dtype=np.float64) + offset
+            x, y = xy[:,0], xy[:,1]
+        else:
+            x, y = np.zeros((0,)), np.zeros((0,))
+        self.point_item.setData(x=x, y=y)
+        self.path_item.setData(x=x, y=y)
+        self.set_depth_labels(px_point_list, z_point_list)
+
+    def set_depth_labels(self, px_point_list, z_point_list):
+        # Only add, remove or change the labels which differ from those shown 
+        depth_values = [(p, f'{int(1000*z)}') for p, z in zip(px_point_list, z_point_list)]
+        for i, (p, text) in enumerate(depth_values):
+            if i < len(self.depth_items):
+                if self.depth_values[i] == (p, text):
+                    continue
+                item = self.depth_items[i]
+            else:
+                item = pg.TextItem(color=self.depth_color, anchor=(0,1))
+                item.setZValue(self.Z_VALUE)
+                self.view.addItem(item)
+                self.depth_items.append(item)
+            item.setText(text)
+            item.setPos(p[0] + self.depth_offset[0], p[1] + self.depth_offset[1])
+        while len(self.depth_items) > len(depth_values):
+            self.view.removeItem(self.depth_items.pop())
+        self.depth_values = depth_values
+
+    def set_points_visible(self, visible):
+        for item in [self.path_item, self.point_item] + self.depth_items:
+            item.setVisible(visible)
+
+    def set_laser_pos(self, pos):
+        if pos is None:
+            self.laser_item.setData(x=[], y=[])
+            return
+        cx = int(pos[0]) + self.PIXEL_CENTER_OFFSET
+        cy = int(pos[1]) + self.PIXEL_CENTER_OFFSET
+        sz = self.laser_size
+        x = [cx - sz, cx + sz, cx, cx]
+        y = [cy, cy, cy - sz, cy + sz]
+        self.laser_item.setData(x=x, y=y)
+
+    def set_label(self, text):
+        self.label_item.setText(text)
+
+    def set_visible(self, visible):
+        items = [self.path_item, self.point_item, self.laser_item, self.label_item] 
+        for item in items + self.depth_items:
+            item.setVisible(visible)
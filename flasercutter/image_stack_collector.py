@@ -1,12 +1,18 @@
 import os
 import time
-import pickle
+import functools
 import collections
+import concurrent.futures
+import cv2
 import numpy as np
-import scipy.ndimage as ndimage
+import scipy.ndimage
 
-import sgolay2
 from .focus_stacker import FocusStacker
+from .frame_reducer import create_reducer
+from .tile_pipeline import TilePipeline
+from .tile_pipeline import clean_depth_image
+from .stack_archive import StackArchiveWriter
+from . import perf
 
 class ImageStackCollector:
 
@@ -19,24 +25,92 @@ class ImageStackCollector:
     DEFAULT_MEDIAN_FILTER_SIZE = 21
     DEFAULT_SGOLAY_WINDOW_SIZE = 51 
     DEFAULT_SGOLAY_POLY_ORDER = 3
+    DEFAULT_REDUCER = 'median'
+    DEFAULT_REDUCER_PARAM = {}
+    DEFAULT_KEEP_RAW_IMAGES = False
+    DEFAULT_NUM_WORKERS = os.cpu_count()
+    DEFAULT_ARCHIVE_FILENAME = 'focus_stack.stack'
+    RECORD_NAME_FORMAT = 'focus_stack_%Y%m%d_%H%M%S'
+    DEFAULT_SYNC_MOTION = True
+    DEFAULT_POSITION_TOLERANCE = 0.0005
+    DEFAULT_IDLE_TIMEOUT = 1.0
+    DEFAULT_STABILITY_THRESHOLD = 2.0
+    DEFAULT_STABLE_FRAMES = 2
+    DEFAULT_STABILITY_SUBSAMPLE = 4
+    DEFAULT_SWEEP = False
+    DEFAULT_SWEEP_TIME = 4.0
+    DEFAULT_STATUS_HISTORY = 64
+    DEFAULT_Z_DECIMALS = 3
+    DEFAULT_DEPTH_TOLERANCE = 0.001
+    DEFAULT_DEPTH_SAMPLE_SPACING = 1.0
+    DEFAULT_ADAPTIVE = False
+    DEFAULT_ADAPTIVE_PARAM = {
+            'initial_num'        : 5,
+            'min_spacing'        : 0.002,
+            'sharpness_fraction' : 0.1,
+            'peak_ratio'         : 1.5,
+            'max_unresolved'     : 0.05,
+            'subsample'          : 4,
+            }
 
     def __init__(self, min_val=-0.05, max_val=0.05, num=10):
         self.images_per_step = self.DEFAULT_IMAGES_PER_STEP
         self.settling_time = self.DEFAULT_SETTLING_TIME
+        self.sync_motion = self.DEFAULT_SYNC_MOTION
+        self.position_tolerance = self.DEFAULT_POSITION_TOLERANCE
+        self.idle_timeout = self.DEFAULT_IDLE_TIMEOUT
+        self.idle_mismatch = None
+        self.stability_threshold = self.DEFAULT_STABILITY_THRESHOLD
+        self.stable_frames = self.DEFAULT_STABLE_FRAMES
         self.focus_stacker_param = self.DEFAULT_FOCUS_STACKER_PARAM
         self.median_filter_size = self.DEFAULT_MEDIAN_FILTER_SIZE
         self.sgolay_window_size = self.DEFAULT_SGOLAY_WINDOW_SIZE
         self.sgolay_poly_order = self.DEFAULT_SGOLAY_POLY_ORDER
+        self.reducer = self.DEFAULT_REDUCER
+        self.reducer_param = self.DEFAULT_REDUCER_PARAM
+        self.keep_raw_images = self.DEFAULT_KEEP_RAW_IMAGES
+        self.num_workers = self.DEFAULT_NUM_WORKERS
+        self.record_dir = None
+        self.record_path = None
+        self.record_compression = None
+        self.archive_writer = None
+        self.sweep = self.DEFAULT_SWEEP
+        self.sweep_time = self.DEFAULT_SWEEP_TIME
+        self.sweep_phase = None
+        self.sweep_target = None
+        self.sweep_z_sum = 0.0
+        self.t_sweep_end = None
+        self.status_history = collections.deque(maxlen=self.DEFAULT_STATUS_HISTORY)
+        self.pending_frames = collections.deque()
+        self.adaptive = self.DEFAULT_ADAPTIVE
+        self.adaptive_param = dict(self.DEFAULT_ADAPTIVE_PARAM)
+        self.unresolved_fraction = None
         self.set_range(min_val, max_val, num)
         self.step_to_image_list = collections.OrderedDict() 
+        self.step_to_timestamp_list = collections.OrderedDict() 
         self.step_to_image_median = collections.OrderedDict()
+        self.step_to_sharpness = {}
+        self.step_reducer = None
+        self.focus_stacker = FocusStacker(**self.focus_stacker_param)
         self.t_step = 0.0
+        self.t_idle = None
+        self.stable = False
+        self.stable_count = 0
+        self.last_stability_image = None
         self.index = self.num
         self.focus_image = None
         self.depth_image = None
 
     def set_range(self, min_val, max_val, num):
-        self.steps = np.linspace(min_val, max_val, num)
+        """ Sets the z range. In adaptive mode the stack starts with a coarse uniform
+        sampling of the range and num is the maximum number of steps. 
+        """
+        self.max_num = num
+        if self.adaptive:
+            num = min(self.adaptive_param['initial_num'], num)
+        # Rounded to what the G-code carries, so each step's z is the one commanded
+        steps = np.round(np.linspace(min_val, max_val, num), self.DEFAULT_Z_DECIMALS)
+        self.steps = np.array(list(dict.fromkeys(steps)))
 
     @property
     def ready(self):
@@ -68,77 +142,555 @@ class ImageStackCollector:
     @property
     def step_complete(self):
         if self.running and self.index >= 0:
-            val = self.steps[self.index] 
-            return len(self.step_to_image_list[val]) >= self.images_per_step
+            return self.step_reducer.count >= self.images_per_step
         else:
             return True
 
+    @property
+    def images_needed(self):
+        if self.running and self.index >= 0:
+            return max(self.images_per_step - self.step_reducer.count, 0)
+        else:
+            return 0
+
+    @property
+    def target(self):
+        if self.sweep:
+            return self.sweep_target
+        if self.running and self.index >= 0:
+            return self.steps[self.index]
+        else:
+            return None
+
+    @property
+    def bin_edges(self):
+        """ Edges of the z bins of a sweep, the steps are their centers. """
+        half_width = 0.5*(self.max_val - self.min_val)/max(self.num - 1, 1)
+        return np.linspace(self.min_val - half_width, self.max_val + half_width, self.num + 1)
+
+    @property
+    def sweep_feedrate(self):
+        """ Feedrate (per minute) which covers the range in sweep_time. """
+        return 60.0*(self.bin_edges[-1] - self.bin_edges[0])/self.sweep_time
+
     @property
     def settled(self):
-        return (time.time() - self.t_step) > self.settling_time
+        """ True once frames for the current step may start to arrive. With sync_motion 
+        that is as soon as grbl reports the move complete, otherwise settling_time after 
+        the step started.
+        """
+        if self.sync_motion:
+            return self.t_idle is not None
+        return self.settled_at(time.time())
+
+    def settled_at(self, timestamp):
+        return (timestamp - self.t_step) > self.settling_time
+
+    def update_motion(self, idle, z, now=None):
+        """ Called with each grbl status report. The move to the current step is complete
+        once grbl reports idle with z at the step's value - a stale idle report from 
+        before the move was started has the previous z so can't be mistaken for it.
+
+        The tolerance allows for the commanded z resolution. If grbl stays idle somewhere
+        else (e.g. the stage's step resolution doesn't divide the step) for idle_timeout
+        the move is taken as complete anyway, rather than waiting forever.
+        """
+        target = self.target
+        if target is None or self.t_idle is not None or z is None:
+            return
+        now = time.time() if now is None else now
+        if not idle:
+            self.idle_mismatch = None
+            return
+        tolerance = self.position_tolerance + 0.5*10.0**(-self.DEFAULT_Z_DECIMALS)
+        if abs(z - target) <= tolerance:
+            self.t_idle = now
+        elif self.idle_mismatch is None or self.idle_mismatch[0] != target:
+            self.idle_mismatch = (target, now)
+        elif now - self.idle_mismatch[1] > self.idle_timeout:
+            self.t_idle = now
+
+    def frame_settled(self, image, timestamp):
+        """ Returns True if the frame can be added to the current step. 
+
+        With sync_motion frames are accepted once the move is complete and the image has 
+        stopped changing - stable_frames consecutive frame to frame differences below 
+        stability_threshold (mean absolute grey level difference). If the image never 
+        steadies, e.g. with flickering light, frames are accepted settling_time after the 
+        move completed. Without sync_motion this is just settled_at. 
+        """
+        if not self.sync_motion:
+            return self.settled_at(timestamp)
+        if self.t_idle is None or timestamp < self.t_idle:
+            return False
+        if not self.stable:
+            diff = self.frame_difference(image)
+            if diff is not None and diff < self.stability_threshold:
+                self.stable_count += 1
+            else:
+                self.stable_count = 0
+            if self.stable_count >= self.stable_frames:
+                self.stable = True
+            elif (timestamp - self.t_idle) > self.settling_time:
+                self.stable = True
+        return self.stable
+
+    def frame_difference(self, image):
+        """ Mean absolute difference between the subsampled grey level image and the 
+        previous one passed in, or None for the first. 
+        """
+        sub = self.DEFAULT_STABILITY_SUBSAMPLE
+        height, width = image.shape[:2]
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, (width//sub, height//sub), interpolation=cv2.INTER_AREA)
+        last = self.last_stability_image
+        self.last_stability_image = small
+        if last is None or last.shape != small.shape:
+            return None
+        return cv2.norm(small, last, cv2.NORM_L1)/small.size
+
+    @property
+    def archive_metadata(self):
+        return {
+                'images_per_step'     : self.images_per_step,
+                'settling_time'       : self.settling_time,
+                'reducer'             : self.reducer,
+                'reducer_param'       : self.reducer_param,
+                'focus_stacker_param' : self.focus_stacker_param,
+                'median_filter_size'  : self.median_filter_size,
+                'sgolay_window_size'  : self.sgolay_window_size,
+                'sgolay_poly_order'   : self.sgolay_poly_order,
+                'adaptive'            : self.adaptive,
+                'adaptive_param'      : self.adaptive_param,
+                }
 
     def start(self):
         self.clear()
         self.index = -1 
+        self.sweep_phase = None
+        self.sweep_target = None
+        self.t_sweep_end = None
+        self.t_idle = None
+        self.status_history.clear()
+        self.pending_frames.clear()
+        if self.record_dir is not None:
+            # Stream raw frames to disk as they arrive, a new archive for every stack
+            self.record_path = self.new_record_path()
+            self.archive_writer = StackArchiveWriter(
+                    self.record_path, 
+                    compression=self.record_compression,
+                    metadata=self.archive_metadata,
+                    )
+
+    def new_record_path(self):
+        name = time.strftime(self.RECORD_NAME_FORMAT)
+        path = os.path.join(self.record_dir, f'{name}.stack')
+        count = 1
+        while os.path.exists(path):
+            path = os.path.join(self.record_dir, f'{name}_{count}.stack')
+            count += 1
+        return path
 
     def stop(self):
         self.index = self.num
+        self.sweep_phase = None
+        self.sweep_target = None
+        self.pending_frames.clear()
+        self.close_archive_writer()
+
+    def close_archive_writer(self):
+        if self.archive_writer is not None:
+            self.archive_writer.close()
+            self.archive_writer = None
 
     def clear(self):
+        self.close_archive_writer()
         self.step_to_image_list = collections.OrderedDict() 
+        self.step_to_timestamp_list = collections.OrderedDict() 
         self.step_to_image_median = collections.OrderedDict() 
+        self.step_to_sharpness = {}
+        self.step_reducer = None
+        self.focus_stacker = FocusStacker(**self.focus_stacker_param)
         self.focus_image = None
         self.depth_image = None
+        self.unresolved_fraction = None
 
+    @perf.monitor.timed('stack_next_step')
     def next_step(self):
         if self.index > -1:
-            val = self.steps[self.index] 
-            image_array = np.array(self.step_to_image_list[val])
-            image_median = np.median(image_array, axis=0).astype(np.uint8)
-            self.step_to_image_median[val] = image_median
+            self.end_step(self.steps[self.index])
         self.index += 1
         self.t_step = time.time()
+        self.t_idle = None
+        self.stable = False
+        self.stable_count = 0
+        self.last_stability_image = None
+        if self.adaptive and self.index == self.num and self.num < self.max_num:
+            val = self.next_adaptive_step()
+            if val is not None:
+                self.steps = np.append(self.steps, val)
         if self.index < self.num:
             val = self.steps[self.index] 
-            self.step_to_image_list[val] = [] 
+            self.begin_step(val)
+            if self.archive_writer is not None:
+                self.archive_writer.begin_step(val)
             return val 
         else:
+            self.step_reducer = None
+            self.close_archive_writer()
             return None
 
-    def add_image(self, image):
-        val = self.steps[self.index] 
-        self.step_to_image_list[val].append(image) 
+    def begin_step(self, val):
+        self.step_to_image_list[val] = [] 
+        self.step_to_timestamp_list[val] = [] 
+        self.step_reducer = create_reducer(self.reducer, **self.reducer_param)
+
+    def end_step(self, val):
+        image_median = self.step_reducer.result()
+        self.step_to_image_median[val] = image_median
+        self.focus_stacker.push(image_median, val)
+        if self.adaptive:
+            self.step_to_sharpness[val] = self.step_sharpness(image_median)
+        if self.archive_writer is not None:
+            self.archive_writer.end_step(image_median, z=val)
+
+    # Sweep acquisition
+    # ---------------------------------------------------------------------------------------------
+
+    def next_sweep_move(self):
+        """ Returns the (z, feedrate) of the next move of a sweep or None if no move is 
+        due. A feedrate of None means the caller's normal feedrate. 
+
+        A sweep is a move to the bottom of the range followed by one slow continuous move 
+        to the top. During it every frame is passed to add_sweep_frame and every status 
+        report to add_status. Each frame's z is interpolated from the status reports 
+        either side of it and the frame is added to the bin (step) that z falls in. When 
+        the stage stops at the top the stack is complete. 
+        """
+        if self.sweep_phase is None:
+            if self.num < 2 or self.max_val <= self.min_val:
+                raise ValueError('a sweep needs a range with at least 2 steps')
+            self.index = 0
+            self.sweep_phase = 'to_start'
+            self.sweep_target = round(float(self.bin_edges[0]), self.DEFAULT_Z_DECIMALS)
+            self.t_idle = None
+            return self.sweep_target, None
+        if self.sweep_phase == 'to_start' and self.t_idle is not None:
+            self.sweep_phase = 'sweeping'
+            self.sweep_target = round(float(self.bin_edges[-1]), self.DEFAULT_Z_DECIMALS)
+            self.t_idle = None
+            self.status_history.clear()
+            self.begin_sweep_bin()
+            return self.sweep_target, self.sweep_feedrate
+        return None
 
-    def calc_focus_and_depth_images(self):
-        # Get list of images and depths and compute focus and depth map images
-        image_list = [image for (depth,image) in self.step_to_image_median.items()]
-        depth_list = [depth for (depth,image) in self.step_to_image_median.items()]
-        fs = FocusStacker(**self.focus_stacker_param)
-        focus_image, depth_image = fs.focus_stack(image_list, depth_list)
-
-        # Clean up depth map image
-        depth_image = ndimage.median_filter(depth_image, self.median_filter_size)
-        sg2 = sgolay2.SGolayFilter2(window_size=51, poly_order=3)
-        depth_image = sg2(depth_image)
+    @property
+    def sweeping(self):
+        return self.sweep_phase == 'sweeping'
+
+    def add_status(self, z, timestamp):
+        if not self.sweeping:
+            return
+        self.status_history.append((timestamp, z))
+        if self.t_idle is not None and self.t_sweep_end is None:
+            self.t_sweep_end = self.t_idle
+        self.resolve_sweep_frames()
+
+    def add_sweep_frame(self, image, timestamp):
+        if not self.sweeping or not self.status_history:
+            return
+        if timestamp < self.status_history[0][0]:
+            return
+        if self.t_sweep_end is not None and timestamp > self.t_sweep_end:
+            return
+        self.pending_frames.append((timestamp, image))
+        self.resolve_sweep_frames()
+
+    def resolve_sweep_frames(self):
+        """ Bins the pending frames which now have a status report after them. """
+        times, z_vals = (np.array(item) for item in zip(*self.status_history))
+        while self.pending_frames and self.pending_frames[0][0] <= times[-1]:
+            timestamp, image = self.pending_frames.popleft()
+            z = float(np.interp(timestamp, times, z_vals))
+            self.add_sweep_image(image, timestamp, z)
+        if self.t_sweep_end is not None and not self.pending_frames:
+            self.end_sweep()
+
+    def add_sweep_image(self, image, timestamp, z):
+        bin_index = int(np.searchsorted(self.bin_edges, z, side='right')) - 1
+        bin_index = min(bin_index, self.num - 1)
+        if bin_index < self.index:
+            return
+        while bin_index > self.index:
+            self.end_sweep_bin()
+            self.index += 1
+            self.begin_sweep_bin()
+        if self.step_reducer.count == 0 and self.archive_writer is not None:
+            # Archive steps are only started once they have a frame
+            self.archive_writer.begin_step(self.steps[self.index])
+        self.add_image(image, timestamp)
+        self.sweep_z_sum += z
+
+    def begin_sweep_bin(self):
+        self.sweep_z_sum = 0.0
+        self.begin_step(self.steps[self.index])
+
+    def end_sweep_bin(self):
+        """ Ends the current bin using the mean z of its frames as its depth. """
+        center = self.steps[self.index]
+        count = self.step_reducer.count
+        if count == 0:
+            del self.step_to_image_list[center]
+            del self.step_to_timestamp_list[center]
+            return
+        val = self.sweep_z_sum/count
+        self.step_to_image_list[val] = self.step_to_image_list.pop(center)
+        self.step_to_timestamp_list[val] = self.step_to_timestamp_list.pop(center)
+        self.end_step(val)
+
+    def end_sweep(self):
+        self.end_sweep_bin()
+        self.index = self.num
+        self.sweep_phase = None
+        self.sweep_target = None
+        self.step_reducer = None
+        self.pending_frames.clear()
+        self.close_archive_writer()
+
+    def next_adaptive_step(self):
+        """ Returns the next z to sample in adaptive mode or None once the stack has 
+        converged. 
+
+        Each in-focus pixel is assigned to the gap between its sharpest step and the 
+        sharper of that step's two neighbours, which is where its true focus lies. The 
+        gap wider than min_spacing holding the most pixels is split, and sampling stops 
+        once the fraction of pixels in such gaps drops below max_unresolved. Gaps in depth
+        bands the specimen doesn't occupy never get pixels so are never split. 
+        """
+        param = self.adaptive_param
+        depths = np.array(sorted(self.step_to_sharpness))
+        if depths.size < 2:
+            return None
+        sharpness = np.array([self.step_to_sharpness[val] for val in depths])
+        best_index = sharpness.argmax(axis=0)
+        best_sharpness = np.take_along_axis(sharpness, best_index[np.newaxis], axis=0)[0]
+        threshold = param['sharpness_fraction']*np.percentile(best_sharpness, 99)
+        in_focus = best_sharpness > threshold
+        # Pixels whose sharpness barely changes with z (no texture, or always out of 
+        # focus) say nothing about where the specimen is
+        in_focus &= best_sharpness > param['peak_ratio']*sharpness.min(axis=0)
+
+        index_lo = np.maximum(best_index - 1, 0)
+        index_hi = np.minimum(best_index + 1, depths.size - 1)
+        sharpness_lo = np.take_along_axis(sharpness, index_lo[np.newaxis], axis=0)[0]
+        sharpness_hi = np.take_along_axis(sharpness, index_hi[np.newaxis], axis=0)[0]
+        gap_index = np.where(sharpness_hi > sharpness_lo, best_index, best_index - 1)
+        gap_index = np.clip(gap_index, 0, depths.size - 2)
+        counts = np.bincount(gap_index[in_focus], minlength=depths.size - 1)
+        total = counts.sum()
+        if total == 0:
+            self.unresolved_fraction = 0.0
+            return None
 
-        self.focus_image = focus_image
-        self.depth_image = depth_image
+        # Gaps no wider than the commanded z resolution can't be split
+        resolution = 10.0**(-self.DEFAULT_Z_DECIMALS)
+        counts[np.diff(depths) <= max(param['min_spacing'], resolution)] = 0
+        self.unresolved_fraction = counts.sum()/total
+        if self.unresolved_fraction < param['max_unresolved']:
+            return None
+        i = int(np.argmax(counts))
+        # Rounded to what the G-code carries, so the step's z is the one commanded
+        return round(float(0.5*(depths[i] + depths[i+1])), self.DEFAULT_Z_DECIMALS)
+
+    def step_sharpness(self, image):
+        """ Sharpness of a subsampled copy of image, cheap enough to keep for every step. """
+        sub = self.adaptive_param['subsample']
+        height, width = image.shape[:2]
+        small = cv2.resize(image, (width//sub, height//sub), interpolation=cv2.INTER_AREA)
+        return self.focus_stacker.compute_sharpness(small).astype(np.float32)
+
+    def add_image(self, image, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.step_reducer.add(image)
+        if self.keep_raw_images:
+            val = self.steps[self.index] 
+            self.step_to_image_list[val].append(image) 
+            self.step_to_timestamp_list[val].append(timestamp) 
+        if self.archive_writer is not None:
+            self.archive_writer.add_frame(image, timestamp)
+
+    def focus_and_depth_task(self):
+        """ Returns a callable which computes the focus and depth images from a snapshot 
+        of the current stack. It holds no reference to the collector's mutable state, 
+        so it can be run off the GUI thread while a new stack is started. 
+        """
+        stacked_result = None
+        if self.focus_stacker.count and self.focus_stacker.count == len(self.step_to_image_median):
+            focus_image, depth_image = self.focus_stacker.result()
+            stacked_result = focus_image.copy(), depth_image
+        return functools.partial(
+                compute_focus_and_depth_images,
+                stacked_result=stacked_result,
+                step_to_image_median=collections.OrderedDict(self.step_to_image_median),
+                focus_stacker_param=dict(self.focus_stacker_param),
+                median_filter_size=self.median_filter_size,
+                sgolay_window_size=self.sgolay_window_size,
+                sgolay_poly_order=self.sgolay_poly_order,
+                num_workers=self.num_workers,
+                )
 
-    def save(self, filename='focus_stack.pkl'):
+    def calc_focus_and_depth_images(self):
+        focus_image, depth_image = self.focus_and_depth_task()()
+        self.set_focus_and_depth_images(focus_image, depth_image)
+
+    def set_focus_and_depth_images(self, focus_image, depth_image):
+        self.focus_image, self.depth_image = focus_image, depth_image
+
+    # Depth sampling
+    # ---------------------------------------------------------------------------------------------
+
+    def sample_depth(self, points_px):
+        """ Bilinearly interpolated depth at each of an (N,2) array of sub-pixel (x,y) 
+        image points. Points outside the image take the depth of the nearest edge pixel.
+        """
+        if self.depth_image is None:
+            raise RuntimeError('no depth image')
+        points_px = np.asarray(points_px, dtype=np.float64).reshape(-1, 2)
+        coords = points_px[:,::-1].T
+        return scipy.ndimage.map_coordinates(self.depth_image, coords, order=1, mode='nearest')
+
+    def sample_path_depth(self, points_px, tolerance=DEFAULT_DEPTH_TOLERANCE, 
+            spacing=DEFAULT_DEPTH_SAMPLE_SPACING):
+        """ Samples the depth along a path, densified where the depth between vertices
+        isn't linear (see densify_path_depth). 
+        """
+        return densify_path_depth(self.sample_depth, points_px, tolerance, spacing)
+
+    def save(self, filename=DEFAULT_ARCHIVE_FILENAME, compression=None):
+        """ Saves the stack as a stack archive (see stack_archive). Raw frames are only
+        included if keep_raw_images is set. 
+        """
         filepath = os.path.join(os.environ['HOME'], filename)
-        data = {
-                'raw_images'    : self.step_to_image_list, 
-                'median_images' : self.step_to_image_median,
-                }
-        with open(filepath,'wb') as f:
-            pickle.dump(data,f)
-
-
-
-
-
-
-
-
-
+        writer = StackArchiveWriter(filepath, compression=compression, metadata=self.archive_metadata)
+        with writer:
+            for val, image_median in self.step_to_image_median.items():
+                writer.write_step(
+                        val, 
+                        self.step_to_image_list.get(val, []), 
+                        median=image_median,
+                        timestamps=self.step_to_timestamp_list.get(val, []),
+                        )
+        return filepath
+
+
+
+# -------------------------------------------------------------------------------------------------
+
+@perf.monitor.timed('stack_compute')
+def compute_focus_and_depth_images(stacked_result, step_to_image_median, focus_stacker_param, 
+        median_filter_size, sgolay_window_size, sgolay_poly_order, num_workers=None, 
+        progress_callback=None, cancel_event=None):
+    """ Computes the focus and cleaned depth images for a stack. 
+
+    stacked_result is the (focus_image, depth_image) of the incremental focus stack, 
+    with each step pushed as it completed, or None if the steps have been modified since 
+    and the full stack needs to be recomputed. With more than one worker 
+    the stages are run on halo padded tiles in parallel. progress_callback(done, total) 
+    is called as the work proceeds and concurrent.futures.CancelledError is raised if 
+    cancel_event is set. 
+    """
+    def check_cancel():
+        if cancel_event is not None and cancel_event.is_set():
+            raise concurrent.futures.CancelledError()
+
+    def report(num_done, num_total):
+        if progress_callback is not None:
+            progress_callback(num_done, num_total)
+
+    pipeline = None
+    if num_workers is not None and num_workers > 1:
+        pipeline = TilePipeline(
+                focus_stacker_param,
+                median_filter_size,
+                sgolay_window_size,
+                sgolay_poly_order,
+                max_workers=num_workers,
+                )
+    clean_param = {
+            'median_filter_size' : median_filter_size,
+            'sgolay_window_size' : sgolay_window_size,
+            'sgolay_poly_order'  : sgolay_poly_order,
+            }
 
+    if stacked_result is not None:
+        focus_image, depth_image = stacked_result
+        if pipeline is not None:
+            depth_image = pipeline.clean_depth(depth_image, progress_callback, cancel_event)
+        else:
+            report(0, 1)
+            depth_image = clean_depth_image(depth_image, **clean_param)
+            report(1, 1)
+    else:
+        image_list = [image for (depth,image) in step_to_image_median.items()]
+        depth_list = [depth for (depth,image) in step_to_image_median.items()]
+        if pipeline is not None:
+            focus_image, depth_image = pipeline.focus_and_depth(
+                    image_list, 
+                    depth_list, 
+                    progress_callback, 
+                    cancel_event,
+                    )
+        else:
+            report(0, 2)
+            fs = FocusStacker(**focus_stacker_param)
+            focus_image, depth_image = fs.focus_stack(image_list, depth_list)
+            check_cancel()
+            report(1, 2)
+            depth_image = clean_depth_image(depth_image, **clean_param)
+            report(2, 2)
+    check_cancel()
+    return focus_image, depth_image
+
+
+def densify_path_depth(sample_depth, points_px, tolerance, spacing):
+    """ Samples the depth along a path and densifies it where the depth between 
+    vertices isn't linear. sample_depth returns the depth at an (N,2) array of points.
+
+    Every segment is sampled every spacing pixels (all segments in one sample_depth
+    call). Sample points are then inserted into the segment, worst first, until 
+    linear interpolation of z between the kept points is within tolerance of the 
+    sampled depth everywhere. Returns the (M,2) path points and (M,) z values, which 
+    include all the original vertices.
+    """
+    points_px = np.asarray(points_px, dtype=np.float64).reshape(-1, 2)
+    if len(points_px) < 2:
+        return points_px.copy(), sample_depth(points_px)
+    lengths = np.linalg.norm(np.diff(points_px, axis=0), axis=1)
+    num_samples = np.maximum(np.ceil(lengths/spacing).astype(int), 1)
+    seg_index = np.repeat(np.arange(lengths.size), num_samples)
+    seg_start = np.cumsum(num_samples) - num_samples
+    t = (np.arange(seg_index.size) - seg_start[seg_index])/num_samples[seg_index]
+    samples = points_px[seg_index] + t[:,np.newaxis]*np.diff(points_px, axis=0)[seg_index]
+    samples = np.vstack([samples, points_px[-1:]])
+    z_samples = sample_depth(samples)
+
+    keep = np.zeros(len(samples), dtype=bool)
+    keep[seg_start] = True
+    keep[-1] = True
+    for start, stop in zip(seg_start, np.append(seg_start[1:], len(samples) - 1)):
+        stack = [(start, stop)]
+        while stack:
+            i, j = stack.pop()
+            if j - i < 2:
+                continue
+            s = np.linspace(0.0, 1.0, j - i + 1)[1:-1]
+            z_linear = z_samples[i] + s*(z_samples[j] - z_samples[i])
+            error = np.abs(z_samples[i+1:j] - z_linear)
+            k = int(np.argmax(error))
+            if error[k] > tolerance:
+                k += i + 1
+                keep[k] = True
+                stack.append((i, k))
+                stack.append((k, j))
+    return samples[keep], z_samples[keep]
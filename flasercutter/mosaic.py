@@ -0,0 +1,637 @@
+"""
+Stitched multi-field mosaics of focus stacked tiles.
+
+Specimens larger than one camera field are imaged as a serpentine grid of XY stage positions
+with a focus stack at each. plan_serpentine lays the grid out from the calibrated field size
+and MosaicCollector steps through it. Each tile's place in the mosaic is predicted from the
+commanded stage positions and refined by phase correlation against the overlapping tiles
+already placed, and the tiles are feather blended into weighted accumulators. The finished
+focus and depth mosaics are normalized from those. Everything is held in TiledArrays, memory
+mapped files stored tile by tile, so only the region being touched is paged in whatever the
+size of the mosaic:
+
+    flaser_mosaic/
+        mosaic.json
+        focus.bin
+        depth.bin
+        focus_sum.bin
+        ...
+
+Mosaic pixels are the camera pixels of one field extended over the whole specimen. px_to_mm
+converts them to absolute work coordinates using the calibration from the nearest tile, so
+cut paths can be drawn over the whole mosaic.
+
+"""
+import os
+import json
+import time
+import cv2
+import numpy as np
+
+from .image_stack_collector import densify_path_depth
+
+
+def field_size_mm(calibration, image_size):
+    """ Returns the (width, height) in mm of a camera field of image_size (width, height)
+    px, measured between the midpoints of opposite edges. The camera is assumed to be
+    roughly aligned with the stage axes.
+    """
+    width, height = image_size
+    edge_px = np.array([
+        (0.0, 0.5*height),
+        (width, 0.5*height),
+        (0.5*width, 0.0),
+        (0.5*width, height),
+        ])
+    edge_mm = calibration.px_to_mm(edge_px)
+    return (
+            float(np.linalg.norm(edge_mm[1] - edge_mm[0])),
+            float(np.linalg.norm(edge_mm[3] - edge_mm[2])),
+            )
+
+
+def plan_serpentine(center_mm, size_mm, field_mm, overlap):
+    """ Returns the list of tiles covering a size_mm (width, height) region centered on
+    center_mm with fields of field_mm overlapping by the fraction overlap. Each tile is a
+    dict with its 'index' in acquisition order, grid 'row' and 'col' and 'stage' (x,y)
+    position. Rows are traversed in alternating directions so every move is one step.
+    """
+    if not 0.0 <= overlap < 1.0:
+        raise ValueError('overlap must be in [0,1)')
+    num_list = []
+    for size, field in zip(size_mm, field_mm):
+        step = field*(1.0 - overlap)
+        num_list.append(max(int(np.ceil((size - field)/step - 1.0e-9)) + 1, 1))
+    num_cols, num_rows = num_list
+    step_x, step_y = (field*(1.0 - overlap) for field in field_mm)
+    x_vals = center_mm[0] + (np.arange(num_cols) - 0.5*(num_cols - 1))*step_x
+    y_vals = center_mm[1] + (np.arange(num_rows) - 0.5*(num_rows - 1))*step_y
+    tiles = []
+    for row, y in enumerate(y_vals):
+        cols = range(num_cols) if row % 2 == 0 else reversed(range(num_cols))
+        for col in cols:
+            tiles.append({
+                'index' : len(tiles),
+                'row'   : row,
+                'col'   : col,
+                'stage' : (float(x_vals[col]), float(y)),
+                })
+    return tiles
+
+
+def stage_to_px_matrix(calibration, image_size):
+    """ Returns the 2x2 matrix taking a stage displacement (mm) to the displacement of a
+    tile in the mosaic (px), from the calibration linearized at the field center.
+    """
+    cx, cy = 0.5*image_size[0], 0.5*image_size[1]
+    p = calibration.px_to_mm(np.array([(cx, cy), (cx + 1.0, cy), (cx, cy + 1.0)]))
+    px_to_mm = np.column_stack((p[1] - p[0], p[2] - p[0]))
+    return np.linalg.inv(px_to_mm)
+
+
+def feather_weights(height, width, feather):
+    """ Blending weights for a tile, ramping linearly from the edges over feather px. """
+    wy = np.minimum(np.arange(height) + 1.0, np.arange(height, 0, -1.0))
+    wx = np.minimum(np.arange(width) + 1.0, np.arange(width, 0, -1.0))
+    wy = np.minimum(wy/max(feather, 1), 1.0)
+    wx = np.minimum(wx/max(feather, 1), 1.0)
+    return np.outer(wy, wx).astype(np.float32)
+
+
+class TiledArray:
+
+    """ Image array (height, width[, channels]) stored as square tiles in a memory mapped
+    file, so reading or writing a region only touches the pages of the tiles it overlaps.
+    """
+
+    DEFAULT_TILE_SIZE = 256
+
+    def __init__(self, filename, shape, dtype, tile_size=DEFAULT_TILE_SIZE, mode='w+'):
+        self.filename = filename
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.tile_size = tile_size
+        height, width = self.shape[:2]
+        self.grid_shape = (-(-height//tile_size), -(-width//tile_size))
+        self.data = np.memmap(
+                filename,
+                dtype=self.dtype,
+                mode=mode,
+                shape=self.grid_shape + (tile_size, tile_size) + self.shape[2:],
+                )
+
+    def regions(self, y0, y1, x0, x1):
+        """ Yields (tile_row, tile_col, tile slices, region slices) covering rows y0:y1
+        and columns x0:x1.
+        """
+        size = self.tile_size
+        for row in range(y0//size, (y1 - 1)//size + 1):
+            ty0, ty1 = max(y0 - row*size, 0), min(y1 - row*size, size)
+            for col in range(x0//size, (x1 - 1)//size + 1):
+                tx0, tx1 = max(x0 - col*size, 0), min(x1 - col*size, size)
+                tile_slices = (slice(ty0, ty1), slice(tx0, tx1))
+                region_slices = (
+                        slice(row*size + ty0 - y0, row*size + ty1 - y0),
+                        slice(col*size + tx0 - x0, col*size + tx1 - x0),
+                        )
+                yield row, col, tile_slices, region_slices
+
+    def read(self, y0, y1, x0, x1):
+        region = np.empty((y1 - y0, x1 - x0) + self.shape[2:], dtype=self.dtype)
+        for row, col, tile_slices, region_slices in self.regions(y0, y1, x0, x1):
+            region[region_slices] = self.data[(row, col) + tile_slices]
+        return region
+
+    def write(self, y0, x0, values):
+        y1, x1 = y0 + values.shape[0], x0 + values.shape[1]
+        for row, col, tile_slices, region_slices in self.regions(y0, y1, x0, x1):
+            self.data[(row, col) + tile_slices] = values[region_slices]
+
+    def add(self, y0, x0, values):
+        y1, x1 = y0 + values.shape[0], x0 + values.shape[1]
+        for row, col, tile_slices, region_slices in self.regions(y0, y1, x0, x1):
+            self.data[(row, col) + tile_slices] += values[region_slices]
+
+    def take(self, ys, xs):
+        """ Values at integer pixel coordinates ys, xs (arrays of the same shape). """
+        size = self.tile_size
+        return self.data[ys//size, xs//size, ys%size, xs%size]
+
+    def to_array(self):
+        return self.read(0, self.shape[0], 0, self.shape[1])
+
+    def overview(self, factor):
+        """ Returns a copy downsampled (area average) by factor, which must divide the 
+        tile size. It is built one tile at a time so the full resolution array is never 
+        in memory.
+        """
+        if self.tile_size % factor != 0:
+            raise ValueError(f'factor {factor} does not divide tile size {self.tile_size}')
+        size = self.tile_size//factor
+        num_rows, num_cols = self.grid_shape
+        image = np.empty((num_rows*size, num_cols*size) + self.shape[2:], dtype=self.dtype)
+        for row in range(num_rows):
+            for col in range(num_cols):
+                image[row*size:(row+1)*size, col*size:(col+1)*size] = cv2.resize(
+                        self.data[row, col], 
+                        (size, size), 
+                        interpolation=cv2.INTER_AREA,
+                        )
+        height, width = self.shape[:2]
+        return image[:-(-height//factor), :-(-width//factor)]
+
+    def flush(self):
+        self.data.flush()
+
+    def close(self):
+        self.flush()
+        self.data = None
+
+
+class Mosaic:
+
+    FORMAT_NAME = 'flasercutter-mosaic'
+    FORMAT_VERSION = 1
+    HEADER_FILENAME = 'mosaic.json'
+    ARRAY_FILENAMES = {
+            'focus'      : 'focus.bin',
+            'depth'      : 'depth.bin',
+            'focus_sum'  : 'focus_sum.bin',
+            'depth_sum'  : 'depth_sum.bin',
+            'weight_sum' : 'weight_sum.bin',
+            }
+
+    DEFAULT_FEATHER = 64
+    DEFAULT_MIN_OVERLAP = 32
+    DEFAULT_MIN_RESPONSE = 0.1
+    DEFAULT_MAX_CORRECTION = 40.0
+    DEFAULT_MARGIN = 64
+    DEFAULT_DEPTH_TOLERANCE = 0.001
+    DEFAULT_DEPTH_SAMPLE_SPACING = 1.0
+
+    def __init__(self, path, calibration, tiles, field_shape, margin=DEFAULT_MARGIN,
+            tile_size=TiledArray.DEFAULT_TILE_SIZE):
+        """ Creates an empty mosaic for tiles (see plan_serpentine) of field_shape
+        (height, width) px. The mosaic is made large enough for the tiles at their
+        predicted positions plus margin px all round for registration corrections.
+        """
+        self.path = path
+        self.calibration = calibration
+        self.tiles = [dict(tile) for tile in tiles]
+        self.field_shape = tuple(field_shape[:2])
+        self.tile_size = tile_size
+        self.feather = self.DEFAULT_FEATHER
+        self.min_overlap = self.DEFAULT_MIN_OVERLAP
+        self.min_response = self.DEFAULT_MIN_RESPONSE
+        self.max_correction = self.DEFAULT_MAX_CORRECTION
+        self.stage_to_px = stage_to_px_matrix(calibration, self.field_shape[::-1])
+
+        height, width = self.field_shape
+        stage = np.array([tile['stage'] for tile in self.tiles])
+        predicted = (stage - stage[0]) @ self.stage_to_px.T
+        self.origin = margin - predicted.min(axis=0)
+        predicted += self.origin
+        for tile, offset in zip(self.tiles, predicted):
+            tile['predicted'] = [float(val) for val in offset]
+            tile['offset'] = None
+            tile['response'] = None
+        self.shape = (
+                int(np.ceil(predicted[:,1].max())) + height + margin,
+                int(np.ceil(predicted[:,0].max())) + width + margin,
+                )
+        self.finished = False
+        self.tile_images = {}
+        self.windows = {}
+        self.weights = None
+        self.arrays = {}
+        os.makedirs(path, exist_ok=True)
+        self.create_arrays('w+')
+
+    @classmethod
+    def load(cls, path, calibration):
+        """ Opens a finished mosaic read only. """
+        with open(os.path.join(path, cls.HEADER_FILENAME), 'r') as f:
+            header = json.load(f)
+        if header.get('format') != cls.FORMAT_NAME:
+            raise ValueError(f'{path} is not a mosaic')
+        if not header.get('finished'):
+            raise ValueError(f'{path} is not finished')
+        mosaic = cls.__new__(cls)
+        mosaic.path = path
+        mosaic.calibration = calibration
+        mosaic.tiles = header['tiles']
+        mosaic.field_shape = tuple(header['field_shape'])
+        mosaic.shape = tuple(header['shape'])
+        mosaic.tile_size = header['tile_size']
+        mosaic.finished = True
+        mosaic.arrays = {}
+        mosaic.create_arrays('r')
+        return mosaic
+
+    def create_arrays(self, mode):
+        height, width = self.shape
+        shapes = {
+                'focus'      : ((height, width, 3), np.uint8),
+                'depth'      : ((height, width), np.float32),
+                'focus_sum'  : ((height, width, 3), np.float32),
+                'depth_sum'  : ((height, width), np.float32),
+                'weight_sum' : ((height, width), np.float32),
+                }
+        names = ['focus', 'depth'] if self.finished else list(shapes)
+        for name in names:
+            shape, dtype = shapes[name]
+            filename = os.path.join(self.path, self.ARRAY_FILENAMES[name])
+            self.arrays[name] = TiledArray(filename, shape, dtype, self.tile_size, mode)
+
+    @property
+    def focus(self):
+        return self.arrays['focus']
+
+    @property
+    def depth(self):
+        return self.arrays['depth']
+
+    @property
+    def num_added(self):
+        return sum(1 for tile in self.tiles if tile['offset'] is not None)
+
+    @property
+    def header(self):
+        return {
+                'format'      : self.FORMAT_NAME,
+                'version'     : self.FORMAT_VERSION,
+                'shape'       : list(self.shape),
+                'field_shape' : list(self.field_shape),
+                'tile_size'   : self.tile_size,
+                'finished'    : self.finished,
+                'tiles'       : self.tiles,
+                }
+
+    def overview(self, max_size):
+        """ Returns (image, factor), the focus mosaic downsampled by the smallest power
+        of two factor which brings it within max_size px on its longest side.
+        """
+        factor = 1
+        while max(self.shape)/factor > max_size and factor < self.tile_size:
+            factor *= 2
+        return self.focus.overview(factor), factor
+
+    def save_header(self):
+        with open(os.path.join(self.path, self.HEADER_FILENAME), 'w') as f:
+            json.dump(self.header, f, indent=2)
+
+    # Registration
+    # ---------------------------------------------------------------------------------------------
+
+    def neighbours(self, tile):
+        """ Tiles already placed which are next to tile in the grid. """
+        rval = []
+        for other in self.tiles:
+            if other['offset'] is None or other['index'] not in self.tile_images:
+                continue
+            if abs(other['row'] - tile['row']) + abs(other['col'] - tile['col']) == 1:
+                rval.append(other)
+        return rval
+
+    def get_window(self, shape):
+        try:
+            window = self.windows[shape]
+        except KeyError:
+            window = cv2.createHanningWindow(shape[::-1], cv2.CV_32F)
+            self.windows[shape] = window
+        return window
+
+    def register(self, tile, gray):
+        """ Returns the (x,y) offset of tile in the mosaic and the phase correlation
+        response (None if no neighbour could be matched).
+
+        For each placed neighbour the offset is predicted from the commanded stage
+        displacement between them and the overlapping regions are phase correlated to
+        correct it. Corrections with a weak response or larger than max_correction are
+        rejected and the estimates are averaged weighted by response. Without an
+        accepted match the offset is the stage prediction alone.
+        """
+        height, width = self.field_shape
+        stage = np.array(tile['stage'])
+        estimates, responses, predictions = [], [], []
+        for other in self.neighbours(tile):
+            offset_other = np.array(other['offset'])
+            predicted = offset_other + self.stage_to_px @ (stage - np.array(other['stage']))
+            predictions.append(predicted)
+            shift = np.round(predicted - offset_other).astype(int)
+            x0, x1 = max(shift[0], 0), min(shift[0] + width, width)
+            y0, y1 = max(shift[1], 0), min(shift[1] + height, height)
+            if x1 - x0 < self.min_overlap or y1 - y0 < self.min_overlap:
+                continue
+            region_other = self.tile_images[other['index']][y0:y1, x0:x1]
+            region_tile = gray[y0-shift[1]:y1-shift[1], x0-shift[0]:x1-shift[0]]
+            window = self.get_window(region_tile.shape)
+            # Content at u in the tile's region is at u + d in the neighbour's
+            d, response = cv2.phaseCorrelate(region_tile, region_other, window)
+            estimate = offset_other + shift + np.array(d)
+            if response < self.min_response:
+                continue
+            if np.linalg.norm(estimate - predicted) > self.max_correction:
+                continue
+            estimates.append(estimate)
+            responses.append(response)
+        if estimates:
+            offset = np.average(estimates, axis=0, weights=responses)
+            return offset, float(max(responses))
+        if predictions:
+            return np.mean(predictions, axis=0), None
+        return np.array(tile['predicted']), None
+
+    # Blending
+    # ---------------------------------------------------------------------------------------------
+
+    def add_tile(self, index, focus_image, depth_image):
+        """ Registers and blends in the focus and depth images of tile index. """
+        if self.finished:
+            raise RuntimeError('mosaic is finished')
+        tile = self.tiles[index]
+        if focus_image.shape[:2] != self.field_shape:
+            raise ValueError(f'tile shape {focus_image.shape[:2]} does not match mosaic')
+        gray = cv2.cvtColor(focus_image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        offset, response = self.register(tile, gray)
+        height, width = self.field_shape
+        max_offset = (self.shape[1] - width, self.shape[0] - height)
+        x0, y0 = (int(np.clip(np.round(val), 0, n)) for val, n in zip(offset, max_offset))
+        tile['offset'] = [x0, y0]
+        tile['response'] = response
+
+        if self.weights is None:
+            self.weights = feather_weights(height, width, self.feather)
+        weights = self.weights
+        self.arrays['focus_sum'].add(y0, x0, focus_image*weights[:,:,np.newaxis])
+        self.arrays['depth_sum'].add(y0, x0, depth_image*weights)
+        self.arrays['weight_sum'].add(y0, x0, weights)
+
+        # Only the row being acquired and the one before can be neighbours of later tiles
+        self.tile_images[index] = gray
+        row = tile['row']
+        for other in self.tiles:
+            if other['index'] in self.tile_images and other['row'] < row - 1:
+                del self.tile_images[other['index']]
+        self.save_header()
+        return tile
+
+    def finish(self):
+        """ Normalizes the accumulators into the focus and depth mosaics, one row of
+        storage tiles at a time. Pixels no tile covered are black with nan depth.
+        """
+        focus_sum = self.arrays['focus_sum'].data
+        depth_sum = self.arrays['depth_sum'].data
+        weight_sum = self.arrays['weight_sum'].data
+        for row in range(self.focus.grid_shape[0]):
+            weight = weight_sum[row]
+            covered = weight > 0.0
+            safe_weight = np.where(covered, weight, 1.0)
+            focus = focus_sum[row]/safe_weight[...,np.newaxis]
+            self.focus.data[row] = np.clip(np.round(focus), 0, 255).astype(np.uint8)
+            self.depth.data[row] = np.where(covered, depth_sum[row]/safe_weight, np.nan)
+        for name in ('focus_sum', 'depth_sum', 'weight_sum'):
+            array = self.arrays.pop(name)
+            array.close()
+            os.remove(array.filename)
+        self.focus.flush()
+        self.depth.flush()
+        self.correct_stage_positions()
+        self.finished = True
+        self.tile_images = {}
+        self.save_header()
+
+    # Coordinates and depth
+    # ---------------------------------------------------------------------------------------------
+
+    def correct_stage_positions(self):
+        """ Sets each tile's 'stage_registered' position, the commanded position
+        corrected by how far registration moved the tile from its prediction. The
+        corrections are relative to their mean, as only the stage errors between tiles
+        can be seen.
+        """
+        placed = [tile for tile in self.tiles if tile['offset'] is not None]
+        if not placed:
+            return
+        residual = np.array([tile['offset'] for tile in placed], dtype=np.float64)
+        residual -= np.array([tile['predicted'] for tile in placed])
+        residual -= residual.mean(axis=0)
+        correction = np.linalg.solve(self.stage_to_px, residual.T).T
+        for tile, delta in zip(placed, correction):
+            tile['stage_registered'] = [float(val) for val in np.array(tile['stage']) + delta]
+
+    def nearest_tiles(self, points_px):
+        """ Index of the placed tile whose center is nearest each (x,y) mosaic point. """
+        placed = [tile for tile in self.tiles if tile['offset'] is not None]
+        if not placed:
+            raise RuntimeError('no tiles in mosaic')
+        height, width = self.field_shape
+        centers = np.array([tile['offset'] for tile in placed]) + (0.5*width, 0.5*height)
+        dist = np.linalg.norm(points_px[:,np.newaxis,:] - centers[np.newaxis,:,:], axis=2)
+        return np.array([tile['index'] for tile in placed])[np.argmin(dist, axis=1)]
+
+    def px_to_mm(self, points_px):
+        """ Converts an (N,2) array of mosaic points (px) to absolute work coordinates
+        (mm) through the calibration of the nearest tile.
+        """
+        points_px = np.asarray(points_px, dtype=np.float64).reshape(-1, 2)
+        nearest = self.nearest_tiles(points_px)
+        points_mm = np.empty_like(points_px)
+        for index in np.unique(nearest):
+            tile = self.tiles[index]
+            mask = nearest == index
+            stage = np.array(tile.get('stage_registered', tile['stage']))
+            tile_px = points_px[mask] - np.array(tile['offset'])
+            points_mm[mask] = stage + self.calibration.px_to_mm(tile_px)
+        return points_mm
+
+    def sample_depth(self, points_px):
+        """ Bilinearly interpolated depth at an (N,2) array of (x,y) mosaic points. Points
+        outside the mosaic take the depth of the nearest edge pixel.
+        """
+        points_px = np.asarray(points_px, dtype=np.float64).reshape(-1, 2)
+        height, width = self.shape
+        x = np.clip(points_px[:,0], 0, width - 1)
+        y = np.clip(points_px[:,1], 0, height - 1)
+        x0 = np.minimum(np.floor(x).astype(int), width - 2)
+        y0 = np.minimum(np.floor(y).astype(int), height - 2)
+        fx, fy = x - x0, y - y0
+        depth = self.depth
+        top = (1.0 - fx)*depth.take(y0, x0) + fx*depth.take(y0, x0 + 1)
+        bottom = (1.0 - fx)*depth.take(y0 + 1, x0) + fx*depth.take(y0 + 1, x0 + 1)
+        return (1.0 - fy)*top + fy*bottom
+
+    def sample_path_depth(self, points_px, tolerance=DEFAULT_DEPTH_TOLERANCE,
+            spacing=DEFAULT_DEPTH_SAMPLE_SPACING):
+        return densify_path_depth(self.sample_depth, points_px, tolerance, spacing)
+
+
+class MosaicCollector:
+
+    """ Steps through the tiles of a mosaic: move to the tile, wait for grbl to report
+    idle there, run a focus stack and move on. The focus and depth images of each tile
+    are computed while the next is acquired and may come back out of order, so they are
+    held until they can be added in acquisition order (registration needs the
+    neighbours placed first).
+    """
+
+    DEFAULT_OVERLAP = 0.2
+    DEFAULT_SETTLING_TIME = 0.2
+    DEFAULT_POSITION_TOLERANCE = 0.0005
+    DEFAULT_XY_DECIMALS = 3
+
+    def __init__(self):
+        self.overlap = self.DEFAULT_OVERLAP
+        self.settling_time = self.DEFAULT_SETTLING_TIME
+        self.position_tolerance = self.DEFAULT_POSITION_TOLERANCE
+        self.mosaic = None
+        self.tiles = []
+        self.index = None
+        self.stacking = False
+        self.target = None
+        self.t_idle = None
+        self.pending = {}
+        self.num_added = 0
+
+    @property
+    def running(self):
+        return self.index is not None or self.waiting
+
+    @property
+    def acquiring(self):
+        return self.index is not None
+
+    @property
+    def waiting(self):
+        """ True when every tile has been acquired but not all have been added. """
+        return self.mosaic is not None and self.index is None and not self.mosaic.finished
+
+    @property
+    def ready(self):
+        return self.mosaic is not None and self.mosaic.finished
+
+    @property
+    def moving(self):
+        return self.acquiring and not self.stacking and self.t_idle is None
+
+    @property
+    def num_tiles(self):
+        return len(self.tiles)
+
+    def start(self, path, calibration, field_shape, center_mm, size_mm):
+        """ Plans the mosaic and returns the (x,y) of the first tile to move to. """
+        height, width = field_shape[:2]
+        field_mm = field_size_mm(calibration, (width, height))
+        self.tiles = plan_serpentine(center_mm, size_mm, field_mm, self.overlap)
+        self.mosaic = Mosaic(path, calibration, self.tiles, (height, width))
+        self.pending = {}
+        self.num_added = 0
+        self.stacking = False
+        return self.advance(0)
+
+    def open(self, path, calibration):
+        """ Opens a previously finished mosaic, e.g. to cut from it. """
+        self.stop()
+        self.mosaic = Mosaic.load(path, calibration)
+        self.tiles = self.mosaic.tiles
+        self.num_added = self.mosaic.num_added
+
+    def stop(self):
+        self.index = None
+        self.stacking = False
+        self.target = None
+        self.t_idle = None
+        self.pending = {}
+        if self.mosaic is not None and not self.mosaic.finished:
+            self.mosaic = None
+
+    def advance(self, index):
+        self.index = index
+        x, y = self.tiles[index]['stage']
+        self.target = (round(x, self.DEFAULT_XY_DECIMALS), round(y, self.DEFAULT_XY_DECIMALS))
+        self.t_idle = None
+        return self.target
+
+    def update_motion(self, idle, x, y, now=None):
+        """ Called with each grbl status report, see Autofocus.update_motion. """
+        if not self.moving or not idle or x is None or y is None:
+            return
+        error = max(abs(x - self.target[0]), abs(y - self.target[1]))
+        if error <= self.position_tolerance:
+            self.t_idle = time.time() if now is None else now
+
+    def settled_at(self, timestamp):
+        if not self.acquiring or self.stacking or self.t_idle is None:
+            return False
+        return (timestamp - self.t_idle) > self.settling_time
+
+    def begin_tile(self):
+        self.stacking = True
+        return self.index
+
+    def end_tile(self):
+        """ Finishes the focus stack of the current tile. Returns the (x,y) of the next
+        tile to move to or None once every tile has been acquired.
+        """
+        self.stacking = False
+        if self.index + 1 < self.num_tiles:
+            return self.advance(self.index + 1)
+        self.index = None
+        self.target = None
+        return None
+
+    def add_result(self, index, focus_image, depth_image):
+        """ Adds the focus and depth images of tile index once all earlier tiles have
+        been added. Returns True when the mosaic has been finished.
+        """
+        if self.mosaic is None or self.mosaic.finished:
+            return False
+        self.pending[index] = (focus_image, depth_image)
+        while self.num_added in self.pending:
+            focus_image, depth_image = self.pending.pop(self.num_added)
+            self.mosaic.add_tile(self.num_added, focus_image, depth_image)
+            self.num_added += 1
+        if self.num_added == self.num_tiles:
+            self.mosaic.finish()
+            return True
+        return False
@@ -0,0 +1,165 @@
+"""
+Lightweight instrumentation for the hot paths.
+
+Timing spans, counters and gauges are recorded into fixed size ring buffers so the cost of
+recording is a few array writes and memory use doesn't grow while the app runs. The module
+level monitor is shared by the app, GrblSender and the stack computations, and its contents
+can be summarized (rate, p50/p99) for display or exported as a Chrome trace (load in
+chrome://tracing or https://ui.perfetto.dev) for offline analysis.
+
+"""
+import json
+import time
+import functools
+import threading
+import contextlib
+import numpy as np
+
+
+class EventRing:
+
+    """ Fixed size ring of (timestamp, value) events. """
+
+    def __init__(self, size):
+        self.times = np.zeros((size,))
+        self.values = np.zeros((size,))
+        self.threads = np.zeros((size,), dtype=np.int64)
+        self.count = 0
+
+    @property
+    def size(self):
+        return self.times.size
+
+    def append(self, t, value, thread_id=0):
+        index = self.count % self.size
+        self.times[index] = t
+        self.values[index] = value
+        self.threads[index] = thread_id
+        self.count += 1
+
+    def get(self):
+        """ Returns (times, values, threads) of the events held, oldest first. """
+        num = min(self.count, self.size)
+        order = (np.arange(self.count - num, self.count)) % self.size
+        return self.times[order], self.values[order], self.threads[order]
+
+
+class PerfMonitor:
+
+    DEFAULT_RING_SIZE = 2048
+    DEFAULT_RATE_WINDOW = 1.0
+
+    KIND_SPAN = 'span'
+    KIND_COUNTER = 'counter'
+    KIND_GAUGE = 'gauge'
+
+    def __init__(self, ring_size=DEFAULT_RING_SIZE):
+        self.ring_size = ring_size
+        self.rings = {}
+        self.kinds = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.enabled = True
+        self.t0 = time.perf_counter()
+
+    def get_ring(self, name, kind):
+        try:
+            ring = self.rings[name]
+        except KeyError:
+            ring = EventRing(self.ring_size)
+            self.rings[name] = ring
+            self.kinds[name] = kind
+            self.totals[name] = 0
+        return ring
+
+    def record(self, name, kind, t, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            ring = self.get_ring(name, kind)
+            ring.append(t, value, threading.get_ident())
+            self.totals[name] += value if kind == self.KIND_COUNTER else 1
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """ Context manager recording the duration of its body. """
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, self.KIND_SPAN, t_start, time.perf_counter() - t_start)
+
+    def timed(self, name):
+        """ Decorator recording the duration of each call as a span. """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, value=1):
+        self.record(name, self.KIND_COUNTER, time.perf_counter(), value)
+
+    def gauge(self, name, value):
+        self.record(name, self.KIND_GAUGE, time.perf_counter(), value)
+
+    def clear(self):
+        with self.lock:
+            self.rings = {}
+            self.kinds = {}
+            self.totals = {}
+
+    def stats(self, name, window=DEFAULT_RATE_WINDOW):
+        """ Returns a summary dict for name or None if nothing has been recorded. For spans
+        the percentiles are of the durations, for gauges of the values. rate is events per
+        second over the last window seconds.
+        """
+        with self.lock:
+            if name not in self.rings:
+                return None
+            times, values, threads = self.rings[name].get()
+            kind = self.kinds[name]
+            total = self.totals[name]
+        now = time.perf_counter()
+        recent = times > (now - window)
+        rval = {'kind': kind, 'total': total}
+        if kind == self.KIND_COUNTER:
+            rval['rate'] = float(values[recent].sum()/window)
+        else:
+            rval['rate'] = float(recent.sum()/window)
+            rval['last'] = float(values[-1])
+            rval['p50'] = float(np.percentile(values, 50))
+            rval['p99'] = float(np.percentile(values, 99))
+        return rval
+
+    def summary(self, window=DEFAULT_RATE_WINDOW):
+        return {name: self.stats(name, window) for name in list(self.rings)}
+
+    def chrome_trace(self):
+        """ Returns the recorded events in Chrome trace event format. """
+        events = []
+        with self.lock:
+            items = [(name, self.kinds[name], ring.get()) for name, ring in self.rings.items()]
+        for name, kind, (times, values, threads) in items:
+            ts_array = 1.0e6*(times - self.t0)
+            for ts, value, tid in zip(ts_array, values, threads):
+                if kind == self.KIND_SPAN:
+                    event = {'name': name, 'ph': 'X', 'ts': ts, 'dur': 1.0e6*value}
+                elif kind == self.KIND_COUNTER:
+                    event = {'name': name, 'ph': 'i', 's': 't', 'ts': ts, 'args': {'n': value}}
+                else:
+                    event = {'name': name, 'ph': 'C', 'ts': ts, 'args': {name: value}}
+                event['pid'] = 0
+                event['tid'] = int(tid)
+                events.append(event)
+        events.sort(key=lambda item: item['ts'])
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+monitor = PerfMonitor()
@@ -0,0 +1,209 @@
+"""
+Headless reprocessing of saved focus stacks (see stack_archive) with parameter sweeps.
+
+Every combination of the given parameter values is run as a separate job on a process pool.
+Each job opens the archive itself, streams the step images from disk (memory mapped) and writes
+the focus image, depth image and timing for its configuration to the output directory.
+
+Example:
+
+    flaser-reprocess ~/focus_stack.stack --laplacian-kernel-size 3 5 7 --median-filter-size 11 21
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import concurrent.futures
+
+import cv2
+import numpy as np
+
+from .focus_stacker import FocusStacker
+from .frame_reducer import REDUCER_DICT
+from .frame_reducer import create_reducer
+from .stack_archive import StackArchive
+from .tile_pipeline import clean_depth_image
+from .image_stack_collector import ImageStackCollector
+
+
+# --reducer value for the median images stored in the archive (reducer None)
+STORED_REDUCER = 'stored'
+
+SWEEP_PARAM_NAMES = [
+        'laplacian_kernel_size',
+        'gaussian_blur_kernel_size',
+        'median_filter_size',
+        'sgolay_window_size',
+        'sgolay_poly_order',
+        'reducer',
+        ]
+
+SWEEP_PARAM_ABBREV = {
+        'laplacian_kernel_size'     : 'lap',
+        'gaussian_blur_kernel_size' : 'blur',
+        'median_filter_size'        : 'med',
+        'sgolay_window_size'        : 'sgw',
+        'sgolay_poly_order'         : 'sgo',
+        'reducer'                   : 'red',
+        }
+
+
+def get_sweep_configs(args):
+    """ Returns a list of config dicts, one for every combination of parameter values. """
+    values = [getattr(args, name) for name in SWEEP_PARAM_NAMES]
+    return [dict(zip(SWEEP_PARAM_NAMES, combo)) for combo in itertools.product(*values)]
+
+
+def get_config_name(config):
+    return '_'.join(f'{SWEEP_PARAM_ABBREV[name]}{config[name]}' for name in SWEEP_PARAM_NAMES)
+
+
+def iter_step_images(archive, reducer):
+    """ Yields (depth, image) for each step. With reducer None the stored median images
+    are used, otherwise the raw frames are streamed from disk through the reducer.
+    """
+    for step, depth in enumerate(archive.depths):
+        if reducer is None:
+            image = archive.median(step)
+        else:
+            step_reducer = create_reducer(reducer)
+            for frame in archive.iter_frames(step):
+                step_reducer.add(frame)
+            image = step_reducer.result()
+        if image is None:
+            raise ValueError(f'no image for step {step} with reducer {reducer}')
+        yield depth, np.asarray(image)
+
+
+def run_config(archive_path, config, output_dir):
+    """ Focus stacks and cleans the depth image for a single configuration and writes
+    the results. Returns a dict with the config, output files and timing.
+    """
+    timing = {}
+    archive = StackArchive(archive_path)
+    t0 = time.perf_counter()
+    fs = FocusStacker(
+            laplacian_kernel_size=config['laplacian_kernel_size'],
+            gaussian_blur_kernel_size=config['gaussian_blur_kernel_size'],
+            )
+    t_load = 0.0
+    t_stack = 0.0
+    t_last = time.perf_counter()
+    for depth, image in iter_step_images(archive, config['reducer']):
+        t_now = time.perf_counter()
+        t_load += t_now - t_last
+        fs.push(image, np.float64(depth))
+        t_last = time.perf_counter()
+        t_stack += t_last - t_now
+    focus_image, depth_image = fs.result()
+    timing['load'] = t_load
+    timing['focus_stack'] = t_stack
+
+    t1 = time.perf_counter()
+    depth_image = clean_depth_image(
+            depth_image,
+            config['median_filter_size'],
+            config['sgolay_window_size'],
+            config['sgolay_poly_order'],
+            )
+    timing['clean_depth'] = time.perf_counter() - t1
+    timing['total'] = time.perf_counter() - t0
+
+    name = get_config_name(config)
+    focus_file = os.path.join(output_dir, f'{name}_focus.png')
+    depth_file = os.path.join(output_dir, f'{name}_depth.npy')
+    depth_png_file = os.path.join(output_dir, f'{name}_depth.png')
+    cv2.imwrite(focus_file, focus_image)
+    np.save(depth_file, depth_image)
+    depth_u8 = cv2.normalize(depth_image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    cv2.imwrite(depth_png_file, depth_u8)
+    return {
+            'config'     : config,
+            'focus_file' : focus_file,
+            'depth_file' : depth_file,
+            'timing'     : timing,
+            }
+
+
+def reprocess_main(argv=None):
+    defaults = ImageStackCollector
+    stacker_defaults = defaults.DEFAULT_FOCUS_STACKER_PARAM
+    parser = argparse.ArgumentParser(description='reprocess a saved focus stack archive')
+    parser.add_argument('archive', help='path to stack archive')
+    parser.add_argument('-o', '--output-dir', default=None,
+            help='output directory (default <archive>_reprocessed)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+            help='number of worker processes')
+    parser.add_argument('--laplacian-kernel-size', type=int, nargs='+',
+            default=[stacker_defaults['laplacian_kernel_size']])
+    parser.add_argument('--gaussian-blur-kernel-size', type=int, nargs='+',
+            default=[stacker_defaults['gaussian_blur_kernel_size']])
+    parser.add_argument('--median-filter-size', type=int, nargs='+',
+            default=[defaults.DEFAULT_MEDIAN_FILTER_SIZE])
+    parser.add_argument('--sgolay-window-size', type=int, nargs='+',
+            default=[defaults.DEFAULT_SGOLAY_WINDOW_SIZE])
+    parser.add_argument('--sgolay-poly-order', type=int, nargs='+',
+            default=[defaults.DEFAULT_SGOLAY_POLY_ORDER])
+    parser.add_argument('--reducer', nargs='+', default=[STORED_REDUCER],
+            choices=[STORED_REDUCER] + list(REDUCER_DICT),
+            help=f'recompute step images from the raw frames ({STORED_REDUCER} for the '
+                 f'stored medians, default: {STORED_REDUCER})')
+    args = parser.parse_args(argv)
+    args.reducer = [None if name == STORED_REDUCER else name for name in args.reducer]
+
+    archive_path = os.path.abspath(os.path.expanduser(args.archive))
+    try:
+        archive = StackArchive(archive_path)
+    except (OSError, ValueError) as err:
+        parser.error(f'unable to open archive: {err}')
+    if any(name is not None for name in args.reducer):
+        missing = [step for step in range(archive.num_steps) if not archive.num_frames(step)]
+        if missing:
+            parser.error(
+                    f'--reducer needs raw frames but {len(missing)} of {archive.num_steps} '
+                    f'steps have none (record the stack, or save it with keep_raw_images '
+                    f'set), use --reducer {STORED_REDUCER} for the stored medians'
+                    )
+    output_dir = args.output_dir
+    if output_dir is None:
+        output_dir = f'{archive_path.rstrip(os.sep)}_reprocessed'
+    os.makedirs(output_dir, exist_ok=True)
+
+    configs = get_sweep_configs(args)
+    print(f'running {len(configs)} configuration(s) on {args.workers} worker(s)')
+    t0 = time.perf_counter()
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        future_to_config = {
+                executor.submit(run_config, archive_path, config, output_dir) : config
+                for config in configs
+                }
+        for future in concurrent.futures.as_completed(future_to_config):
+            config = future_to_config[future]
+            try:
+                result = future.result()
+            except Exception as err:
+                result = {'config': config, 'error': str(err)}
+                print(f'  {get_config_name(config)}: failed, {err}')
+            else:
+                print(f"  {get_config_name(config)}: {result['timing']['total']:0.2f} s")
+            results.append(result)
+
+    summary = {
+            'archive'    : archive_path,
+            'wall_time'  : time.perf_counter() - t0,
+            'results'    : results,
+            }
+    with open(os.path.join(output_dir, 'results.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(f"done in {summary['wall_time']:0.2f} s, results in {output_dir}")
+    return 0 if all('error' not in item for item in results) else 1
+
+
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    sys.exit(reprocess_main())
@@ -0,0 +1,216 @@
+"""
+On-disk format for focus stacks.
+
+A stack archive is a directory holding a JSON header and, for every z step, the raw frames
+as one contiguous uint8 binary file plus the reduced (median) image as a .npy file:
+
+    focus_stack.stack/
+        header.json
+        raw_0000.bin
+        median_0000.npy
+        raw_0001.bin
+        ...
+
+Uncompressed raw files are read back with np.memmap so opening a stack is instant and only
+the frames which are touched are paged in. With zlib compression each frame is a separate
+lossless chunk whose offset is recorded in the header, so single frames can still be read
+without decompressing the rest of the step.
+
+"""
+import os
+import json
+import zlib
+import numpy as np
+
+
+class StackArchiveWriter:
+
+    FORMAT_NAME = 'flasercutter-stack'
+    FORMAT_VERSION = 1
+    HEADER_FILENAME = 'header.json'
+    COMPRESSION_NONE = None
+    COMPRESSION_ZLIB = 'zlib'
+    DEFAULT_ZLIB_LEVEL = 1
+
+    def __init__(self, path, compression=COMPRESSION_NONE, zlib_level=DEFAULT_ZLIB_LEVEL,
+            metadata=None):
+        if compression not in (self.COMPRESSION_NONE, self.COMPRESSION_ZLIB):
+            raise ValueError(f'unknown compression {compression}')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.compression = compression
+        self.zlib_level = zlib_level
+        self.header = {
+                'format'      : self.FORMAT_NAME,
+                'version'     : self.FORMAT_VERSION,
+                'shape'       : None,
+                'dtype'       : None,
+                'compression' : compression,
+                'metadata'    : metadata if metadata is not None else {},
+                'steps'       : [],
+                }
+        self.step = None
+        self.raw_file = None
+
+    @property
+    def step_index(self):
+        return len(self.header['steps'])
+
+    def begin_step(self, z):
+        if self.step is not None:
+            self.end_step()
+        index = self.step_index
+        self.step = {
+                'z'             : float(z),
+                'raw_file'      : f'raw_{index:04d}.bin',
+                'median_file'   : None,
+                'num_frames'    : 0,
+                'timestamps'    : [],
+                'chunk_offsets' : [],
+                }
+        self.raw_file = open(os.path.join(self.path, self.step['raw_file']), 'wb')
+
+    def add_frame(self, image, timestamp=None):
+        image = np.ascontiguousarray(image)
+        if self.header['shape'] is None:
+            self.header['shape'] = list(image.shape)
+            self.header['dtype'] = image.dtype.str
+        elif list(image.shape) != self.header['shape']:
+            raise ValueError(f'frame shape {image.shape} does not match stack')
+        data = image.tobytes()
+        if self.compression == self.COMPRESSION_ZLIB:
+            data = zlib.compress(data, self.zlib_level)
+        self.step['chunk_offsets'].append(self.raw_file.tell())
+        self.raw_file.write(data)
+        self.step['num_frames'] += 1
+        self.step['timestamps'].append(timestamp)
+
+    def end_step(self, median=None, z=None):
+        if self.step is None:
+            return
+        if z is not None:
+            self.step['z'] = float(z)
+        self.raw_file.close()
+        self.raw_file = None
+        if median is not None:
+            if self.header['shape'] is None:
+                self.header['shape'] = list(median.shape)
+                self.header['dtype'] = median.dtype.str
+            self.step['median_file'] = f'median_{self.step_index:04d}.npy'
+            np.save(os.path.join(self.path, self.step['median_file']), median)
+        self.step['chunk_offsets'].append(
+                os.path.getsize(os.path.join(self.path, self.step['raw_file']))
+                )
+        self.header['steps'].append(self.step)
+        self.step = None
+        self.write_header()
+
+    def write_step(self, z, frames, median=None, timestamps=None):
+        self.begin_step(z)
+        if timestamps is None:
+            timestamps = [None]*len(frames)
+        for image, timestamp in zip(frames, timestamps):
+            self.add_frame(image, timestamp)
+        self.end_step(median)
+
+    def write_header(self):
+        filepath = os.path.join(self.path, self.HEADER_FILENAME)
+        tmp_filepath = f'{filepath}.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump(self.header, f, indent=2)
+        os.replace(tmp_filepath, filepath)
+
+    def close(self):
+        self.end_step()
+        self.write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StackArchive:
+
+    """ Read access to a stack archive. Nothing is loaded until it is asked for. """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, StackArchiveWriter.HEADER_FILENAME), 'r') as f:
+            self.header = json.load(f)
+        if self.header.get('format') != StackArchiveWriter.FORMAT_NAME:
+            raise ValueError(f'{path} is not a stack archive')
+
+    @property
+    def num_steps(self):
+        return len(self.header['steps'])
+
+    @property
+    def depths(self):
+        return [step['z'] for step in self.header['steps']]
+
+    @property
+    def shape(self):
+        return tuple(self.header['shape'])
+
+    @property
+    def dtype(self):
+        return np.dtype(self.header['dtype'])
+
+    @property
+    def compressed(self):
+        return self.header['compression'] is not None
+
+    @property
+    def metadata(self):
+        return self.header['metadata']
+
+    def num_frames(self, step):
+        return self.header['steps'][step]['num_frames']
+
+    def timestamps(self, step):
+        return self.header['steps'][step]['timestamps']
+
+    def frames(self, step):
+        """ Returns all frames of a step as an (n,H,W,C) array. This is a read-only
+        memory map unless the archive is compressed.
+        """
+        info = self.header['steps'][step]
+        filepath = os.path.join(self.path, info['raw_file'])
+        shape = (info['num_frames'],) + self.shape
+        if not self.compressed:
+            if info['num_frames'] == 0:
+                return np.zeros(shape, dtype=self.dtype)
+            return np.memmap(filepath, dtype=self.dtype, mode='r', shape=shape)
+        array = np.empty(shape, dtype=self.dtype)
+        for i in range(info['num_frames']):
+            array[i] = self.frame(step, i)
+        return array
+
+    def frame(self, step, index):
+        """ Returns a single frame reading only its chunk from disk. """
+        info = self.header['steps'][step]
+        filepath = os.path.join(self.path, info['raw_file'])
+        if not self.compressed:
+            return self.frames(step)[index]
+        start = info['chunk_offsets'][index]
+        stop = info['chunk_offsets'][index + 1]
+        with open(filepath, 'rb') as f:
+            f.seek(start)
+            data = zlib.decompress(f.read(stop - start))
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.shape)
+
+    def iter_frames(self, step):
+        for index in range(self.num_frames(step)):
+            yield self.frame(step, index)
+
+    def median(self, step, mmap=True):
+        info = self.header['steps'][step]
+        if info['median_file'] is None:
+            return None
+        filepath = os.path.join(self.path, info['median_file'])
+        return np.load(filepath, mmap_mode='r' if mmap else None)
+
+    def medians(self, mmap=True):
+        return [self.median(step, mmap=mmap) for step in range(self.num_steps)]
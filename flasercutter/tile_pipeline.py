@@ -0,0 +1,151 @@
+import os
+import concurrent.futures
+import numpy as np
+import scipy.ndimage as ndimage
+
+import sgolay2
+from .focus_stacker import FocusStacker
+
+
+def clean_depth_image(depth_image, median_filter_size, sgolay_window_size, sgolay_poly_order):
+    """ Median filter and Savitzky-Golay smooth the raw depth image from the focus stack. """
+    depth_image = ndimage.median_filter(depth_image, median_filter_size)
+    sg2 = sgolay2.SGolayFilter2(window_size=sgolay_window_size, poly_order=sgolay_poly_order)
+    return sg2(depth_image)
+
+
+def focus_and_depth_tile(images, depths, focus_stacker_param, clean_param):
+    """ Focus stack and clean a single (halo padded) tile. """
+    fs = FocusStacker(**focus_stacker_param)
+    focus_image, depth_image = fs.focus_stack(images, depths)
+    if clean_param is not None:
+        depth_image = clean_depth_image(depth_image, **clean_param)
+    return focus_image, depth_image
+
+
+def clean_depth_tile(depth_image, clean_param):
+    """ Clean a single (halo padded) tile of the depth image. """
+    return clean_depth_image(depth_image, **clean_param)
+
+
+class TilePipeline:
+
+    """ Tiled, parallel version of the focus stack and depth map clean up.
+
+    The frame is split into tiles which are padded with a halo wide enough that every
+    stage - blur, laplacian, argmax, median filter and Savitzky-Golay filter - sees the
+    same neighbourhood for the tile's core pixels as it would on the full frame. Tiles
+    on the edge of the frame are not padded past it so the filters apply their own
+    border handling exactly as in the serial path. The cores are then stitched back
+    together, giving the same result as running the stages on the whole frame.
+    """
+
+    DEFAULT_TILE_SIZE = 256
+    DEFAULT_USE_PROCESSES = False
+
+    def __init__(self, focus_stacker_param, median_filter_size, sgolay_window_size,
+            sgolay_poly_order, tile_size=DEFAULT_TILE_SIZE, max_workers=None,
+            use_processes=DEFAULT_USE_PROCESSES):
+        self.focus_stacker_param = focus_stacker_param
+        self.clean_param = {
+                'median_filter_size' : median_filter_size,
+                'sgolay_window_size' : sgolay_window_size,
+                'sgolay_poly_order'  : sgolay_poly_order,
+                }
+        self.tile_size = tile_size
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        self.use_processes = use_processes
+
+    @property
+    def focus_halo(self):
+        blur_size = self.focus_stacker_param.get('gaussian_blur_kernel_size', 5)
+        laplacian_size = max(self.focus_stacker_param.get('laplacian_kernel_size', 5), 3)
+        return blur_size//2 + laplacian_size//2
+
+    @property
+    def clean_halo(self):
+        return self.clean_param['median_filter_size']//2 + self.clean_param['sgolay_window_size']//2
+
+    def get_executor(self):
+        if self.use_processes:
+            return concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        else:
+            return concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+    @staticmethod
+    def completed(futures, progress_callback=None, cancel_event=None):
+        """ Yields futures as they complete, reporting progress and cancelling the 
+        outstanding tiles if cancel_event is set. 
+        """
+        num_total = len(futures)
+        for num_done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            if cancel_event is not None and cancel_event.is_set():
+                for item in futures:
+                    item.cancel()
+                raise concurrent.futures.CancelledError()
+            yield future
+            if progress_callback is not None:
+                progress_callback(num_done, num_total)
+
+    def tiles(self, shape, halo):
+        """ Yields (core, padded, inner) slice pairs for each tile. core is the tile's
+        region in the frame, padded is the region including the halo and inner is
+        the core's region within the padded tile.
+        """
+        n, m = shape[:2]
+        for i0 in range(0, n, self.tile_size):
+            i1 = min(i0 + self.tile_size, n)
+            p0 = max(i0 - halo, 0)
+            p1 = min(i1 + halo, n)
+            for j0 in range(0, m, self.tile_size):
+                j1 = min(j0 + self.tile_size, m)
+                q0 = max(j0 - halo, 0)
+                q1 = min(j1 + halo, m)
+                core = (slice(i0, i1), slice(j0, j1))
+                padded = (slice(p0, p1), slice(q0, q1))
+                inner = (slice(i0 - p0, i1 - p0), slice(j0 - q0, j1 - q0))
+                yield core, padded, inner
+
+    def focus_and_depth(self, images, depths, progress_callback=None, cancel_event=None):
+        """ Returns the focus image and cleaned depth image for the stack. """
+        shape = images[0].shape
+        focus_image = np.zeros(shape, dtype=images[0].dtype)
+        depth_image = None
+        halo = self.focus_halo + self.clean_halo
+        with self.get_executor() as executor:
+            future_to_tile = {}
+            for core, padded, inner in self.tiles(shape, halo):
+                tile_images = [np.ascontiguousarray(image[padded]) for image in images]
+                future = executor.submit(
+                        focus_and_depth_tile,
+                        tile_images,
+                        depths,
+                        self.focus_stacker_param,
+                        self.clean_param,
+                        )
+                future_to_tile[future] = core, inner
+            for future in self.completed(future_to_tile, progress_callback, cancel_event):
+                core, inner = future_to_tile[future]
+                tile_focus, tile_depth = future.result()
+                if depth_image is None:
+                    depth_image = np.zeros(shape[:2], dtype=tile_depth.dtype)
+                focus_image[core] = tile_focus[inner]
+                depth_image[core] = tile_depth[inner]
+        return focus_image, depth_image
+
+    def clean_depth(self, depth_image, progress_callback=None, cancel_event=None):
+        """ Returns the cleaned version of an already focus stacked depth image. """
+        clean_image = None
+        with self.get_executor() as executor:
+            future_to_tile = {}
+            for core, padded, inner in self.tiles(depth_image.shape, self.clean_halo):
+                tile = np.ascontiguousarray(depth_image[padded])
+                future = executor.submit(clean_depth_tile, tile, self.clean_param)
+                future_to_tile[future] = core, inner
+            for future in self.completed(future_to_tile, progress_callback, cancel_event):
+                core, inner = future_to_tile[future]
+                tile_clean = future.result()
+                if clean_image is None:
+                    clean_image = np.zeros(depth_image.shape, dtype=tile_clean.dtype)
+                clean_image[core] = tile_clean[inner]
+        return clean_image
@@ -0,0 +1,187 @@
+"""
+Toolpath post-processing between the calibrated (mm) cut points and G-code emission.
+
+Dense paths (e.g. traced outlines) are mostly nearly collinear micro-segments. Every one
+of them costs serial bandwidth and a planner slot, and grbl slows down at each junction.
+optimize_toolpath merges exactly collinear moves, optionally replaces runs of points lying
+on a circle with G2/G3 arcs (helical when z changes) and simplifies what remains with 3D
+Ramer-Douglas-Peucker, all within a tolerance in mm of the original path.
+
+"""
+import numpy as np
+
+
+DEFAULT_TOLERANCE = 0.002
+DEFAULT_MIN_ARC_POINTS = 5
+DEFAULT_DECIMALS = 3
+
+MOVE_LINE = 'G1'
+MOVE_ARC_CW = 'G2'
+MOVE_ARC_CCW = 'G3'
+
+
+def point_segment_distance(points, start, end):
+    """ Distance from each of points (n,3) to the segment from start to end. """
+    direction = end - start
+    length_sq = np.dot(direction, direction)
+    if length_sq == 0.0:
+        return np.linalg.norm(points - start, axis=1)
+    t = np.clip(np.dot(points - start, direction)/length_sq, 0.0, 1.0)
+    return np.linalg.norm(points - (start + t[:,np.newaxis]*direction), axis=1)
+
+
+def simplify_rdp(points, tolerance=DEFAULT_TOLERANCE):
+    """ Ramer-Douglas-Peucker simplification of a 3D polyline. Returns the kept points,
+    always including the first and last. No point of the original path is further than
+    tolerance from the simplified one.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 3:
+        return points.copy()
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        dist = point_segment_distance(points[i+1:j], points[i], points[j])
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return points[keep]
+
+
+def merge_collinear(points, tolerance=1.0e-9):
+    """ Removes duplicate points and interior points lying on the segment between their
+    neighbours, so consecutive moves in the same direction become one move.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 3:
+        return points.copy()
+    merged = [points[0]]
+    for i in range(1, len(points) - 1):
+        if np.linalg.norm(points[i] - merged[-1]) <= tolerance:
+            continue
+        dist = point_segment_distance(points[i:i+1], merged[-1], points[i+1])[0]
+        if dist > tolerance:
+            merged.append(points[i])
+    merged.append(points[-1])
+    return np.array(merged)
+
+
+def fit_circle_xy(p0, p1, p2):
+    """ Returns the (center, radius) of the circle through three points in the xy plane
+    or None if they are collinear.
+    """
+    ax, ay = p0[:2]
+    bx, by = p1[:2]
+    cx, cy = p2[:2]
+    d = 2.0*(ax*(by - cy) + bx*(cy - ay) + cx*(ay - by))
+    if abs(d) < 1.0e-12:
+        return None
+    a_sq = ax*ax + ay*ay
+    b_sq = bx*bx + by*by
+    c_sq = cx*cx + cy*cy
+    ux = (a_sq*(by - cy) + b_sq*(cy - ay) + c_sq*(ay - by))/d
+    uy = (a_sq*(cx - bx) + b_sq*(ax - cx) + c_sq*(bx - ax))/d
+    center = np.array([ux, uy])
+    return center, float(np.linalg.norm(p0[:2] - center))
+
+
+def check_arc(points, tolerance):
+    """ Returns (center, clockwise) if points fit a circular arc in xy, with z linear in
+    the arc angle, to within tolerance, else None.
+    """
+    circle = fit_circle_xy(points[0], points[len(points)//2], points[-1])
+    if circle is None:
+        return None
+    center, radius = circle
+    offset = points[:,:2] - center
+    if np.abs(np.linalg.norm(offset, axis=1) - radius).max() > tolerance:
+        return None
+    dtheta = np.diff(np.unwrap(np.arctan2(offset[:,1], offset[:,0])))
+    if not (np.all(dtheta > 0.0) or np.all(dtheta < 0.0)):
+        return None
+    # The chords of the original path bulge from the arc by the sagitta
+    if (radius*(1.0 - np.cos(0.5*np.abs(dtheta)))).max() > tolerance:
+        return None
+    theta = np.concatenate(([0.0], np.cumsum(dtheta)))
+    if abs(theta[-1]) >= 2.0*np.pi:
+        return None
+    z_arc = points[0,2] + (points[-1,2] - points[0,2])*theta/theta[-1]
+    if np.abs(points[:,2] - z_arc).max() > tolerance:
+        return None
+    return center, bool(theta[-1] < 0.0)
+
+
+def fit_arcs(points, tolerance=DEFAULT_TOLERANCE, min_arc_points=DEFAULT_MIN_ARC_POINTS):
+    """ Splits the path into arcs and polylines. Returns a list of moves (see
+    optimize_toolpath) with the polyline stretches left as one line move per point.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    moves = []
+    i = 0
+    while i < len(points) - 1:
+        arc = None
+        j = i + min_arc_points - 1
+        while j < len(points):
+            fit = check_arc(points[i:j+1], tolerance)
+            if fit is None:
+                break
+            # Only arcs which are too curved to be a single line are worth having
+            if point_segment_distance(points[i:j+1], points[i], points[j]).max() > tolerance:
+                arc = (j, fit)
+            j += 1
+        if arc is None:
+            # Everything up to the last point that fitted is within tolerance of a line
+            i_next = max(i + 1, j - min_arc_points)
+            moves.extend((MOVE_LINE, p, None) for p in points[i+1:i_next+1])
+            i = i_next
+        else:
+            j, (center, clockwise) = arc
+            offset = center - points[i,:2]
+            moves.append((MOVE_ARC_CW if clockwise else MOVE_ARC_CCW, points[j], offset))
+            i = j
+    return moves
+
+
+def optimize_toolpath(points, tolerance=DEFAULT_TOLERANCE, arcs=False,
+        min_arc_points=DEFAULT_MIN_ARC_POINTS):
+    """ Optimizes a path given as an (n,3) array of x,y,z points in mm.
+
+    Returns a list of moves (code, end, offset) from points[0], where code is G1, G2 or G3,
+    end the end point and offset the (I,J) arc center offset from the start of the move
+    (None for lines).
+    """
+    points = merge_collinear(points)
+    if not arcs:
+        return [(MOVE_LINE, p, None) for p in simplify_rdp(points, tolerance)[1:]]
+    moves = []
+    run = [points[0]]
+    for move in fit_arcs(points, tolerance, min_arc_points):
+        code, end, offset = move
+        if code == MOVE_LINE:
+            run.append(end)
+            continue
+        moves.extend((MOVE_LINE, p, None) for p in simplify_rdp(run, tolerance)[1:])
+        moves.append(move)
+        run = [end]
+    moves.extend((MOVE_LINE, p, None) for p in simplify_rdp(run, tolerance)[1:])
+    return moves
+
+
+def toolpath_to_gcode(moves, decimals=DEFAULT_DECIMALS):
+    """ Returns the G-code lines for a list of moves from optimize_toolpath. """
+    cmd_list = []
+    for code, end, offset in moves:
+        x, y, z = (f'{val:0.{decimals}f}' for val in end)
+        if offset is None:
+            cmd_list.append(f'{code} X{x} Y{y} Z{z}')
+        else:
+            i, j = (f'{val:0.{decimals}f}' for val in offset)
+            cmd_list.append(f'{code} X{x} Y{y} Z{z} I{i} J{j}')
+    return cmd_list
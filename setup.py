@@ -21,6 +21,11 @@ setup(
     include_package_data=True,
     package_data = {'': ['*.ui']},
     entry_points = {
-        'console_scripts' : ['flaser = flasercutter.app:app_main'],
+        'console_scripts' : [
+            'flaser = flasercutter.app:app_main',
+            'flaser-grbl-sim = flasercutter.grbl_simulator:simulator_main',
+            'flaser-reprocess = flasercutter.reprocess:reprocess_main',
+            'flaser-benchmark = flasercutter.benchmark:benchmark_main',
+            ],
         },
 )
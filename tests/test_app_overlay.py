@@ -0,0 +1,95 @@
+import pytest
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('pyqtgraph')
+pytest.importorskip('serial')
+
+from flasercutter.app import AppMainWindow
+
+
+class RecordingOverlay:
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if not name.startswith('set_'):
+            raise AttributeError(name)
+        return lambda *args: self.calls.append(name)
+
+
+class FakeCheckBox:
+
+    def __init__(self, checked):
+        self.checked = checked
+
+    def isChecked(self):
+        return self.checked
+
+
+class FakeCollector:
+    running = False
+
+
+class FakeCalibration:
+    ok = False
+    version = 0
+
+
+class FakeApp:
+
+    """ Just the state update_scene_overlay and get_overlay_key look at. """
+
+    OVERLAY_MODE_SCENE = AppMainWindow.OVERLAY_MODE_SCENE
+    get_overlay_key = AppMainWindow.get_overlay_key
+    update_scene_overlay = AppMainWindow.update_scene_overlay
+
+    def __init__(self):
+        self.overlay_mode = self.OVERLAY_MODE_SCENE
+        self.overlay_key = None
+        self.annotation_overlay = RecordingOverlay()
+        self.image_stack_collector = FakeCollector()
+        self.calibration = FakeCalibration()
+        self.pointsVisibleCheckBox = FakeCheckBox(True)
+        self.show_mosaic = False
+        self.px_point_list = []
+        self.z_point_list = []
+        self.point_list_version = 0
+
+
+SHAPE = (480, 640, 3)
+
+
+def test_scene_overlay_only_updated_when_key_changes():
+    app = FakeApp()
+    app.update_scene_overlay(SHAPE, False, False)
+    assert app.annotation_overlay.calls
+    for i in range(3):
+        app.annotation_overlay.calls.clear()
+        app.update_scene_overlay(SHAPE, False, False)
+        assert not app.annotation_overlay.calls
+
+
+@pytest.mark.parametrize('change', ['points', 'visible', 'sending', 'calibration', 'shape'])
+def test_scene_overlay_updated_on_key_change(change):
+    app = FakeApp()
+    app.update_scene_overlay(SHAPE, False, False)
+    app.annotation_overlay.calls.clear()
+    shape, sending = SHAPE, False
+    if change == 'points':
+        app.px_point_list.append((10, 20))
+        app.z_point_list.append(0.1)
+        app.point_list_version += 1
+    elif change == 'visible':
+        app.pointsVisibleCheckBox.checked = False
+    elif change == 'sending':
+        sending = True
+    elif change == 'calibration':
+        app.calibration.version += 1
+    elif change == 'shape':
+        shape = (240, 320, 3)
+    app.update_scene_overlay(shape, sending, False)
+    assert 'set_points' in app.annotation_overlay.calls
+    app.annotation_overlay.calls.clear()
+    app.update_scene_overlay(shape, sending, False)
+    assert not app.annotation_overlay.calls
@@ -0,0 +1,90 @@
+import cv2
+import numpy as np
+import pytest
+
+from flasercutter.autofocus import Autofocus
+from flasercutter.autofocus import coarse_to_fine_search
+from flasercutter.autofocus import golden_section_search
+
+
+MIN_VAL = -0.05
+MAX_VAL = 0.05
+TOLERANCE = 0.002
+
+
+def run_search(search, func):
+    """ Drives a search generator with func(z). Returns the best z and the z values
+    measured.
+    """
+    z_list = [next(search)]
+    try:
+        while True:
+            z_list.append(search.send(func(z_list[-1])))
+    except StopIteration as stop:
+        return stop.value, z_list
+
+
+def single_peak(z_peak):
+    return lambda z: 1.0/(1.0 + ((z - z_peak)/0.01)**2)
+
+
+SEARCHES = [
+        lambda: golden_section_search(MIN_VAL, MAX_VAL, 7, TOLERANCE),
+        lambda: coarse_to_fine_search(MIN_VAL, MAX_VAL, 7, TOLERANCE),
+        ]
+
+
+@pytest.mark.parametrize('make_search', SEARCHES)
+@pytest.mark.parametrize('z_peak', [MIN_VAL, -0.0123, 0.0, 0.0271, MAX_VAL])
+def test_search_finds_peak(make_search, z_peak):
+    best_z, z_list = run_search(make_search(), single_peak(z_peak))
+    assert abs(best_z - z_peak) <= TOLERANCE
+    assert all(MIN_VAL <= z <= MAX_VAL for z in z_list)
+    assert len(z_list) < 40
+
+
+@pytest.mark.parametrize('make_search', SEARCHES)
+def test_search_peak_outside_range(make_search):
+    best_z, z_list = run_search(make_search(), single_peak(MAX_VAL + 0.1))
+    assert abs(best_z - MAX_VAL) <= TOLERANCE
+
+
+def blurred_image(texture, z, z_peak):
+    sigma = 0.5 + 200*abs(z - z_peak)
+    return cv2.GaussianBlur(texture, (0, 0), sigma)
+
+
+def make_texture(shape=(120, 160), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=shape + (3,), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('method', [Autofocus.METHOD_GOLDEN, Autofocus.METHOD_COARSE_TO_FINE])
+def test_autofocus_run(method):
+    texture = make_texture()
+    z_peak = 0.013
+    af = Autofocus(MIN_VAL, MAX_VAL, method=method)
+    z = af.start()
+    t = 0.0
+    while af.running:
+        af.update_motion(True, z, now=t)
+        t += 1.0
+        while af.images_needed:
+            assert af.settled_at(t)
+            af.add_image(blurred_image(texture, z, z_peak), t)
+        z = af.next_step()
+    assert z == af.best_z
+    assert abs(af.best_z - z_peak) <= af.tolerance
+    assert af.num_moves == len(af.history)
+
+
+def test_autofocus_roi():
+    texture = make_texture()
+    image = cv2.GaussianBlur(texture, (0, 0), 4)
+    image[40:80, 60:100] = texture[40:80, 60:100]
+    af = Autofocus()
+    whole_score = af.measure(image)
+    af.set_roi((60, 40, 40, 40))
+    assert af.measure(image) > 2*whole_score
+    af.set_roi((1000, 1000, 10, 10))
+    assert af.measure(image) == whole_score
@@ -0,0 +1,157 @@
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+from flasercutter.calibration import Calibration
+from flasercutter.calibration import PointConverter
+from flasercutter.calibration import load_correspondences
+
+
+def make_calibration():
+    cal = Calibration()
+    cal.update({
+        'image_points'     : [(100, 100), (500, 100), (500, 400), (100, 400)],
+        'target_width_mm'  : 0.4,
+        'target_height_mm' : 0.3,
+        })
+    return cal
+
+
+def check(converter, cal, points):
+    np.testing.assert_allclose(converter.update(points), cal.px_to_mm(points))
+
+
+def test_point_converter_append():
+    cal = make_calibration()
+    converter = PointConverter(cal)
+    points = [(100, 100), (300, 250)]
+    check(converter, cal, points)
+    points.append((500, 400))
+    check(converter, cal, points)
+
+
+def test_point_converter_pop_then_add():
+    cal = make_calibration()
+    converter = PointConverter(cal)
+    points = [(100, 100), (300, 250)]
+    check(converter, cal, points)
+    points.pop()
+    check(converter, cal, points)
+    points.append((500, 100))
+    check(converter, cal, points)
+
+
+def test_point_converter_clear_then_add():
+    cal = make_calibration()
+    converter = PointConverter(cal)
+    points = [(100, 100), (300, 250), (500, 400)]
+    check(converter, cal, points)
+    points = []
+    check(converter, cal, points)
+    points = [(200, 200), (400, 300)]
+    check(converter, cal, points)
+
+
+def test_point_converter_replace():
+    cal = make_calibration()
+    converter = PointConverter(cal)
+    check(converter, cal, [(100, 100), (300, 250), (500, 400)])
+    check(converter, cal, [(100, 100), (120, 380), (500, 100), (100, 100)])
+    check(converter, cal, [(450, 150), (150, 350)])
+
+
+def test_point_converter_recalibrate():
+    cal = make_calibration()
+    converter = PointConverter(cal)
+    points = [(100, 100), (300, 250)]
+    check(converter, cal, points)
+    cal.update({
+        'image_points'     : [(0, 0), (600, 0), (600, 450), (0, 450)],
+        'target_width_mm'  : 0.4,
+        'target_height_mm' : 0.3,
+        })
+    check(converter, cal, points)
+
+
+def test_point_converter_pop_then_add_without_update():
+    # The app only updates the converter when points are added
+    cal = make_calibration()
+    converter = PointConverter(cal)
+    points = [(100, 100), (300, 250)]
+    check(converter, cal, points)
+    points.pop()
+    points.append((500, 100))
+    check(converter, cal, points)
+
+
+def test_point_converter_clear_then_add_without_update():
+    cal = make_calibration()
+    converter = PointConverter(cal)
+    check(converter, cal, [(100, 100), (300, 250)])
+    check(converter, cal, [(400, 300), (200, 150)])
+
+
+def test_load_correspondences(tmp_path):
+    cal = make_calibration()
+    image_points = [(100, 100), (500, 100), (500, 400), (100, 400), (300, 250), (200, 300)]
+    target_points_mm = cal.px_to_mm(image_points).tolist()
+    filename = tmp_path / 'points.json'
+    filename.write_text(json.dumps({
+        'image_points'     : image_points,
+        'target_points_mm' : target_points_mm,
+        'method'           : 'ransac',
+        }))
+    cal_loaded = Calibration()
+    cal_loaded.update(load_correspondences(filename))
+    np.testing.assert_allclose(cal_loaded.px_to_mm(image_points), target_points_mm, atol=1e-9)
+    assert cal_loaded.vals['residual_max_mm'] < 1e-6
+
+
+def test_load_correspondences_targets_only(tmp_path):
+    filename = tmp_path / 'points.json'
+    filename.write_text(json.dumps({'target_points_mm': [(0, 0), (1, 0), (1, 1)]}))
+    assert 'image_points' not in load_correspondences(filename)
+
+
+def test_load_correspondences_length_mismatch(tmp_path):
+    filename = tmp_path / 'points.json'
+    filename.write_text(json.dumps({
+        'image_points'     : [(0, 0), (1, 0)],
+        'target_points_mm' : [(0, 0), (1, 0), (1, 1)],
+        }))
+    with pytest.raises(ValueError):
+        load_correspondences(filename)
+
+
+def make_distorted_correspondences(image_size=(640, 480)):
+    """ A burned grid seen through a lens with barrel distortion. """
+    x, y = np.meshgrid(np.linspace(-0.3, 0.3, 9), np.linspace(-0.2, 0.2, 7))
+    target_points_mm = np.column_stack((x.ravel(), y.ravel()))
+    object_points = np.column_stack((target_points_mm, np.zeros(len(target_points_mm))))
+    camera_matrix = np.array([[900.0, 0.0, 330.0], [0.0, 900.0, 235.0], [0.0, 0.0, 1.0]])
+    dist_coeffs = np.array([-0.25, 0.1, 0.0, 0.0, 0.0])
+    rvec = np.zeros(3)
+    tvec = np.array([0.01, -0.02, 1.0])
+    image_points, _ = cv2.projectPoints(object_points, rvec, tvec, camera_matrix, dist_coeffs)
+    return {
+        'image_points'     : image_points.reshape(-1, 2).tolist(),
+        'target_points_mm' : target_points_mm.tolist(),
+        'distortion'       : True,
+        'image_size'       : image_size,
+        }
+
+
+def test_distortion_raw_image_coordinates():
+    # Points stay in raw (distorted) camera pixels, the model is applied to the points
+    data = make_distorted_correspondences()
+    cal = Calibration()
+    cal.update(data)
+    assert cal.has_distortion
+    assert cal.vals['residual_max_mm'] < 1e-4
+    image_points = np.array(data['image_points'])
+    target_points_mm = np.array(data['target_points_mm'])
+    np.testing.assert_allclose(cal.px_to_mm(image_points), target_points_mm, atol=1e-4)
+    np.testing.assert_allclose(cal.mm_to_px(target_points_mm), image_points, atol=0.05)
+    np.testing.assert_allclose(cal.px_to_mm([cal.laser_pos_px]), [(0.0, 0.0)], atol=1e-6)
@@ -0,0 +1,130 @@
+import cv2
+import numpy as np
+import pytest
+
+from flasercutter.contour_tracer import ContourTracer
+
+
+SHAPE = (240, 320)
+CENTER = (150, 110)
+AXES = (60, 35)
+
+
+def make_blob(shape=SHAPE, center=CENTER, axes=AXES, foreground=200, background=40, seed=0):
+    """ A filled ellipse on a noisy background, as a BGR image. """
+    rng = np.random.default_rng(seed)
+    gray = np.full(shape, background, dtype=np.uint8)
+    cv2.ellipse(gray, center, axes, 20, 0, 360, foreground, -1)
+    noise = rng.normal(0.0, 5.0, size=shape)
+    gray = np.clip(gray + noise, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+def make_plane(shape=SHAPE, a=1.0e-4, b=-2.0e-4, c=0.01):
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    return (a*x + b*y + c).astype(np.float32)
+
+
+def ellipse_area(axes=AXES):
+    return np.pi*axes[0]*axes[1]
+
+
+def inside_ellipse(points, center=CENTER, axes=AXES, angle=20, scale=1.0):
+    theta = np.deg2rad(angle)
+    d = np.asarray(points, dtype=np.float64) - center
+    u = d[:,0]*np.cos(theta) + d[:,1]*np.sin(theta)
+    v = -d[:,0]*np.sin(theta) + d[:,1]*np.cos(theta)
+    return (u/(scale*axes[0]))**2 + (v/(scale*axes[1]))**2 <= 1.0
+
+
+def test_trace_blob():
+    tracer = ContourTracer()
+    depth_image = make_plane()
+    proposals = tracer.trace(make_blob(), depth_image)
+    assert len(proposals) == 1
+    proposal = proposals[0]
+    px = proposal['px']
+    assert px.ndim == 2 and px.shape[1] == 2 and len(px) >= 4
+    np.testing.assert_array_equal(px[0], px[-1])
+    assert proposal['area'] == pytest.approx(ellipse_area(), rel=0.05)
+    # The vertices lie on the ellipse's outline
+    assert inside_ellipse(px, scale=1.05).all()
+    assert not inside_ellipse(px, scale=0.95).any()
+    np.testing.assert_array_equal(proposal['z'], depth_image[px[:,1], px[:,0]])
+
+
+def test_trace_adaptive_uneven_lighting():
+    # Light falling off across the field defeats a global threshold
+    x = np.arange(SHAPE[1])
+    ramp = np.broadcast_to((120.0*x/SHAPE[1])[np.newaxis,:,np.newaxis], SHAPE + (3,))
+    image = np.clip(make_blob() + ramp, 0, 255).astype(np.uint8)
+    assert ContourTracer().trace(image) == []
+    tracer = ContourTracer(ContourTracer.METHOD_ADAPTIVE)
+    tracer.adaptive_block_size = 151
+    tracer.adaptive_c = -10
+    proposals = tracer.trace(image)
+    assert len(proposals) == 1
+    assert proposals[0]['area'] == pytest.approx(ellipse_area(), rel=0.05)
+    assert inside_ellipse(proposals[0]['px'], scale=1.05).all()
+
+
+def test_trace_canny_blob():
+    tracer = ContourTracer(ContourTracer.METHOD_CANNY)
+    proposals = tracer.trace(make_blob())
+    assert proposals
+    assert proposals[0]['z'] is None
+    assert proposals[0]['area'] == pytest.approx(ellipse_area(), rel=0.1)
+
+
+def test_trace_invert_dark_blob():
+    image = make_blob(foreground=40, background=200)
+    assert ContourTracer().trace(image) == []
+    tracer = ContourTracer()
+    tracer.invert = True
+    proposals = tracer.trace(image)
+    assert len(proposals) == 1
+    assert proposals[0]['area'] == pytest.approx(ellipse_area(), rel=0.05)
+
+
+def test_trace_largest_first_and_min_area():
+    image = make_blob()
+    cv2.circle(image, (270, 190), 20, (200, 200, 200), -1)
+    cv2.circle(image, (40, 40), 8, (200, 200, 200), -1)
+    tracer = ContourTracer()
+    areas = [proposal['area'] for proposal in tracer.trace(image)]
+    assert len(areas) == 2
+    assert areas == sorted(areas, reverse=True)
+    assert areas[1] == pytest.approx(np.pi*20**2, rel=0.1)
+    tracer.max_contours = 1
+    assert len(tracer.trace(image)) == 1
+    tracer.min_area = 2*ellipse_area()
+    assert tracer.trace(image) == []
+
+
+def test_trace_roi():
+    image = make_blob()
+    cv2.circle(image, (270, 190), 20, (200, 200, 200), -1)
+    tracer = ContourTracer()
+    proposals = tracer.trace(image, roi=(230, 150, 80, 80))
+    assert len(proposals) == 1
+    px = proposals[0]['px']
+    # Vertices are in full image coordinates
+    assert np.linalg.norm(px - (270, 190), axis=1).max() < 22
+    assert tracer.trace(image, roi=(400, 300, 50, 50)) == []
+
+
+def test_trace_exclude_border():
+    # A blob cut off by the search area's edge is not an outline
+    image = make_blob()
+    roi = (CENTER[0], 0, SHAPE[1] - CENTER[0], SHAPE[0])
+    tracer = ContourTracer()
+    assert tracer.trace(image, roi=roi) == []
+    tracer.exclude_border = False
+    proposals = tracer.trace(image, roi=roi)
+    assert len(proposals) == 1
+    assert proposals[0]['px'][:,0].min() >= CENTER[0]
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        ContourTracer('watershed')
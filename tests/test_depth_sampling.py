@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('sgolay2')
+
+from flasercutter.image_stack_collector import ImageStackCollector
+from flasercutter.image_stack_collector import densify_path_depth
+
+
+SHAPE = (120, 160)
+TOLERANCE = 0.001
+PATH = np.array([[10.0, 10.0], [150.0, 20.5], [140.0, 110.0], [20.25, 100.0], [10.0, 10.0]])
+
+
+def plane(points, a=2.0e-4, b=-1.0e-4, c=0.01):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return a*points[:,0] + b*points[:,1] + c
+
+
+def bowl(points, center=(80.0, 60.0), curvature=4.0e-6):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return curvature*((points - center)**2).sum(axis=1)
+
+
+def dense_points(points, num=2000):
+    """ Points every small step along the polyline. """
+    return np.vstack([
+        start + np.linspace(0.0, 1.0, num)[:,np.newaxis]*(end - start)
+        for start, end in zip(points[:-1], points[1:])
+        ])
+
+
+def interpolate_path(samples, z, points):
+    """ z linearly interpolated along the path samples at points lying on it. """
+    dist = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(samples, axis=0), axis=1))))
+    rval = np.empty(len(points))
+    for i, p in enumerate(points):
+        d = np.array([segment_param(p, s, e) for s, e in zip(samples[:-1], samples[1:])])
+        k = int(np.argmin(d[:,1]))
+        rval[i] = z[k] + d[k,0]*(z[k+1] - z[k])
+    return rval
+
+
+def segment_param(p, start, end):
+    """ (t, distance) of the nearest point on the segment start-end to p. """
+    v = end - start
+    t = np.clip(np.dot(p - start, v)/max(np.dot(v, v), 1.0e-12), 0.0, 1.0)
+    return t, np.linalg.norm(start + t*v - p)
+
+
+def test_densify_plane_keeps_vertices():
+    samples, z = densify_path_depth(plane, PATH, TOLERANCE, 1.0)
+    np.testing.assert_array_equal(samples, PATH)
+    np.testing.assert_allclose(z, plane(PATH))
+
+
+@pytest.mark.parametrize('tolerance', [1.0e-3, 1.0e-4])
+def test_densify_curved_within_tolerance(tolerance):
+    samples, z = densify_path_depth(bowl, PATH, tolerance, 1.0)
+    assert len(samples) > len(PATH)
+    np.testing.assert_allclose(z, bowl(samples))
+    # The original vertices are all kept, in order
+    index = [np.flatnonzero((samples == p).all(axis=1))[0] for p in PATH[:-1]]
+    assert index == sorted(index)
+    np.testing.assert_array_equal(samples[-1], PATH[-1])
+    # Linear interpolation between the kept points is within tolerance all along the path
+    # (up to the error of sampling every spacing px)
+    points = dense_points(PATH, num=200)
+    error = np.abs(interpolate_path(samples, z, points) - bowl(points))
+    assert error.max() <= tolerance + 1.0e-5
+
+
+def test_densify_tighter_tolerance_adds_points():
+    num_coarse = len(densify_path_depth(bowl, PATH, 1.0e-3, 1.0)[0])
+    num_fine = len(densify_path_depth(bowl, PATH, 1.0e-4, 1.0)[0])
+    assert num_fine > num_coarse
+
+
+def test_densify_single_point():
+    samples, z = densify_path_depth(plane, PATH[:1], TOLERANCE, 1.0)
+    np.testing.assert_array_equal(samples, PATH[:1])
+    np.testing.assert_allclose(z, plane(PATH[:1]))
+
+
+def make_collector(depth_function):
+    collector = ImageStackCollector()
+    y, x = np.mgrid[:SHAPE[0], :SHAPE[1]]
+    points = np.column_stack((x.ravel(), y.ravel()))
+    collector.depth_image = depth_function(points).reshape(SHAPE)
+    return collector
+
+
+def test_sample_depth_plane():
+    # Bilinear interpolation is exact on a plane, between pixels too
+    collector = make_collector(plane)
+    rng = np.random.default_rng(0)
+    points = rng.uniform((0, 0), (SHAPE[1] - 1, SHAPE[0] - 1), size=(100, 2))
+    np.testing.assert_allclose(collector.sample_depth(points), plane(points), atol=1.0e-12)
+    # Points off the image take the nearest edge pixel's depth
+    outside = np.array([[-5.0, 30.0], [SHAPE[1] + 10.0, 200.0]])
+    edge = np.array([[0.0, 30.0], [SHAPE[1] - 1.0, SHAPE[0] - 1.0]])
+    np.testing.assert_allclose(collector.sample_depth(outside), plane(edge), atol=1.0e-12)
+
+
+def test_sample_path_depth():
+    collector = make_collector(plane)
+    samples, z = collector.sample_path_depth(PATH)
+    np.testing.assert_array_equal(samples, PATH)
+    np.testing.assert_allclose(z, plane(PATH), atol=1.0e-12)
+    collector = make_collector(bowl)
+    samples, z = collector.sample_path_depth(PATH, tolerance=1.0e-4)
+    assert len(samples) > len(PATH)
+    np.testing.assert_allclose(z, bowl(samples), atol=1.0e-5)
+
+
+def test_sample_depth_without_image():
+    with pytest.raises(RuntimeError):
+        ImageStackCollector().sample_depth([[0.0, 0.0]])
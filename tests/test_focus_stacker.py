@@ -0,0 +1,90 @@
+import cv2
+import numpy as np
+import pytest
+
+from flasercutter.focus_stacker import FocusStacker
+
+
+SHAPE = (60, 80, 3)
+
+
+def batch_focus_and_depth(fs, images, depths):
+    """ The original full stack algorithm, all laplacians at once. """
+    laplacians = fs.compute_laplacian(images)
+    return fs.find_focus_regions(images, np.asarray(depths), laplacians)
+
+
+def incremental_focus_and_depth(fs, images, depths):
+    fs.reset()
+    for image, depth in zip(images, depths):
+        fs.push(image, depth)
+    return fs.result()
+
+
+def make_random_stack(num, seed):
+    rng = np.random.default_rng(seed)
+    images = [rng.integers(0, 256, size=SHAPE, dtype=np.uint8) for i in range(num)]
+    depths = list(np.linspace(-0.02, 0.02, num))
+    return images, depths
+
+
+def make_blurred_stack(num, seed):
+    # Each image is sharp in a different band, as in a real stack
+    rng = np.random.default_rng(seed)
+    texture = rng.integers(0, 256, size=SHAPE, dtype=np.uint8)
+    blurred = cv2.GaussianBlur(texture, (0, 0), 3)
+    band = SHAPE[1]//num
+    images = []
+    for i in range(num):
+        image = blurred.copy()
+        image[:, i*band:(i + 1)*band] = texture[:, i*band:(i + 1)*band]
+        images.append(image)
+    depths = list(np.linspace(-0.02, 0.02, num))
+    return images, depths
+
+
+@pytest.mark.parametrize('make_stack', [make_random_stack, make_blurred_stack])
+@pytest.mark.parametrize('kernel_sizes', [(5, 5), (3, 1), (7, 3)])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_incremental_matches_batch(make_stack, kernel_sizes, seed):
+    laplacian_size, blur_size = kernel_sizes
+    fs = FocusStacker(laplacian_kernel_size=laplacian_size, gaussian_blur_kernel_size=blur_size)
+    images, depths = make_stack(7, seed)
+    focus_expected, depth_expected = batch_focus_and_depth(fs, images, depths)
+    focus_image, depth_image = incremental_focus_and_depth(fs, images, depths)
+    np.testing.assert_array_equal(focus_image, focus_expected)
+    np.testing.assert_array_equal(depth_image, depth_expected)
+    focus_image, depth_image = fs.focus_stack(images, depths)
+    np.testing.assert_array_equal(focus_image, focus_expected)
+    np.testing.assert_array_equal(depth_image, depth_expected)
+
+
+def test_ties_go_to_later_image():
+    # Flat images have zero sharpness everywhere
+    fs = FocusStacker()
+    images = [np.full(SHAPE, 10*i, dtype=np.uint8) for i in range(4)]
+    depths = [0.0, 0.01, 0.02, 0.03]
+    focus_expected, depth_expected = batch_focus_and_depth(fs, images, depths)
+    focus_image, depth_image = incremental_focus_and_depth(fs, images, depths)
+    np.testing.assert_array_equal(focus_image, focus_expected)
+    np.testing.assert_array_equal(depth_image, depth_expected)
+    np.testing.assert_array_equal(focus_image, images[-1])
+    np.testing.assert_array_equal(depth_image, depths[-1])
+
+
+def test_result_during_stack():
+    # The running result is the stack of the images pushed so far
+    fs = FocusStacker()
+    images, depths = make_blurred_stack(5, 0)
+    for n in range(1, len(images) + 1):
+        fs.push(images[n-1], depths[n-1])
+        focus_expected, depth_expected = batch_focus_and_depth(fs, images[:n], depths[:n])
+        focus_image, depth_image = fs.result()
+        assert fs.count == n
+        np.testing.assert_array_equal(focus_image, focus_expected)
+        np.testing.assert_array_equal(depth_image, depth_expected)
+
+
+def test_result_empty():
+    with pytest.raises(RuntimeError):
+        FocusStacker().result()
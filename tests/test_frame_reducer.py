@@ -0,0 +1,14 @@
+import numpy as np
+import pytest
+
+from flasercutter.frame_reducer import SigmaClippedMeanReducer
+
+
+@pytest.mark.parametrize('min_count', [0, 1, 2, 5])
+def test_sigma_clipped_mean_min_count(min_count):
+    reducer = SigmaClippedMeanReducer(num_sigma=2.0, min_count=min_count)
+    frames = [np.full((4, 6), 100, dtype=np.uint8) + i%2 for i in range(8)]
+    frames.append(np.full((4, 6), 250, dtype=np.uint8))
+    for frame in frames:
+        reducer.add(frame)
+    np.testing.assert_array_equal(reducer.result(), np.full((4, 6), 100, dtype=np.uint8))
@@ -0,0 +1,265 @@
+import time
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('grbl_comm')
+
+from flasercutter import toolpath
+from flasercutter.grbl_sender import GrblSender
+from flasercutter.grbl_simulator import GrblSimulator
+from flasercutter.grbl_simulator import GrblSimulatorPty
+from flasercutter.grbl_simulator import SimulatedSerial
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
+
+
+def make_sender(clock=time.monotonic):
+    sim = GrblSimulator(clock=clock)
+    return sim, GrblSender(serial_port=SimulatedSerial(sim))
+
+
+def run_until_done(sim, sender, clock, query_status=False, dt=0.01, max_steps=100000):
+    """ Updates the sender, advancing the simulator's clock, until everything queued has
+    been acknowledged. Checks the character counting on every update. Returns the
+    (line, cmd) responses and the last status.
+    """
+    responses = []
+    status = None
+    for i in range(max_steps):
+        rval = sender.update(query_status=query_status)
+        responses.extend(rval.get('responses', []))
+        status = rval.get('status', status)
+        assert sender.buff_char_count < sim.RX_BUFFER_SIZE
+        assert sender.buff_char_count == sum(len(cmd) for cmd in sender.cmd_in_buff)
+        # Unparsed bytes in grbl's rx buffer have all been counted but not acknowledged
+        assert len(sim.rx_buffer) <= sender.buff_char_count
+        if not sender.sending:
+            break
+        clock.t += dt
+    else:
+        pytest.fail('sender did not finish')
+    return responses, status
+
+
+def wait_for_idle(sim, clock, dt=0.01):
+    while sim.planner:
+        clock.t += dt
+        sim.update()
+
+
+def cut_commands(bad_cmd=None):
+    """ Cut as sent by the app: a circle with arcs followed by a dense wavy line. """
+    theta = np.linspace(0.0, 2.0*np.pi, 200)
+    circle = np.column_stack((np.cos(theta), np.sin(theta), np.zeros_like(theta)))
+    x = np.linspace(1.0, 3.0, 400)
+    wave = np.column_stack((x, 0.2*np.sin(5*x), 0.01*x))
+    points = np.concatenate((circle, wave))
+    moves = toolpath.optimize_toolpath(points, arcs=True)
+    cmd_list = ['G90', 'G17', 'F200.0', 'G1 X1.000 Y0.000 Z0.000', 'M3 S500']
+    cmd_list.extend(toolpath.toolpath_to_gcode(moves))
+    if bad_cmd is not None:
+        cmd_list.insert(len(cmd_list)//2, bad_cmd)
+    cmd_list.extend(['M5 S0', 'G1 X0 Y0 Z0'])
+    return cmd_list
+
+
+def test_cut_character_counting():
+    clock = FakeClock()
+    sim, sender = make_sender(clock)
+    cmd_list = cut_commands()
+    sender.extend_cmd(cmd_list)
+    responses, _ = run_until_done(sim, sender, clock)
+    assert sim.stats['rx_overflow_bytes'] == 0
+    assert sim.stats['max_rx_fill'] <= sim.RX_BUFFER_SIZE
+    # The buffer is actually kept full rather than sent a line at a time
+    assert sim.stats['max_rx_fill'] > sim.RX_BUFFER_SIZE//2
+    assert [cmd for line, cmd in responses] == [f'{cmd}\n' for cmd in cmd_list]
+    assert all(line == 'ok' for line, cmd in responses)
+    assert not sender.cmd_to_send and not sender.cmd_in_buff
+    assert sender.buff_char_count == 0
+    wait_for_idle(sim, clock)
+    np.testing.assert_allclose(sim.wpos, (0.0, 0.0, 0.0))
+    assert not sim.spindle_on
+
+
+def test_cut_error_matched_to_line():
+    clock = FakeClock()
+    sim, sender = make_sender(clock)
+    bad_cmd = 'G1 X1 Q5'
+    cmd_list = cut_commands(bad_cmd)
+    sender.extend_cmd(cmd_list)
+    responses, _ = run_until_done(sim, sender, clock)
+    assert [cmd for line, cmd in responses] == [f'{cmd}\n' for cmd in cmd_list]
+    errors = [(line, cmd) for line, cmd in responses if line.startswith('error')]
+    assert errors == [(f'error:{sim.ERROR_UNSUPPORTED_COMMAND}', f'{bad_cmd}\n')]
+    assert sender.buff_char_count == 0
+
+
+def test_focus_stack_moves():
+    # Each step is a move_to_z, waiting for grbl to report idle at z before the next
+    clock = FakeClock()
+    sim, sender = make_sender(clock)
+    z_values = np.round(np.linspace(-0.05, 0.05, 21), 3)
+    for z in z_values:
+        sender.extend_cmd(['G90', 'F50.0', f'G1 Z{z:0.3f}'])
+        responses, status = run_until_done(sim, sender, clock, query_status=True)
+        assert [line for line, cmd in responses] == ['ok']*3
+        while status['mode'] != 'idle' or abs(status['WPos']['z'] - z) > 1.0e-6:
+            clock.t += 0.01
+            status = sender.update(query_status=True).get('status', status)
+    assert sim.stats['rx_overflow_bytes'] == 0
+    assert sim.stats['errors'] == 0
+    assert sim.stats['oks'] == 3*len(z_values)
+    assert sender.buff_char_count == 0
+
+
+def test_line_lengths_up_to_buffer_size():
+    # Lines close to the buffer size only fit once it has (nearly) emptied
+    clock = FakeClock()
+    sim, sender = make_sender(clock)
+    rng = np.random.default_rng(0)
+    cmd_list = ['G90', 'F500']
+    for i in range(200):
+        cmd = f'G1 X{rng.uniform(-1, 1):0.3f} Y{rng.uniform(-1, 1):0.3f}'
+        # The longest line which can be sent is RX_BUFFER_SIZE - 1 bytes with the newline
+        max_padding = sim.RX_BUFFER_SIZE - len(cmd) - 4
+        padding = max_padding if i%10 == 0 else int(rng.integers(0, max_padding))
+        cmd_list.append(f'{cmd}({"p"*padding})')
+    sender.extend_cmd(cmd_list)
+    responses, _ = run_until_done(sim, sender, clock, query_status=True)
+    assert [cmd for line, cmd in responses] == [f'{cmd}\n' for cmd in cmd_list]
+    assert all(line == 'ok' for line, cmd in responses)
+    assert sim.stats['rx_overflow_bytes'] == 0
+    assert not sender.sending and sender.buff_char_count == 0
+
+
+def run_threaded(sender, cmd_list, timeout=10.0):
+    responses = []
+    statuses = []
+    done = threading.Event()
+
+    def on_response(line, cmd):
+        responses.append((line, cmd))
+        if len(responses) == len(cmd_list):
+            done.set()
+
+    sender.start_thread(
+            status_callback=statuses.append,
+            response_callback=on_response,
+            status_period=0.01,
+            )
+    try:
+        sender.extend_cmd(cmd_list)
+        assert done.wait(timeout)
+        t_end = time.monotonic() + timeout
+        while sender.sending and time.monotonic() < t_end:
+            time.sleep(0.01)
+    finally:
+        sender.stop_thread()
+    return responses, statuses
+
+
+def fast_cut_commands():
+    cmd_list = ['G90', 'F6000', 'M3 S500']
+    cmd_list.extend(f'G1 X{0.01*i:0.3f} Y{0.01*(i%2):0.3f}' for i in range(100))
+    cmd_list.append('M5 S0')
+    return cmd_list
+
+
+def test_threaded_sender():
+    sim, sender = make_sender()
+    cmd_list = fast_cut_commands()
+    responses, statuses = run_threaded(sender, cmd_list)
+    assert [cmd for line, cmd in responses] == [f'{cmd}\n' for cmd in cmd_list]
+    assert all(line == 'ok' for line, cmd in responses)
+    assert statuses and 'WPos' in statuses[-1]
+    assert not sender.threaded
+    assert not sender.sending and sender.buff_char_count == 0
+    assert sim.stats['rx_overflow_bytes'] == 0
+
+
+def test_threaded_sender_pty():
+    with GrblSimulatorPty() as sim_pty:
+        sender = GrblSender(port=sim_pty.port, timeout=1.0)
+        try:
+            cmd_list = fast_cut_commands()
+            responses, statuses = run_threaded(sender, cmd_list)
+        finally:
+            sender.close()
+    sim = sim_pty.simulator
+    assert [cmd for line, cmd in responses] == [f'{cmd}\n' for cmd in cmd_list]
+    assert all(line == 'ok' for line, cmd in responses)
+    assert statuses
+    assert sim.stats['rx_overflow_bytes'] == 0
+    assert sim.stats['max_rx_fill'] <= sim.RX_BUFFER_SIZE
+
+
+@pytest.mark.parametrize('lookahead, num_sent', [(2, 4), (256, 0)])
+def test_stream_iterable_long_line_stops_laser(lookahead, num_sent):
+    # Lines read ahead of the bad one but not yet sent are dropped with it
+    clock = FakeClock()
+    sim, sender = make_sender(clock)
+    lines = ['G90', 'F200', 'M3 S500', 'G1 X0.1', f'G1 X0.2 ({"x"*10})', 'G1 X' + '1'*200, 'G1 X0.3']
+    stream = sender.stream_gcode(iter(lines), lookahead=lookahead)
+    responses, _ = run_until_done(sim, sender, clock)
+    sent = [cmd for line, cmd in responses]
+    cleaned = ['G90\n', 'F200\n', 'M3S500\n', 'G1X0.1\n', 'G1X0.2\n']
+    assert sent == cleaned[:num_sent] + [stream.SAFE_STOP_CMD]
+    assert all(line == 'ok' for line, cmd in responses)
+    assert stream.done
+    assert 'line 6' in stream.error
+    assert not sim.spindle_on
+
+
+def test_stream_file_long_line_rejected(tmp_path):
+    clock = FakeClock()
+    sim, sender = make_sender(clock)
+    filename = tmp_path / 'long.gcode'
+    filename.write_text('G90\nF200\nM3 S500\nG1 X' + '1'*200 + '\nM5\n')
+    with pytest.raises(ValueError, match='line 4'):
+        sender.stream_gcode(filename)
+    sender.update()
+    assert sim.stats['lines'] == 0
+    assert not sender.sending
+
+
+def test_stream_file(tmp_path):
+    clock = FakeClock()
+    sim, sender = make_sender(clock)
+    cmd_list = cut_commands()
+    filename = tmp_path / 'cut.gcode'
+    filename.write_text('; cut\n' + '\n'.join(cmd_list) + '\n')
+    stream = sender.stream_gcode(filename, lookahead=16)
+    responses, _ = run_until_done(sim, sender, clock)
+    assert [cmd for line, cmd in responses] == [f'{cmd.replace(" ", "")}\n' for cmd in cmd_list]
+    assert stream.done and stream.error is None
+    assert stream.lines_sent == len(cmd_list)
+    assert sim.stats['rx_overflow_bytes'] == 0
+
+
+def test_pty_stream_stops_laser():
+    with GrblSimulatorPty() as sim_pty:
+        sender = GrblSender(port=sim_pty.port, timeout=1.0)
+        try:
+            lines = ['G90', 'F6000', 'M3 S500', 'G1 X0.1', 'G1 X' + '1'*200, 'G1 X0.3']
+            sender.start_thread(status_period=0.01)
+            stream = sender.stream_gcode(iter(lines), lookahead=2)
+            t_end = time.monotonic() + 10.0
+            while sender.sending and time.monotonic() < t_end:
+                time.sleep(0.01)
+        finally:
+            sender.close()
+    sim = sim_pty.simulator
+    assert stream.done and stream.error is not None
+    assert stream.lines_sent == 5
+    assert sim.stats['lines'] == 5
+    assert not sim.spindle_on
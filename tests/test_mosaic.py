@@ -0,0 +1,199 @@
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip('sgolay2')
+
+from flasercutter.mosaic import Mosaic
+from flasercutter.mosaic import MosaicCollector
+from flasercutter.mosaic import TiledArray
+
+
+FIELD_SHAPE = (120, 160)
+MM_PER_PX = 0.001
+
+
+class LinearCalibration:
+
+    """ Camera to work coordinates with y flipped, as for a camera looking down. """
+
+    def __init__(self, mm_per_px=MM_PER_PX, image_size=FIELD_SHAPE[::-1]):
+        self.matrix = mm_per_px*np.array([[1.0, 0.0], [0.0, -1.0]])
+        self.center = 0.5*np.array(image_size, dtype=np.float64)
+
+    def px_to_mm(self, points_px):
+        return (np.asarray(points_px, dtype=np.float64) - self.center) @ self.matrix.T
+
+
+def make_world(shape=(600, 800), seed=0):
+    rng = np.random.default_rng(seed)
+    world = rng.random(shape + (3,)).astype(np.float32)
+    world = cv2.GaussianBlur(world, (0, 0), 2)
+    return cv2.normalize(world, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+
+def make_tiles(stages):
+    return [
+            {'index': i, 'row': 0, 'col': i, 'stage': stage}
+            for i, stage in enumerate(stages)
+            ]
+
+
+def crop(world, origin):
+    x, y = origin
+    height, width = FIELD_SHAPE
+    return world[y:y+height, x:x+width].copy()
+
+
+def to_gray(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+
+# TiledArray
+# -------------------------------------------------------------------------------------------------
+
+@pytest.mark.parametrize('shape, dtype', [((300, 520, 3), np.uint8), ((200, 130), np.float32)])
+def test_tiled_array_round_trip(tmp_path, shape, dtype):
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 256, size=shape).astype(dtype)
+    filename = str(tmp_path / 'array.bin')
+    array = TiledArray(filename, shape, dtype, tile_size=64)
+    assert array.grid_shape == (-(-shape[0]//64), -(-shape[1]//64))
+    # Written in pieces which straddle tile boundaries
+    for y0, y1 in ((0, 70), (70, 150), (150, shape[0])):
+        for x0, x1 in ((0, 63), (63, 129), (129, shape[1])):
+            array.write(y0, x0, values[y0:y1, x0:x1])
+    np.testing.assert_array_equal(array.to_array(), values)
+    np.testing.assert_array_equal(array.read(10, 140, 50, 129), values[10:140, 50:129])
+    ys, xs = rng.integers(0, shape[0], 50), rng.integers(0, shape[1], 50)
+    np.testing.assert_array_equal(array.take(ys, xs), values[ys, xs])
+    array.close()
+    array = TiledArray(filename, shape, dtype, tile_size=64, mode='r')
+    np.testing.assert_array_equal(array.to_array(), values)
+
+
+def test_tiled_array_add(tmp_path):
+    array = TiledArray(str(tmp_path / 'array.bin'), (100, 150), np.float32, tile_size=32)
+    array.add(10, 20, np.ones((50, 60), dtype=np.float32))
+    array.add(40, 50, np.full((50, 60), 2.0, dtype=np.float32))
+    expected = np.zeros((100, 150), dtype=np.float32)
+    expected[10:60, 20:80] += 1.0
+    expected[40:90, 50:110] += 2.0
+    np.testing.assert_array_equal(array.to_array(), expected)
+
+
+@pytest.mark.parametrize('factor', [1, 2, 4, 8])
+def test_tiled_array_overview(tmp_path, factor):
+    # Whole blocks of factor px are averaged
+    shape = (200, 136)
+    rng = np.random.default_rng(1)
+    values = rng.random(shape).astype(np.float32)
+    array = TiledArray(str(tmp_path / 'array.bin'), shape, np.float32, tile_size=64)
+    array.write(0, 0, values)
+    overview = array.overview(factor)
+    height, width = shape[0]//factor, shape[1]//factor
+    assert overview.shape == (height, width)
+    expected = values.reshape(height, factor, width, factor).mean(axis=(1, 3))
+    np.testing.assert_allclose(overview, expected, rtol=1.0e-5)
+
+
+def test_tiled_array_overview_factor(tmp_path):
+    array = TiledArray(str(tmp_path / 'array.bin'), (100, 100), np.uint8, tile_size=64)
+    with pytest.raises(ValueError):
+        array.overview(3)
+
+
+# Registration
+# -------------------------------------------------------------------------------------------------
+
+def make_pair(tmp_path, stage_error_px, step_px=100):
+    """ A mosaic with tile 0 added and the gray image of tile 1, whose true position is
+    off its stage prediction by stage_error_px. Returns (mosaic, tile 1, gray, true
+    offset of tile 1 relative to tile 0).
+    """
+    calibration = LinearCalibration()
+    stage_step = step_px*MM_PER_PX
+    tiles = make_tiles([(0.0, 0.0), (stage_step, 0.0)])
+    mosaic = Mosaic(str(tmp_path / 'mosaic'), calibration, tiles, FIELD_SHAPE)
+    world = make_world()
+    origin = np.array([200, 200])
+    true_shift = np.array([step_px, 0]) + stage_error_px
+    focus_0 = crop(world, origin)
+    mosaic.add_tile(0, focus_0, np.zeros(FIELD_SHAPE, dtype=np.float32))
+    gray_1 = to_gray(crop(world, origin + true_shift))
+    return mosaic, mosaic.tiles[1], gray_1, true_shift
+
+
+@pytest.mark.parametrize('stage_error_px', [(0, 0), (7, -5), (-6, 4), (-3, -7)])
+def test_register_shifted_pair(tmp_path, stage_error_px):
+    mosaic, tile, gray, true_shift = make_pair(tmp_path, np.array(stage_error_px))
+    offset_0 = np.array(mosaic.tiles[0]['offset'])
+    np.testing.assert_allclose(np.array(tile['predicted']) - offset_0, (100, 0), atol=1.0e-6)
+    offset, response = mosaic.register(tile, gray)
+    assert response is not None and response > mosaic.min_response
+    # Tiles are placed on whole pixels
+    np.testing.assert_allclose(offset - offset_0, true_shift, atol=0.4)
+    np.testing.assert_array_equal(np.round(offset - offset_0), true_shift)
+
+
+def test_register_rejects_large_correction(tmp_path):
+    # A stage error beyond max_correction falls back on the stage prediction
+    mosaic, tile, gray, _ = make_pair(tmp_path, np.array([0, 60]))
+    offset, response = mosaic.register(tile, gray)
+    assert response is None
+    np.testing.assert_allclose(offset, tile['predicted'], atol=1.0e-6)
+
+
+def test_register_without_neighbours(tmp_path):
+    tiles = make_tiles([(0.0, 0.0)])
+    mosaic = Mosaic(str(tmp_path / 'mosaic'), LinearCalibration(), tiles, FIELD_SHAPE)
+    offset, response = mosaic.register(mosaic.tiles[0], np.zeros(FIELD_SHAPE, np.float32))
+    assert response is None
+    np.testing.assert_array_equal(offset, mosaic.tiles[0]['predicted'])
+
+
+# Finished mosaics
+# -------------------------------------------------------------------------------------------------
+
+def test_finish_and_open(tmp_path):
+    calibration = LinearCalibration()
+    path = str(tmp_path / 'mosaic')
+    world = make_world()
+    origin = np.array([200, 200])
+    tiles = make_tiles([(0.0, 0.0), (0.1, 0.0)])
+    mosaic = Mosaic(path, calibration, tiles, FIELD_SHAPE)
+    for index, shift in enumerate([(0, 0), (100, 0)]):
+        depth = np.full(FIELD_SHAPE, 0.01, dtype=np.float32)
+        mosaic.add_tile(index, crop(world, origin + shift), depth)
+    with pytest.raises(ValueError):
+        Mosaic.load(path, calibration)
+    mosaic.finish()
+    focus = mosaic.focus.to_array()
+    # The blended overlap matches the world it was cut from
+    x0, y0 = mosaic.tiles[0]['offset']
+    height, width = FIELD_SHAPE
+    np.testing.assert_allclose(
+            focus[y0:y0+height, x0:x0+width+100],
+            world[200:200+height, 200:200+width+100],
+            atol=1,
+            )
+
+    collector = MosaicCollector()
+    collector.open(path, calibration)
+    assert collector.ready and not collector.running
+    assert collector.num_tiles == 2 and collector.num_added == 2
+    loaded = collector.mosaic
+    assert loaded.shape == mosaic.shape
+    np.testing.assert_array_equal(loaded.focus.to_array(), focus)
+    points = np.array([[x0 + 10.0, y0 + 20.0], [x0 + 200.5, y0 + 60.0]])
+    np.testing.assert_allclose(loaded.px_to_mm(points), mosaic.px_to_mm(points))
+    np.testing.assert_allclose(loaded.sample_depth(points), 0.01, rtol=1.0e-6)
+    image, factor = loaded.overview(max(loaded.shape)//2)
+    assert factor == 2
+    assert image.shape[:2] == tuple(-(-n//2) for n in loaded.shape)
+
+
+def test_open_not_a_mosaic(tmp_path):
+    (tmp_path / Mosaic.HEADER_FILENAME).write_text('{"format": "other"}')
+    with pytest.raises(ValueError):
+        MosaicCollector().open(str(tmp_path), LinearCalibration())
@@ -0,0 +1,81 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('sgolay2')
+
+from flasercutter.reprocess import get_config_name
+from flasercutter.reprocess import reprocess_main
+from flasercutter.reprocess import run_config
+from flasercutter.stack_archive import StackArchiveWriter
+
+
+SHAPE = (48, 64, 3)
+DEPTHS = [-0.02, -0.01, 0.0, 0.01, 0.02]
+CLEAN_ARGS = ['--median-filter-size', '3', '--sgolay-window-size', '5', '--sgolay-poly-order', '2']
+
+
+def write_stack(path, compression=None, raw=True, num_frames=3, seed=0):
+    rng = np.random.default_rng(seed)
+    with StackArchiveWriter(str(path), compression=compression) as writer:
+        for z in DEPTHS:
+            frames = [rng.integers(0, 256, size=SHAPE, dtype=np.uint8) for i in range(num_frames)]
+            median = np.median(frames, axis=0).astype(np.uint8)
+            writer.write_step(z, frames if raw else [], median=median)
+    return str(path)
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_reprocess_sweep(tmp_path, compression):
+    archive_path = write_stack(tmp_path / 'test.stack', compression)
+    output_dir = tmp_path / 'out'
+    argv = [archive_path, '-o', str(output_dir), '-w', '2', '--reducer', 'stored', 'mean']
+    assert reprocess_main(argv + CLEAN_ARGS) == 0
+
+    with open(output_dir / 'results.json') as f:
+        summary = json.load(f)
+    assert summary['archive'] == archive_path
+    results = summary['results']
+    assert sorted(result['config']['reducer'] or 'stored' for result in results) == ['mean', 'stored']
+    for result in results:
+        assert 'error' not in result
+        assert os.path.exists(result['focus_file'])
+        depth_image = np.load(result['depth_file'])
+        assert depth_image.shape == SHAPE[:2]
+        assert np.isfinite(depth_image).all()
+        timing = result['timing']
+        for name in ('load', 'focus_stack', 'clean_depth', 'total'):
+            assert timing[name] >= 0.0
+        assert timing['total'] >= timing['clean_depth']
+
+
+def test_run_config_reducers_match_stored_median(tmp_path):
+    archive_path = write_stack(tmp_path / 'test.stack')
+    config = {
+            'laplacian_kernel_size'     : 5,
+            'gaussian_blur_kernel_size' : 5,
+            'median_filter_size'        : 3,
+            'sgolay_window_size'        : 5,
+            'sgolay_poly_order'         : 2,
+            }
+    outputs = {}
+    for reducer in (None, 'median'):
+        result = run_config(archive_path, dict(config, reducer=reducer), str(tmp_path))
+        assert os.path.basename(result['focus_file']).startswith(get_config_name(result['config']))
+        outputs[reducer] = np.load(result['depth_file'])
+    # The stored medians are the median reducer's output
+    np.testing.assert_array_equal(outputs[None], outputs['median'])
+
+
+def test_reprocess_without_raw_frames(tmp_path, capsys):
+    archive_path = write_stack(tmp_path / 'test.stack', raw=False)
+    output_dir = tmp_path / 'out'
+    with pytest.raises(SystemExit) as exc_info:
+        reprocess_main([archive_path, '-o', str(output_dir), '--reducer', 'mean'] + CLEAN_ARGS)
+    assert exc_info.value.code != 0
+    assert 'raw frames' in capsys.readouterr().err
+    assert not output_dir.exists()
+    argv = [archive_path, '-o', str(output_dir), '-w', '1', '--reducer', 'stored']
+    assert reprocess_main(argv + CLEAN_ARGS) == 0
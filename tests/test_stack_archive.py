@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from flasercutter.stack_archive import StackArchive
+from flasercutter.stack_archive import StackArchiveWriter
+
+
+SHAPE = (24, 32, 3)
+
+
+def make_frames(num_steps=3, num_frames=4, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+            [rng.integers(0, 256, size=SHAPE, dtype=np.uint8) for i in range(num_frames)]
+            for step in range(num_steps)
+            ]
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_round_trip(tmp_path, compression):
+    path = tmp_path / 'test.stack'
+    frames = make_frames()
+    depths = [-0.01, 0.0, 0.012]
+    metadata = {'images_per_step': 4}
+    with StackArchiveWriter(path, compression=compression, metadata=metadata) as writer:
+        for step, (z, step_frames) in enumerate(zip(depths, frames)):
+            timestamps = [10.0*step + 0.1*i for i in range(len(step_frames))]
+            median = np.median(step_frames, axis=0).astype(np.uint8)
+            writer.write_step(z, step_frames, median=median, timestamps=timestamps)
+
+    archive = StackArchive(path)
+    assert archive.num_steps == len(depths)
+    assert archive.depths == depths
+    assert archive.shape == SHAPE
+    assert archive.dtype == np.uint8
+    assert archive.compressed == (compression is not None)
+    assert archive.metadata == metadata
+    for step, step_frames in enumerate(frames):
+        assert archive.num_frames(step) == len(step_frames)
+        assert archive.timestamps(step) == [10.0*step + 0.1*i for i in range(len(step_frames))]
+        array = archive.frames(step)
+        assert isinstance(array, np.memmap) == (compression is None)
+        np.testing.assert_array_equal(array, np.array(step_frames))
+        np.testing.assert_array_equal(archive.frame(step, 2), step_frames[2])
+        for frame, expected in zip(archive.iter_frames(step), step_frames):
+            np.testing.assert_array_equal(frame, expected)
+        median = np.median(step_frames, axis=0).astype(np.uint8)
+        np.testing.assert_array_equal(archive.median(step), median)
+
+
+def test_raw_file_is_contiguous_frames(tmp_path):
+    path = tmp_path / 'test.stack'
+    frames = make_frames(num_steps=1)
+    with StackArchiveWriter(path) as writer:
+        writer.write_step(0.0, frames[0])
+    data = (path / 'raw_0000.bin').read_bytes()
+    assert data == np.array(frames[0]).tobytes()
+
+
+def test_streamed_steps(tmp_path):
+    # Steps written frame by frame with z only known at the end, as in a sweep
+    path = tmp_path / 'test.stack'
+    frames = make_frames(num_steps=2)
+    writer = StackArchiveWriter(path, compression='zlib')
+    for step, step_frames in enumerate(frames):
+        writer.begin_step(0.0)
+        for i, frame in enumerate(step_frames):
+            writer.add_frame(frame, float(i))
+        writer.end_step(step_frames[0], z=0.01*step)
+    writer.close()
+    archive = StackArchive(path)
+    assert archive.depths == [0.0, 0.01]
+    np.testing.assert_array_equal(archive.frames(1), np.array(frames[1]))
+    np.testing.assert_array_equal(archive.median(1), frames[1][0])
+
+
+def test_mismatched_frame_rejected(tmp_path):
+    writer = StackArchiveWriter(tmp_path / 'test.stack')
+    writer.begin_step(0.0)
+    writer.add_frame(np.zeros(SHAPE, dtype=np.uint8))
+    with pytest.raises(ValueError):
+        writer.add_frame(np.zeros((10, 10, 3), dtype=np.uint8))
+
+
+def test_not_an_archive(tmp_path):
+    (tmp_path / StackArchiveWriter.HEADER_FILENAME).write_text('{"format": "other"}')
+    with pytest.raises(ValueError):
+        StackArchive(tmp_path)
+
+
+def test_collector_records_stack(tmp_path):
+    pytest.importorskip('sgolay2')
+    from flasercutter.image_stack_collector import ImageStackCollector
+    collector = ImageStackCollector(-0.01, 0.01, 3)
+    collector.images_per_step = 2
+    collector.record_dir = str(tmp_path)
+    frames = make_frames(num_steps=3, num_frames=2)
+    collector.start()
+    step = 0
+    while collector.next_step() is not None:
+        for i, frame in enumerate(frames[step]):
+            collector.add_image(frame, 10.0*step + i)
+        step += 1
+    assert not collector.running
+    archive = StackArchive(collector.record_path)
+    np.testing.assert_allclose(archive.depths, collector.steps)
+    for step in range(3):
+        np.testing.assert_array_equal(archive.frames(step), np.array(frames[step]))
+        assert archive.timestamps(step) == [10.0*step, 10.0*step + 1]
+        assert archive.median(step) is not None
+    # The next stack gets its own archive
+    first_path = collector.record_path
+    collector.start()
+    collector.stop()
+    assert collector.record_path != first_path
@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip('sgolay2')
+
+from flasercutter.focus_stacker import FocusStacker
+from flasercutter.tile_pipeline import TilePipeline
+from flasercutter.tile_pipeline import clean_depth_image
+from flasercutter.image_stack_collector import ImageStackCollector
+
+
+# Frame size is not a multiple of the tile size, so the last row and column of tiles
+# are narrower than the halo.
+FRAME_SHAPE = (200, 230)
+TILE_SIZE = 64
+
+
+def make_stack(shape=FRAME_SHAPE, num_steps=9, seed=0):
+    """ Synthetic stack of a textured, tilted and curved surface. Each image is sharp
+    where the surface is close to its depth and increasingly blurred away from it.
+    """
+    rng = np.random.default_rng(seed)
+    texture = rng.integers(0, 256, size=shape + (3,), dtype=np.uint8)
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    surface = 0.6*x/shape[1] + 0.3*np.sin(2*np.pi*y/shape[0])
+    depths = list(np.linspace(surface.min(), surface.max(), num_steps))
+    blurred = [texture] + [cv2.GaussianBlur(texture, (0, 0), sigma) for sigma in (1, 2, 4)]
+    images = []
+    for depth in depths:
+        level = np.clip(np.abs(surface - depth)*num_steps, 0, len(blurred) - 1).astype(int)
+        image = np.empty_like(texture)
+        for n, item in enumerate(blurred):
+            image[level == n] = item[level == n]
+        images.append(image)
+    return images, depths
+
+
+def make_pipeline(tile_size):
+    return TilePipeline(
+            ImageStackCollector.DEFAULT_FOCUS_STACKER_PARAM,
+            ImageStackCollector.DEFAULT_MEDIAN_FILTER_SIZE,
+            ImageStackCollector.DEFAULT_SGOLAY_WINDOW_SIZE,
+            ImageStackCollector.DEFAULT_SGOLAY_POLY_ORDER,
+            tile_size=tile_size,
+            max_workers=2,
+            )
+
+
+def untiled_focus_and_depth(images, depths):
+    fs = FocusStacker(**ImageStackCollector.DEFAULT_FOCUS_STACKER_PARAM)
+    focus_image, depth_image = fs.focus_stack(images, depths)
+    return focus_image, untiled_clean_depth(depth_image)
+
+
+def untiled_clean_depth(depth_image):
+    return clean_depth_image(
+            depth_image,
+            ImageStackCollector.DEFAULT_MEDIAN_FILTER_SIZE,
+            ImageStackCollector.DEFAULT_SGOLAY_WINDOW_SIZE,
+            ImageStackCollector.DEFAULT_SGOLAY_POLY_ORDER,
+            )
+
+
+@pytest.mark.parametrize('tile_size', [TILE_SIZE, max(FRAME_SHAPE)])
+def test_focus_and_depth_matches_untiled(tile_size):
+    images, depths = make_stack()
+    focus_image, depth_image = make_pipeline(tile_size).focus_and_depth(images, depths)
+    focus_expected, depth_expected = untiled_focus_and_depth(images, depths)
+    np.testing.assert_array_equal(focus_image, focus_expected)
+    # The Savitzky-Golay filter may convolve via the fft, whose rounding depends on size
+    np.testing.assert_allclose(depth_image, depth_expected, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('tile_size', [TILE_SIZE, max(FRAME_SHAPE)])
+def test_clean_depth_matches_untiled(tile_size):
+    images, depths = make_stack()
+    fs = FocusStacker(**ImageStackCollector.DEFAULT_FOCUS_STACKER_PARAM)
+    _, depth_image = fs.focus_stack(images, depths)
+    clean_image = make_pipeline(tile_size).clean_depth(depth_image)
+    np.testing.assert_allclose(clean_image, untiled_clean_depth(depth_image), rtol=0, atol=1e-9)
+
+
+def test_tiles_cover_frame():
+    pipeline = make_pipeline(TILE_SIZE)
+    halo = pipeline.focus_halo + pipeline.clean_halo
+    count = np.zeros(FRAME_SHAPE, dtype=int)
+    for core, padded, inner in pipeline.tiles(FRAME_SHAPE, halo):
+        count[core] += 1
+        padded_shape = tuple(s.stop - s.start for s in padded)
+        assert np.zeros(padded_shape)[inner].shape == count[core].shape
+    np.testing.assert_array_equal(count, 1)
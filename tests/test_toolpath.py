@@ -0,0 +1,197 @@
+import re
+
+import numpy as np
+import pytest
+
+from flasercutter import toolpath
+from flasercutter.toolpath import MOVE_ARC_CCW
+from flasercutter.toolpath import MOVE_ARC_CW
+from flasercutter.toolpath import MOVE_LINE
+
+
+TOLERANCE = 0.002
+
+
+def path_distance(points, path):
+    """ Distance from each of points to the polyline path. """
+    points = np.asarray(points, dtype=np.float64)
+    dist = np.full(len(points), np.inf)
+    for start, end in zip(path[:-1], path[1:]):
+        dist = np.minimum(dist, toolpath.point_segment_distance(points, start, end))
+    return dist
+
+
+def arc_points(start, end, offset, clockwise, num=500):
+    center = start[:2] + offset
+    angle_start = np.arctan2(*(start[:2] - center)[::-1])
+    angle_end = np.arctan2(*(end[:2] - center)[::-1])
+    sweep = angle_end - angle_start
+    if clockwise and sweep >= 0.0:
+        sweep -= 2.0*np.pi
+    elif not clockwise and sweep <= 0.0:
+        sweep += 2.0*np.pi
+    radius = np.linalg.norm(start[:2] - center)
+    s = np.linspace(0.0, 1.0, num)
+    angle = angle_start + s*sweep
+    x = center[0] + radius*np.cos(angle)
+    y = center[1] + radius*np.sin(angle)
+    z = start[2] + s*(end[2] - start[2])
+    return np.column_stack((x, y, z))
+
+
+def moves_to_path(start, moves):
+    """ Densely sampled points along the moves, arcs included. """
+    path = [np.asarray(start, dtype=np.float64)[np.newaxis]]
+    pos = np.asarray(start, dtype=np.float64)
+    for code, end, offset in moves:
+        end = np.asarray(end, dtype=np.float64)
+        if code == MOVE_LINE:
+            path.append(end[np.newaxis])
+        else:
+            path.append(arc_points(pos, end, np.asarray(offset), code == MOVE_ARC_CW)[1:])
+        pos = end
+    return np.concatenate(path)
+
+
+def wavy_path(num=500, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0.0, 2.0, num)
+    y = 0.1*np.sin(3*x) + 0.0005*rng.standard_normal(num)
+    z = 0.02*x
+    return np.column_stack((x, y, z))
+
+
+def circle_path(num=100, radius=1.0, center=(0.5, -0.25), start_angle=0.3, sweep=np.pi, dz=0.0):
+    angle = start_angle + np.linspace(0.0, sweep, num)
+    x = center[0] + radius*np.cos(angle)
+    y = center[1] + radius*np.sin(angle)
+    z = np.linspace(0.0, dz, num)
+    return np.column_stack((x, y, z))
+
+
+@pytest.mark.parametrize('tolerance', [0.0005, TOLERANCE, 0.01])
+def test_simplify_rdp_tolerance(tolerance):
+    points = wavy_path()
+    simplified = toolpath.simplify_rdp(points, tolerance)
+    assert len(simplified) < len(points)
+    np.testing.assert_array_equal(simplified[0], points[0])
+    np.testing.assert_array_equal(simplified[-1], points[-1])
+    assert path_distance(points, simplified).max() <= tolerance
+    # Kept points are original points, in order
+    index = [np.flatnonzero((points == p).all(axis=1))[0] for p in simplified]
+    assert index == sorted(index)
+
+
+def test_simplify_rdp_short():
+    points = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]])
+    np.testing.assert_array_equal(toolpath.simplify_rdp(points), points)
+
+
+def test_merge_collinear():
+    points = np.array([
+        [0.0, 0.0, 0.0],
+        [0.5, 0.0, 0.0],
+        [0.5, 0.0, 0.0],
+        [1.0, 0.0, 0.0],
+        [1.0, 1.0, 0.5],
+        [1.0, 2.0, 1.0],
+        [0.0, 2.0, 1.0],
+        [0.0, 2.0, 1.0],
+        ])
+    merged = toolpath.merge_collinear(points)
+    expected = np.array([
+        [0.0, 0.0, 0.0],
+        [1.0, 0.0, 0.0],
+        [1.0, 2.0, 1.0],
+        [0.0, 2.0, 1.0],
+        ])
+    np.testing.assert_array_equal(merged, expected)
+
+
+def test_merge_collinear_keeps_reversal():
+    # Going back along the same line is not a single move
+    points = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.5, 0.0, 0.0]])
+    np.testing.assert_array_equal(toolpath.merge_collinear(points), points)
+
+
+@pytest.mark.parametrize('sweep, code', [(np.pi, MOVE_ARC_CCW), (-np.pi, MOVE_ARC_CW)])
+def test_fit_arcs_direction_and_center(sweep, code):
+    center = np.array([0.5, -0.25])
+    points = circle_path(center=center, sweep=sweep)
+    moves = toolpath.fit_arcs(points, TOLERANCE)
+    assert len(moves) == 1
+    move_code, end, offset = moves[0]
+    assert move_code == code
+    np.testing.assert_array_equal(end, points[-1])
+    np.testing.assert_allclose(offset, center - points[0,:2], atol=1.0e-9)
+    path = moves_to_path(points[0], moves)
+    assert path_distance(points, path).max() <= TOLERANCE
+
+
+def test_fit_arcs_helical():
+    points = circle_path(sweep=1.5*np.pi, dz=0.05)
+    moves = toolpath.fit_arcs(points, TOLERANCE)
+    assert [move[0] for move in moves] == [MOVE_ARC_CCW]
+    path = moves_to_path(points[0], moves)
+    assert path_distance(points, path).max() <= TOLERANCE
+
+
+def test_fit_arcs_rejects_coarse_polygon():
+    # The chords of a coarse polygon bulge further from its circle than the tolerance
+    points = circle_path(num=8, sweep=np.pi)
+    moves = toolpath.fit_arcs(points, TOLERANCE)
+    assert all(move[0] == MOVE_LINE for move in moves)
+    assert len(moves) == len(points) - 1
+
+
+@pytest.mark.parametrize('arcs', [False, True])
+def test_optimize_toolpath_tolerance(arcs):
+    line = np.column_stack((np.linspace(-1.0, 0.5, 50), np.full(50, 0.75), np.zeros(50)))
+    points = np.concatenate((line, circle_path(num=200, dz=0.01)[1:], wavy_path()[::-1] + (0, -1, 0)))
+    moves = toolpath.optimize_toolpath(points, TOLERANCE, arcs=arcs)
+    assert len(moves) < len(points)//4
+    np.testing.assert_array_equal(moves[-1][1], points[-1])
+    codes = {move[0] for move in moves}
+    if arcs:
+        assert MOVE_ARC_CCW in codes
+    else:
+        assert codes == {MOVE_LINE}
+    path = moves_to_path(points[0], moves)
+    assert path_distance(points, path).max() <= TOLERANCE
+
+
+def test_toolpath_to_gcode():
+    moves = [
+            (MOVE_LINE, np.array([1.0, 2.0, -0.0125]), None),
+            (MOVE_ARC_CW, np.array([2.0, 3.0, 0.0]), np.array([1.0, -0.5])),
+            (MOVE_ARC_CCW, np.array([0.0, 0.0, 0.0]), np.array([-1.0, 0.25])),
+            ]
+    assert toolpath.toolpath_to_gcode(moves) == [
+            'G1 X1.000 Y2.000 Z-0.013',
+            'G2 X2.000 Y3.000 Z0.000 I1.000 J-0.500',
+            'G3 X0.000 Y0.000 Z0.000 I-1.000 J0.250',
+            ]
+
+
+def test_gcode_arcs_round_trip():
+    # I/J are relative to the start of each move, as grbl expects in G91.1 (default)
+    # An S curve, counterclockwise then clockwise about the mirrored center
+    center = np.array([0.5, -0.25])
+    first = circle_path(center=center)
+    center_second = 2*first[-1,:2] - center
+    second = circle_path(center=center_second, start_angle=0.3, sweep=-np.pi)
+    points = np.concatenate((first, second[1:]))
+    moves = toolpath.optimize_toolpath(points, TOLERANCE, arcs=True)
+    assert [move[0] for move in moves] == [MOVE_ARC_CCW, MOVE_ARC_CW]
+    pos = points[0]
+    word_re = re.compile(r'([XYZIJ])(-?[0-9.]+)')
+    for cmd, (code, end, offset) in zip(toolpath.toolpath_to_gcode(moves), moves):
+        words = dict((letter, float(value)) for letter, value in word_re.findall(cmd))
+        assert cmd.split()[0] == code
+        np.testing.assert_allclose([words['X'], words['Y'], words['Z']], end, atol=5.0e-4)
+        if offset is not None:
+            center = pos[:2] + (words['I'], words['J'])
+            radius_start = np.linalg.norm(pos[:2] - center)
+            radius_end = np.linalg.norm(end[:2] - center)
+            assert abs(radius_start - radius_end) < 2.0e-3
+        pos = end